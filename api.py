@@ -3,63 +3,137 @@
 Python API for PriorityStoreLite. Built on top of commonly available UNIX tools.
 
 Exposes a simple CRUD API. Assumes that user to which SSH is done to has public key SSH configured.
+All remote operations go through the transport configured in config.json (see transport.py).
 
 Author: Brian Tuan
 """
 
+from concurrent.futures import ThreadPoolExecutor, wait
+import contextlib
+import fcntl
+import io
 import json
-from multiprocessing import cpu_count
-import queue
-from random import randrange
-from subprocess import run
+import os
+from random import random, randrange
 import time
 import numpy as np
-from threading import Thread
+import shutil
+from subprocess import CompletedProcess, TimeoutExpired
 import sys
-import copy
+import tempfile
+from threading import Lock, RLock
+
+from cache import ReadCache
+from index import FileListing, MetadataIndex, chunk_name, chunk_sizes, entry_nodes
+from inventory import reconcile
+from journal import MetadataJournal
+from latency import LatencyTracker
+from locks import ShardedLocks
+from metastore import open_store
+from metrics import Metrics
+from migrate import Migrator
+from placement import PlacementIndex
+from planner import plan_reassign
+from pool import TaskBatch, TaskPool
+from prober import NodeProber
+from stream import ChainedReader, RemoteReader, iter_chunks, range_command
+from tiering import AccessTracker, Tierer, plan_tiers
+from transport import make_transport
+from upload import Uploader
 
 FILE_FREQUENCY = {0: 0.01, 1: 0.09, 2: 0.99}
 ACCESS_FREQUENCY = {0: 0.15, 1: 0.35, 2: 0.5}
 
-def psl_worker(psl, task_queue, stats):
-    while True:
-        command = task_queue.get()
-        if command is None:
-            break
-        func, args, kwargs = command
-        time_before = time.time()
-        func(*args, **kwargs)
-        time_after = time.time()
-        time_taken = time_after - time_before
-        # Save the statistics
-        if stats and 'step' in kwargs:
-            stats[int(kwargs['step'])][args[0]] = time_taken
-        if psl.verbose:
-            print(func.__name__, args, kwargs)
-        task_queue.task_done()
+def psl_worker(psl, task, stats, wait=None):
+    """ Run one (func, args, kwargs) task on a pool worker, recording its latency in stats.
+
+    stats is a results sink such as results.ResultStream: tasks with a step keyword are recorded with
+    stats.record(step, filename, latency).
+    """
+    func, args, kwargs = task
+    psl.metrics.queued(wait)
+    time_before = time.time()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        print("Task failed:", func.__name__, args, kwargs, repr(e), file=sys.stderr)
+        raise
+    finally:
+        psl.metrics.queued(None)
+    time_after = time.time()
+    time_taken = time_after - time_before
+    # Save the statistics
+    if stats is not None and 'step' in kwargs:
+        stats.record(int(kwargs['step']), args[0], time_taken)
+    if psl.verbose:
+        print(func.__name__, args, kwargs)
+    return result
 
 class PriorityStoreLite:
     def __init__(self, config_dir, verbose=False):
         self.verbose = verbose
         self.config_dir = config_dir + '/' if config_dir[-1] != '/' else config_dir
+        self.dir_lock = self.lock_config_dir()
+        try:
+            with open(self.config_dir + 'config.json', 'r') as f:
+                self.config = json.load(f)
+                if self.config is None:
+                    self.config = {}
 
-        with open(self.config_dir + 'config.json', 'r') as f:
-            self.config = json.load(f)
-            if self.config is None:
-                self.config = {}
+            with open(self.config_dir + 'datanodes.json', 'r') as f:
+                self.datanodes = json.load(f)['nodelist']
+                assert(len(self.datanodes) != 0)
 
-        with open(self.config_dir + 'metadata.json', 'r') as f:
-            self.metadata = json.load(f)
-            if self.metadata is None:
-                self.metadata = {}
+            self.metadata = open_store(self.config_dir, self.datanodes)
+            # metadata_lock is the one lock over the metadata store, the index, the journal order
+            # and the placement and space accounting (available, effective, placement,
+            # priority_counter). It is held for local updates only, never across a remote command.
+            # Operations on one file, remote commands included, are serialized by its shard of
+            # file_locks, so only those shard.
+            self.metadata_lock = RLock()
+            self.file_locks = ShardedLocks(self.config.get('lock_shards', 64))
+            # Files being uploaded: their names are taken, but not in metadata yet.
+            self.claims = set()
+            # One snapshot at a time: each rotates the journal the previous one is compacting.
+            self.persist_lock = RLock()
 
-        with open(self.config_dir + 'datanodes.json', 'r') as f:
-            self.datanodes = json.load(f)['nodelist']
-            assert(len(self.datanodes) != 0)
-
-        self.setup_system_info()
+            self.transport = make_transport(self.config)
+            self.pool = None
+            self.fanout = None
+            self.migrator = Migrator(self, bandwidth=self.config.get('migration_bandwidth', 0),
+                                     node_bandwidth=self.config.get('migration_node_bandwidth', 0))
+            self.uploader = Uploader(self, max_parts=self.config.get('upload_parts', 4))
+            self.batch_lock = Lock()
+            # Held from planning a batch to submitting its scripts, so they reach the pool in plan order.
+            self.batch_order = Lock()
+            self.latency = LatencyTracker()
+            self.metrics = Metrics(enabled=self.config.get('metrics', True))
+            if self.config.get('metrics_port', 0) > 0:
+                self.metrics.serve(self.config['metrics_port'])
+            self.access = AccessTracker(half_life=self.config.get('access_half_life', 3600.0))
+            self.cache = None
+            if self.config.get('cache_size', 0) > 0:
+                self.cache = ReadCache(self.config.get('cache_dir', self.config_dir + 'cache'),
+                                       self.config['cache_size'],
+                                       pin_priority0=self.config.get('cache_pin_priority0', False))
+            self.setup_system_info()
+            self.recover_metadata()
+        except BaseException:
+            # Nothing will call close(): let the next store take the directory.
+            os.close(self.dir_lock)
+            raise
         # sys.stdout = Logger()
 
+    def lock_config_dir(self):
+        """ Take the config directory for this store: one writer at a time on its journal and snapshot. """
+        fd = os.open(self.config_dir, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError("{} is in use by another PriorityStoreLite (a daemon?)".format(self.config_dir))
+        return fd
+
     def setup_system_info(self):
         self.num = len(self.datanodes)
 
@@ -70,6 +144,7 @@ class PriorityStoreLite:
             self.latencies = self.metadata["PSL"]["latencies"]
             self.effective = self.metadata["PSL"]["effective"]
             self.priority_counter = self.metadata["PSL"]["priority_counter"]
+            self.recompute_effectiveness()
             return
 
         # This is usually an initial setup for a clean system.
@@ -87,96 +162,426 @@ class PriorityStoreLite:
         self.priority_counter = [ 0.0 ] * 3
     
     def recompute_effectiveness(self):
-        self.effective = [0.0] * self.num 
-        for node_id in range(self.num):
-            self.effectiveness_for_node(node_id)
+        with self.metadata_lock:
+            # Constants of the cluster layout, only change with latencies or capacities.
+            self.slowest = int(np.argmax(self.latencies))
+            self.worst_latency = max(self.latencies)*self.capacities[self.slowest]/self.block_size
+            self.total_capacity = sum(self.capacities)
+            self.total_available = sum(self.available)
+            self.effective = [0.0] * self.num
+            for node_id in range(self.num):
+                self.effective[node_id] = self.effectiveness_for_node_helper(node_id, self.available)
+            self.placement = PlacementIndex(self.effective)
     
     def effectiveness_for_node(self, i):
         self.effective[i] = self.effectiveness_for_node_helper(i, self.available)
+        self.placement.update(i, self.effective[i])
 
     def effectiveness_for_node_helper(self, i, available):
-        worst_latency = max(self.latencies)*self.capacities[np.argmax(self.latencies)]/self.block_size
+        worst_latency = self.worst_latency
         avg_latency = max(0.5*(self.capacities[i] - available[i])*self.latencies[i]/self.block_size, 
                           self.latencies[i])
         # the greater the avg_latency, the worse for us it is
         return 1.0 - (avg_latency/worst_latency)
     
-    def persist_metadata(self):
-        self.metadata["PSL"] = {
-            'capacities': self.capacities,
-            'available': self.available,
-            'block_size': self.block_size,
-            'latencies': self.latencies,
-            'effective': self.effective,
-            'priority_counter': self.priority_counter
-        }
-        with open(self.config_dir + 'metadata.json', 'w') as f:
-            json.dump(self.metadata, f)
+    def recover_metadata(self):
+        """ Replay the metadata journal on top of the metadata.bin snapshot. """
+        self.journal = MetadataJournal(self.config_dir,
+                                       sync_interval=self.config.get('journal_sync_interval', 0.1),
+                                       compact_every=self.config.get('journal_compact_every', 100000),
+                                       enabled=self.config.get('journal', True))
+        seq = self.metadata["PSL"].get("journal_seq", 0) if "PSL" in self.metadata else 0
+        replayed = False
+        for record in self.journal.records_after(seq):
+            self.apply_record(record)
+            seq = record['seq']
+            replayed = True
+        self.journal.open(seq)
+        self.prober = NodeProber(self, interval=self.config.get('probe_interval', 0),
+                                 probe_bytes=self.config.get('probe_bytes', 4194304))
+        if "PSL" in self.metadata and "probes" in self.metadata["PSL"]:
+            self.prober.load_json(self.metadata["PSL"]["probes"])
+        if "PSL" in self.metadata and "access" in self.metadata["PSL"]:
+            self.access.load_json(self.metadata["PSL"]["access"])
+        if self.config.get('probe_interval', 0) > 0:
+            self.prober.start()
+        self.tierer = Tierer(self, self.config.get('tiering_interval', 0))
+        if self.config.get('tiering_interval', 0) > 0:
+            self.tierer.start()
+        self.index = MetadataIndex(self.metadata, lock=self.metadata_lock)
+        if replayed:
+            self.recompute_effectiveness()
+        if self.journal.interrupted():
+            # A compaction died half-way: fold its journal into a fresh snapshot before new writes.
+            self.persist_metadata()
+
+    def apply_record(self, record):
+        op = record['op']
+        if op == 'create':
+            self.metadata[record['file']] = record['entry']
+            self.priority_counter[record['entry']['priority']] += 1
+        elif op == 'delete' and record['file'] in self.metadata:
+            self.priority_counter[self.metadata[record['file']]['priority']] -= 1
+            del self.metadata[record['file']]
+        elif op == 'move':
+            fields = {'node_id': record['node_id']}
+            if 'replicas' in record:
+                fields['replicas'] = record['replicas']
+            self.metadata.update_entry(record['file'], **fields)
+        elif op == 'capacity':
+            self.available[record['node_id']] = record['available']
+        elif op == 'priority':
+            info = self.metadata[record['file']]
+            self.priority_counter[info['priority']] -= 1
+            self.priority_counter[record['priority']] += 1
+            self.metadata.update_entry(record['file'], priority=record['priority'])
+        elif op == 'latency':
+            self.latencies[record['node_id']] = record['latency']
+        elif op == 'latencies':
+            self.latencies[:] = record['latencies']
+
+    def add_entry(self, filename, entry):
+        with self.metadata_lock:
+            self.metadata[filename] = entry
+            self.index.add(filename, entry)
+            # Important to update the priority counter! This is for data placement algorithm.
+            self.priority_counter[entry['priority']] += 1
+            self.journal.append('create', file=filename, entry=entry)
+
+    def remove_entry(self, filename):
+        with self.metadata_lock:
+            self.priority_counter[self.metadata[filename]['priority']] -= 1
+            self.index.remove(filename, self.metadata[filename])
+            del self.metadata[filename]
+            self.journal.append('delete', file=filename)
+
+    def move_entry(self, filename, node_id):
+        """ Point a file's primary copy at node_id, once the data is there. """
+        with self.file_locks(filename), self.metadata_lock:
+            info = self.metadata[filename]
+            old = info['node_id']
+            old_nodes = entry_nodes(info)
+            replicas = self.replicas(info)
+            if node_id not in replicas:
+                # The copy itself moved: space moves with it.
+                self.reserve(node_id, -info['size'])
+                self.reserve(old, info['size'])
+                replicas = [node_id] + [r for r in replicas if r != old]
+            else:
+                replicas = [node_id] + [r for r in replicas if r != node_id]
+            fields = {'node_id': node_id}
+            if len(replicas) > 1:
+                fields['replicas'] = replicas
+            self.metadata.update_entry(filename, **fields)
+            self.index.move(filename, old_nodes, entry_nodes(self.metadata[filename]))
+            if self.cache is not None:
+                self.cache.invalidate(filename)
+            self.journal.append('move', file=filename, **fields)
+
+    def set_priority(self, filename, priority):
+        with self.file_locks(filename), self.metadata_lock:
+            info = self.metadata.get(filename)
+            if info is None:
+                # Deleted since the caller looked.
+                return
+            self.index.remove(filename, info)
+            self.priority_counter[info['priority']] -= 1
+            self.metadata.update_entry(filename, priority=priority)
+            self.priority_counter[priority] += 1
+            self.index.add(filename, self.metadata[filename])
+            self.journal.append('priority', file=filename, priority=priority)
+
+    def reserve(self, node_id, delta):
+        """ Change a node's available space by delta bytes. """
+        with self.metadata_lock:
+            self.available[node_id] += delta
+            self.total_available += delta
+            self.effectiveness_for_node(node_id)
+            self.journal.append('capacity', node_id=node_id, available=self.available[node_id])
+
+    def update_latencies(self, latencies):
+        """ Set every node's measured latency and re-score them all for placement.
+
+        All nodes at once: the latencies are only comparable when they are all in the same units.
+        """
+        with self.metadata_lock:
+            self.latencies[:] = latencies
+            self.journal.append('latencies', latencies=list(latencies))
+            self.recompute_effectiveness()
+        self.commit_metadata()
+
+    def commit_metadata(self, persist=True):
+        """ Make journaled changes durable, compacting in the background when the journal is long. """
+        if persist:
+            self.journal.commit()
+        # Skipped if another thread is already snapshotting: never wait for it, as this thread may
+        # hold metadata_lock, which the snapshot needs.
+        if self.journal.needs_compaction() and self.persist_lock.acquire(blocking=False):
+            try:
+                if self.journal.needs_compaction():
+                    self.persist_metadata(background=True)
+            finally:
+                self.persist_lock.release()
+
+    def persist_metadata(self, background=False):
+        """ Write a full snapshot of the metadata and truncate the journal. """
+        with self.persist_lock:
+            self.journal.wait_compaction()
+            with self.metadata_lock:
+                # The snapshot must hold exactly the records up to seq: no mutation in between.
+                seq = self.journal.rotate()
+                self.metadata["PSL"] = {
+                    'capacities': list(self.capacities),
+                    'available': list(self.available),
+                    'block_size': self.block_size,
+                    'latencies': list(self.latencies),
+                    'effective': list(self.effective),
+                    'priority_counter': list(self.priority_counter),
+                    'probes': self.prober.to_json(),
+                    'access': self.access.to_json(),
+                    'journal_seq': seq
+                }
+                snapshot = self.metadata.snapshot()
+            self.journal.compact(snapshot, background=background, written=self.rebase_metadata)
+
+    def rebase_metadata(self, path):
+        """ Switch the metadata over to the snapshot just written at path, keeping later changes. """
+        with self.metadata_lock:
+            self.metadata.rebase(path)
+
+    def close(self):
+        self.tierer.stop()
+        self.prober.stop()
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.fanout is not None:
+            self.fanout.shutdown()
+        self.journal.close()
+        self.transport.close()
+        self.metrics.close()
+        if self.cache is not None:
+            self.cache.close()
+        os.close(self.dir_lock)
+
+    def remote_path(self, node, filename):
+        return self.transport.resolve(node, self.config['path'] + filename)
 
     def execute_command(self, node, command):
-        return run(['ssh', node, command])
+        return self.transport.execute(node, command)
 
     def create_file(self, filename, size=67108864, node_id=None, priority=2, persist=True):
-        if (filename in self.metadata) or (
-            node_id is not None and self.datanodes[node_id] not in self.datanodes):
+        planned = self.plan_create(filename, size=size, node_id=node_id, priority=priority, persist=persist)
+        if planned is None:
             return None
+        rc = self.execute_all(planned, op='create', priority=priority, wait=self.metrics.take_wait())
+        if rc.returncode != 0:
+            self.rollback_create(filename, persist=persist)
+        return rc
 
-        path = self.config['path'] + filename
-        command = "head -c {} </dev/urandom > {}".format(size, self.config['path'] + filename)
-        if node_id is None:
-            node_id = self.placement_node_id(priority)
-            if node_id is None:
-                return None
+    def rollback_create(self, filename, persist=True):
+        """ Undo a create whose remote command failed: give its space back and remove what got written. """
+        planned = self.plan_delete(filename, persist=persist)
+        if planned is not None:
+            self.execute_all(planned)
 
-        # Important to update the priority counter! This is for data placement algorithm.
-        self.priority_counter[priority] += 1
-        node = self.datanodes[node_id]
+    def put_file(self, filename, source, priority=2, node_id=None, persist=True):
+        """ Upload real content: source is a local path, bytes, a readable file or an iterable of bytes.
+
+        Large sources are striped and uploaded in parallel; every piece is checksummed on its node.
+        Returns None if the file already exists, otherwise a CompletedProcess (returncode 1 on failure).
+        """
+        return self.uploader.put(filename, source, priority=priority, node_id=node_id, persist=persist)
+
+    def execute_all(self, planned, op=None, priority=None, wait=None):
+        """ Run (node, command) pairs in parallel; returns the first failure, or the first result if none failed.
 
-        self.metadata[filename] = {
+        With op set, each command is recorded in the metrics under op and its node, and the first
+        one also records the pool wait.
+        """
+        def run(node_command):
+            start = time.time()
+            rc = self.execute_command(*node_command)
+            return rc, time.time() - start
+        if len(planned) == 1:
+            timed = [run(planned[0])]
+        else:
+            timed = list(self.fanout_pool().map(run, planned))
+        if op is not None:
+            for (node, _), (rc, seconds) in zip(planned, timed):
+                self.metrics.observe(op, seconds, node=node, priority=priority, error=rc.returncode != 0,
+                                     wait=wait)
+                wait = None
+        results = [rc for rc, _ in timed]
+        return next((rc for rc in results if rc.returncode != 0), results[0])
+
+    def fanout_pool(self):
+        """ Threads running the pieces (replicas, chunks) of a single operation in parallel. """
+        if self.fanout is None:
+            self.fanout = ThreadPoolExecutor(max_workers=self.config.get('fanout_workers', 16))
+        return self.fanout
+
+    def replication_factor(self, priority):
+        return min(int(self.config.get('replication', {}).get(str(priority), 1)), self.num)
+
+    def replicas(self, info):
+        """ Node ids holding a copy of the file, primary first. """
+        return info.get('replicas', [info['node_id']])
+
+    def copies(self, filename, info):
+        """ (node id, stored name, size) of every piece of a file: one per replica, or one per chunk. """
+        if 'chunks' in info:
+            return [(node_id, chunk_name(filename, i), size) for i, (node_id, size)
+                    in enumerate(zip(info['chunks'], chunk_sizes(info['size'], self.block_size)))]
+        return [(node_id, filename, info['size']) for node_id in self.replicas(info)]
+
+    @contextlib.contextmanager
+    def reservation(self):
+        """ Make the reserve calls of the block atomic: if a node runs out of space part-way, the
+        space already reserved is given back before the AssertionError propagates.
+        """
+        with self.metadata_lock:
+            available = list(self.available)
+            try:
+                yield
+            except AssertionError:
+                for node_id, before in enumerate(available):
+                    if self.available[node_id] != before:
+                        self.reserve(node_id, before - self.available[node_id])
+                raise
+
+    def place_chunks(self, priority, sizes, chosen=()):
+        """ Reserve space for each chunk, striping them over distinct nodes picked by effectiveness.
+
+        Returns the node ids of the chunks, appended to those of the chunks already placed in chosen.
+        """
+        chosen = list(chosen)
+        with self.reservation():
+            rank = self.effective_rank(self.num, priority)
+            for size in sizes:
+                # Chunks of the same stripe (one chunk per node) go to different nodes.
+                stripe = chosen[len(chosen) - len(chosen) % self.num:]
+                i = rank
+                while self.placement[i] in stripe:
+                    i = (i + 1) % self.num
+                node = self.placement[i]
+                self.reserve(node, -size)
+                # No more available storage!
+                assert self.available[node] > 0
+                chosen.append(node)
+        return chosen
+
+    def place_replicas(self, node_id, count, size):
+        """ Reserve space for count more copies on the most effective nodes other than node_id. """
+        chosen = [node_id]
+        with self.reservation():
+            for _ in range(count):
+                rank = 0
+                while self.placement[rank] in chosen:
+                    rank += 1
+                node = self.placement[rank]
+                self.reserve(node, -size)
+                # No more available storage!
+                assert self.available[node] > 0
+                chosen.append(node)
+        return chosen
+
+    def make_entry(self, node_id, priority, size, replicas=(), chunks=None):
+        entry = {
             'node_id': node_id,
-            'node': self.datanodes[node_id],
-            'modified': time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime()),
+            'mtime': int(time.time()),
             'priority': priority,
             'size': size
         }
+        if len(replicas) > 1:
+            entry['replicas'] = list(replicas)
+        if chunks is not None:
+            entry['chunks'] = chunks
+        return entry
 
-        if persist:
-            self.persist_metadata()
+    def place_entry(self, filename, size, node_id=None, priority=2):
+        """ Reserve space for all copies of a new file, or none, and return its metadata entry, not added yet. """
+        if (filename in self.metadata) or (
+            node_id is not None and not 0 <= node_id < self.num):
+            return None
 
-        if filename.count('/') > 1:
+        chunks = None
+        with self.reservation():
+            if node_id is None and size > self.block_size and self.num > 1:
+                # Large files are striped: each block_size chunk is placed on its own.
+                chunks = self.place_chunks(priority, chunk_sizes(size, self.block_size))
+                node_id = chunks[0]
+                replicas = []
+            elif node_id is None:
+                node_id = self.placement_node_id(priority, persist=False, size=size)
+                if node_id is None:
+                    return None
+                replicas = self.place_replicas(node_id, self.replication_factor(priority) - 1, size)
+            else:
+                # Explicit placement (e.g. a move) still consumes space on the target.
+                self.reserve(node_id, -size)
+                replicas = self.place_replicas(node_id, self.replication_factor(priority) - 1, size)
+        return self.make_entry(node_id, priority, size, replicas=replicas, chunks=chunks)
+
+    def release_entry(self, filename, entry):
+        """ Give back the space place_entry reserved for a file that was never added. """
+        for node_id, _, size in self.copies(filename, entry):
+            self.reserve(node_id, size)
+
+    def plan_create(self, filename, size=67108864, node_id=None, priority=2, persist=True):
+        """ Update metadata for a new file and return the (node, command) pairs that materialize it. """
+        # Under metadata_lock throughout, so the space is never seen reserved without its entry.
+        with self.file_locks(filename), self.metadata_lock:
+            if filename in self.claims:
+                return None
+            entry = self.place_entry(filename, size, node_id=node_id, priority=priority)
+            if entry is None:
+                return None
+            if self.cache is not None:
+                self.cache.invalidate(filename)
+            self.add_entry(filename, entry)
+        self.commit_metadata(persist)
+
+        if '/' in filename:
             basename = filename[:filename.rfind('/')]
         else:
             basename = ''
 
-        self.execute_command(node, 'mkdir -p "{}"'.format(self.config['path'] + basename))
-        return  self.execute_command(node, command)
+        planned = []
+        for i, name, piece_size in self.copies(filename, entry):
+            node = self.datanodes[i]
+            # Single round trip: create the directory and fill the file in one remote command.
+            command = 'mkdir -p "{}" && head -c {} </dev/urandom > "{}"'.format(
+                self.remote_path(node, basename), piece_size, self.remote_path(node, name))
+            planned.append((node, command))
+        return planned
 
     def get_effective_node_id(self, sorted_eff, priority=2):
-        # Sort based on effectiveness
-        n = len(sorted_eff)
-        node = sorted_eff[0]
-        high_pr_share = self.priority_counter[0]/sum(self.capacities)
-        if priority == 0 or 1.0* sum(self.available) > 0.1 * sum(self.capacities):
+        """ Pick a node from sorted_eff, any sequence of node ids ordered by effectiveness. """
+        return sorted_eff[self.effective_rank(len(sorted_eff), priority)]
+
+    def effective_rank(self, n, priority=2):
+        """ Rank, among n nodes sorted by effectiveness, at which a file of this priority goes. """
+        high_pr_share = self.priority_counter[0]/self.total_capacity
+        if priority == 0 or 1.0* self.total_available > 0.1 * self.total_capacity:
             # High priority
-            return node
+            return 0
         elif priority == 1:
             # Medium priority
             if high_pr_share < FILE_FREQUENCY[0]:
                 still_missing = FILE_FREQUENCY[0] - high_pr_share
-                node = sorted_eff[max(int(still_missing*n), 1)]
+                return max(int(still_missing*n), 1)
         elif priority == 2:
             # Low priority
-            med_pr_share = self.priority_counter[1]/sum(self.capacities)
+            med_pr_share = self.priority_counter[1]/self.total_capacity
             if high_pr_share < FILE_FREQUENCY[0] or med_pr_share < FILE_FREQUENCY[1]:
                 still_missing = ((FILE_FREQUENCY[0] - high_pr_share)
                                  + (FILE_FREQUENCY[1]  - med_pr_share))
-                node = sorted_eff[max(int(still_missing*n), 1)]
-        return node
+                return max(int(still_missing*n), 1)
+        return 0
 
     def fake_placement(self, avail, eff, previous_node_id, priority=2):
-        sorted_eff = [i[0] for i in sorted(
-            enumerate(eff), key=lambda x:x[1], reverse=True)]
-        node = self.get_effective_node_id(sorted_eff, priority)
+        """ Placement against a scratch layout: avail is a list, eff a PlacementIndex over it. """
+        node = self.get_effective_node_id(eff, priority)
         # No need to move if effectiveness is small.
         if abs(node - previous_node_id) <= 1:
             node = previous_node_id
@@ -184,144 +589,498 @@ class PriorityStoreLite:
         avail[node] -= self.block_size
         # No more available storage!
         assert avail[node] > 0
-        eff[node] = self.effectiveness_for_node_helper(node, avail)
+        eff.update(node, self.effectiveness_for_node_helper(node, avail))
         # (avail[node]/self.capacities[node])**2)/self.latencies[node]
         return node
 
-    def placement_node_id(self, priority=2, persist=True):
-        if self.num == 1:
-            return 0
-        sorted_eff = [i[0] for i in sorted(
-            enumerate(self.effective), key=lambda x:x[1], reverse=True)]
-        node = self.get_effective_node_id(sorted_eff, priority)
+    def placement_node_id(self, priority=2, persist=True, size=None):
+        """ Pick the node for a new copy of size bytes (default one block) and reserve the space. """
+        with self.reservation():
+            node = 0 if self.num == 1 else self.get_effective_node_id(self.placement, priority)
 
-        # print ("Placement_node_id for priority", priority, "is", node)
-        # Main formula for effectiveness.
-        self.available[node] -= self.block_size
-        # No more available storage!
-        assert self.available[node] > 0
-        self.effectiveness_for_node(node)
-        assert self.effective[node] <= 1.0
-        if persist:
-            self.persist_metadata()
+            # print ("Placement_node_id for priority", priority, "is", node)
+            # Main formula for effectiveness.
+            self.reserve(node, -(self.block_size if size is None else size))
+            # No more available storage!
+            assert self.available[node] > 0
+            assert self.effective[node] <= 1.0
+        self.commit_metadata(persist)
         return node
 
 
-    def placement_reassign(self):
+    def placement_reassign(self, dry_run=False):
+        """ Move files to where the greedy placement would put them today.
+
+        With dry_run=True nothing is moved; the ReassignPlan (moves and byte cost) is returned.
+        """
         # Not enough files to consider moving.
         print("Checking placement optimization.")
         #if sum(self.capacities) - sum(self.available) < 3221225472:
         #    return
-        eff = []
-        for i in range(self.num):
-            eff.append(1.0/self.latencies[i])
-        avail = [17179869184] * self.num
-        files = sorted(self.metadata.items(), 
-                       key=lambda k: k[1]["priority"] if k[0] != "PSL" else 0.0, reverse=True)
-        move = {}
-        for filename, value in files:
-            if filename == "PSL":
-                continue
-            best_place = self.fake_placement(avail, eff, value["node_id"], value["priority"]) 
-            if best_place != value["node_id"]:
-                # we need to move this 
-                move[filename] = best_place
-        print("Placement reassign: Need to move %d" % len(move))
-        if (len(move)) < 1:
-            return
+        if not dry_run:
+            self.resume_migration()
+        plan = plan_reassign(self)
+        print("Placement reassign: Need to move %d (%d bytes)" % (len(plan), plan.bytes))
+        if dry_run or len(plan) < 1:
+            return plan
+        self.run_migration(plan.moves)
+        return plan
+
+    def reconcile(self, repair=False, adopt=False, delete_orphans=False):
+        """ Compare the metadata with a listing of every datanode; returns an inventory.Inventory.
+
+        With repair=True, entries are fixed to match the nodes, available and priority_counter are
+        recomputed, and with adopt and delete_orphans, files no entry accounts for are turned into
+        entries or removed.
+        """
+        inventory = reconcile(self, repair=repair, adopt_orphans=adopt, remove_orphans=delete_orphans)
+        if inventory.repairs:
+            self.persist_metadata()
+        return inventory
+
+    def resume_migration(self):
+        """ Finish the moves of a placement_reassign that was interrupted. """
+        moves = self.migrator.pending()
+        if moves:
+            print("Resuming interrupted migration: %d moves left" % len(moves))
+            self.run_migration(moves, resume=True)
+        else:
+            self.migrator.finish()
+
+    def run_migration(self, moves, resume=False):
+        if not resume:
+            self.migrator.begin(moves)
         task_list = []
-        for filename, node_id in move.items():
+        for filename, node_id in moves.items():
             self.move_file(task_list, filename, node_id)
-
-        self.submit_tasks(task_list, block=True)
+        handle = self.submit_tasks(task_list, block=True)
         self.persist_metadata()
+        # Keep the batch around for the next run if some moves failed.
+        if all(handle.results) and not handle.errors():
+            self.migrator.finish()
+
+    def retier(self, dry_run=False):
+        """ Re-assign priorities from observed reads, then move files to match their new tier. """
+        changes = plan_tiers(self, FILE_FREQUENCY, margin=self.config.get('tiering_margin', 1.25))
+        print("Re-tiering: %d files change priority" % len(changes))
+        if dry_run or not changes:
+            return changes
+        for filename, priority in changes.items():
+            self.set_priority(filename, priority)
+        self.commit_metadata()
+        self.placement_reassign()
+        return changes
 
     def move_file(self, task_list, filename, node_id, persist=True):
-        if node_id is None or node_id not in self.datanodes:
+        if node_id is None or not 0 <= node_id < self.num:
             return
-        info = self.metadata[filename]
-        task_list.append((psl.delete_file, [filename], {'persist': False}))
-        task_list.append((psl.create_file, [filename], {'size': info['size'], 'node_id': node_id, 'persist': False, 'priority': info['priority']}))
+        task_list.append((self.migrate_file, [filename, node_id], {}))
+
+    def migrate_file(self, filename, node_id):
+        """ Copy a file to node_id, switch its metadata over, then delete the old copy. """
+        wait = self.metrics.take_wait()
+        info = self.metadata.get(filename)
+        start = time.time()
+        ok = self.migrator.migrate(filename, node_id)
+        if info is not None:
+            self.metrics.observe('migrate', time.time() - start, node=self.datanodes[node_id],
+                                 priority=info['priority'], nbytes=info['size'] if ok else 0,
+                                 error=not ok, wait=wait)
+        return ok
 
     def delete_file(self, filename, persist=True):
-        if filename not in self.metadata or filename == "PSL":
+        info = self.metadata.get(filename)
+        priority = info['priority'] if info is not None and filename != "PSL" else None
+        planned = self.plan_delete(filename, persist=persist)
+        if planned is None:
             return None
+        return self.execute_all(planned, op='delete', priority=priority, wait=self.metrics.take_wait())
 
-        command = "rm -rf {}".format(self.config['path'] + filename)
-        node = self.metadata[filename]['node']
-        # Recompute statistics
-        node_id = self.metadata[filename]['node_id']
-        self.available[node_id] += self.block_size
-        self.effectiveness_for_node(node_id)
-        del self.metadata[filename]
-        if persist:
-            self.persist_metadata()
-        return self.execute_command(node, command)
+    def plan_delete(self, filename, persist=True):
+        """ Drop a file from metadata and return the (node, command) pairs that remove its copies. """
+        with self.file_locks(filename):
+            info = self.metadata.get(filename)
+            if info is None or filename == "PSL":
+                return None
+
+            if self.cache is not None:
+                self.cache.invalidate(filename)
+            self.access.forget(filename)
+            planned = []
+            with self.metadata_lock:
+                for node_id, name, size in self.copies(filename, info):
+                    node = self.datanodes[node_id]
+                    planned.append((node, 'rm -rf "{}"'.format(self.remote_path(node, name))))
+                    # Recompute statistics
+                    self.reserve(node_id, size)
+                self.remove_entry(filename)
+        self.commit_metadata(persist)
+        return planned
+
+    def claim(self, filename):
+        """ Take filename for a create that adds its entry later (an upload). False if it is taken. """
+        with self.file_locks(filename):
+            if filename in self.metadata or filename in self.claims or filename == "PSL":
+                return False
+            self.claims.add(filename)
+            return True
+
+    def unclaim(self, filename):
+        with self.file_locks(filename):
+            self.claims.discard(filename)
 
     def retrieve_file(self, filename, output='./', step=None):
-        if filename not in self.metadata or filename == "PSL":
+        wait = self.metrics.take_wait()
+        if self.plan_retrieve(filename) is None:
+            return None
+        info = self.metadata.get(filename)
+        if info is None:
+            # Deleted since it was planned.
             return None
+        if os.path.isdir(output):
+            output = os.path.join(output, os.path.basename(filename))
+        start = time.time()
+        rc = self.read_file(filename, info, output)
+        self.metrics.observe('retrieve', time.time() - start, priority=info['priority'],
+                             nbytes=info['size'] if rc.returncode == 0 else 0,
+                             error=rc.returncode != 0, wait=wait)
+        return rc
+
+    def read_file(self, filename, info, output):
+        """ Copy a file to output, through the read cache if there is one. """
+        if self.cache is None:
+            return self.fetch_file(filename, info, output)
+
+        if self.cache.get(filename, output):
+            return CompletedProcess(['cache', filename, output], 0)
+        part = self.cache.admit(filename, info['size'], info['priority'])
+        if part is None:
+            return self.fetch_file(filename, info, output)
+        ok = False
+        try:
+            rc = self.fetch_file(filename, info, part)
+            if rc.returncode == 0:
+                shutil.copyfile(part, output)
+            ok = rc.returncode == 0
+        finally:
+            self.cache.commit(filename, part, ok)
+        return rc
+
+    def open_file(self, filename, offset=0, length=None, buffer_size=1048576, read_ahead=4):
+        """ Read-only file object streaming the file (or length bytes from offset) from its node. """
+        planned = self.plan_retrieve(filename)
+        if planned is None:
+            return None
+        info = self.metadata.get(filename)
+        if info is None:
+            return None
+        if 'chunks' in info:
+            raw = self.open_chunks(filename, info, offset, length, buffer_size, read_ahead)
         else:
-            node = self.metadata[filename]['node']
-            self.metadata[filename]['modified'] = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
-        return run(['scp', node + ':' + self.config['path'] + filename, output])
-
-    def list_files(self):
-        if "PSL" not in self.metadata:
-            return self.metadata
-        tmp = copy.deepcopy(self.metadata)
-        del tmp["PSL"]
-        return tmp
-
-    def submit_tasks(self, task_list, block=False, stats=None):
-        """ Asynchronously process tasks in a task list, given as (func, args, kwargs). """
-        num_workers = cpu_count()
-        threads = []
-        task_queue = queue.Queue()
-        for _ in range(num_workers):
-            t = Thread(target=psl_worker, args=[self, task_queue, stats])
-            t.start()
-            threads.append(t)
-
-        for task in task_list:
-            task_queue.put(task)
-
-        # https://docs.python.org/3/library/queue.html
-        for _ in range(num_workers):
-            task_queue.put(None)
+            node, remote_path = planned
+            raw = RemoteReader(self.transport, node, range_command(remote_path, offset, length),
+                               chunk_size=buffer_size, read_ahead=read_ahead)
+        return io.BufferedReader(raw, buffer_size)
+
+    def open_chunks(self, filename, info, offset, length, buffer_size, read_ahead):
+        """ ChainedReader over the part of each chunk that falls in the requested range. """
+        end = info['size'] if length is None else min(offset + length, info['size'])
+        segments = []
+        start = 0
+        for node_id, name, size in self.copies(filename, info):
+            lo, hi = max(offset, start), min(end, start + size)
+            if lo < hi:
+                node = self.datanodes[node_id]
+                segments.append((node, range_command(self.remote_path(node, name), lo - start,
+                                                     None if hi == start + size else hi - lo)))
+            start += size
+        def open_segment(segment):
+            return RemoteReader(self.transport, segment[0], segment[1], chunk_size=buffer_size,
+                                read_ahead=read_ahead)
+        return ChainedReader(open_segment, segments)
+
+    def stream_file(self, filename, offset=0, length=None, chunk_size=1048576):
+        """ Iterator over the file's bytes, in chunks of at most chunk_size. """
+        f = self.open_file(filename, offset=offset, length=length, buffer_size=chunk_size)
+        if f is None:
+            return None
+        return iter_chunks(f, chunk_size)
+
+    def plan_retrieve(self, filename):
+        """ Record the access and return the (node, remote path) to read the file from. """
+        with self.metadata_lock:
+            info = self.metadata.get(filename)
+            if info is None or filename == "PSL":
+                return None
+            self.metadata.update_entry(filename, mtime=int(time.time()))
+        node = self.datanodes[self.replica_order(info)[0]]
+        self.access.hit(filename)
+        return node, self.remote_path(node, filename)
+
+    def replica_order(self, info):
+        """ Replicas by observed latency; the ones never read from yet go by their configured latency.
+
+        With probability replica_explore, a replica never read from goes first, so that it gets
+        measured instead of only ever being read through a hedge.
+        """
+        replicas = self.replicas(info)
+        if len(replicas) == 1:
+            return replicas
+        def key(node_id):
+            observed = self.latency.estimate(node_id)
+            return (observed is None, observed if observed is not None else self.latencies[node_id])
+        order = sorted(replicas, key=key)
+        unmeasured = [node_id for node_id in order if self.latency.estimate(node_id) is None]
+        # All unmeasured: the first by configured latency gets measured anyway.
+        if 0 < len(unmeasured) < len(order) and random() < self.config.get('replica_explore', 0.05):
+            first = unmeasured[randrange(len(unmeasured))]
+            order = [first] + [node_id for node_id in order if node_id != first]
+        return order
+
+    def fetch_file(self, filename, info, output):
+        """ Copy a file to output from its fastest replica, hedging to a second one if it is slow. """
+        if 'chunks' in info:
+            return self.fetch_chunks(filename, info, output)
+        replicas = self.replica_order(info)
+        deadline = None
+        if len(replicas) > 1:
+            # From reads of about this size: a large file is not late just for being large.
+            deadline = self.latency.deadline(replicas[0], info['size'], self.config.get('hedge_percentile', 95))
+        if deadline is None:
+            node = self.datanodes[replicas[0]]
+            start = time.time()
+            rc = self.transport.fetch(node, self.remote_path(node, filename), output)
+            self.fetched(replicas[0], start, info, info['size'], rc.returncode == 0)
+            return rc
+
+        tmp = tempfile.mkdtemp(prefix='psl-hedge-')
+        fetches = []
+        try:
+            fetches.append(self.start_fetch(filename, replicas[0], tmp))
+            try:
+                fetches[0][1].wait(timeout=deadline)
+            except TimeoutExpired:
+                # Missed the deadline: race a second replica against it.
+                fetches.append(self.start_fetch(filename, replicas[1], tmp))
+            while True:
+                done = [f for f in fetches if f[1].poll() is not None]
+                for node_id, proc, target, start in done:
+                    if proc.returncode == 0:
+                        self.fetched(node_id, start, info, info['size'], True)
+                        try:
+                            os.replace(target, output)
+                        except OSError:
+                            shutil.copyfile(target, output)
+                        return CompletedProcess(proc.args, 0)
+                if len(done) == len(fetches):
+                    if len(fetches) == 1:
+                        fetches.append(self.start_fetch(filename, replicas[1], tmp))
+                        continue
+                    for node_id, _, _, start in done:
+                        self.fetched(node_id, start, info, info['size'], False)
+                    return CompletedProcess(done[-1][1].args, done[-1][1].returncode)
+                time.sleep(0.005)
+        finally:
+            for node_id, proc, _, _ in fetches:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                self.transport.release(self.datanodes[node_id])
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def fetch_chunks(self, filename, info, output):
+        """ Fetch every chunk of a striped file in parallel, then concatenate them into output. """
+        tmp = tempfile.mkdtemp(prefix='psl-chunks-')
+        def fetch(piece):
+            i, (node_id, name, size) = piece
+            node = self.datanodes[node_id]
+            start = time.time()
+            rc = self.transport.fetch(node, self.remote_path(node, name), os.path.join(tmp, str(i)))
+            self.fetched(node_id, start, info, size, rc.returncode == 0)
+            return rc
+        try:
+            results = list(self.fanout_pool().map(fetch, enumerate(self.copies(filename, info))))
+            failed = next((rc for rc in results if rc.returncode != 0), None)
+            if failed is not None:
+                return failed
+            with open(output, 'wb') as out:
+                for i in range(len(results)):
+                    with open(os.path.join(tmp, str(i)), 'rb') as f:
+                        shutil.copyfileobj(f, out)
+            return CompletedProcess(['fetch', filename, output], 0)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def fetched(self, node_id, start, info, nbytes, ok):
+        """ Record a transfer from node_id that started at start. """
+        elapsed = time.time() - start
+        if ok:
+            self.latency.record(node_id, elapsed, nbytes)
+        self.metrics.observe('fetch', elapsed, node=self.datanodes[node_id], priority=info['priority'],
+                             nbytes=nbytes if ok else 0, error=not ok)
+
+    def start_fetch(self, filename, node_id, directory):
+        node = self.datanodes[node_id]
+        target = os.path.join(directory, str(node_id))
+        proc = self.transport.spawn(node, self.transport.fetch_argv(node, self.remote_path(node, filename), target))
+        return node_id, proc, target, time.time()
+
+    def list_files(self, prefix=None, priority=None, offset=0, limit=None):
+        """ Lazy view of the files, optionally filtered by path prefix and priority and paginated. """
+        return FileListing(self.metadata, self.index, prefix=prefix, priority=priority,
+                           offset=offset, limit=limit)
+
+    def task_pool(self):
+        """ The long-lived worker pool, started on first use. """
+        if self.pool is None:
+            self.pool = TaskPool(lambda task, stats, wait: psl_worker(self, task, stats, wait),
+                                 num_workers=self.config.get('io_workers', 64),
+                                 max_pending=self.config.get('max_pending', 10000),
+                                 node_limit=self.config.get('node_workers', self.transport.max_channels))
+        return self.pool
+
+    def task_node(self, task):
+        """ Datanode a task will talk to, when it is known before the task runs. """
+        func, args, _ = task
+        if func == self.run_batch:
+            return args[0]
+        if func in (self.retrieve_file, self.delete_file, self.migrate_file) and args and args[0] in self.metadata:
+            info = self.metadata[args[0]]
+            # A striped file is spread over several nodes.
+            return None if 'chunks' in info else info['node']
+        return None
+
+    def submit_tasks(self, task_list, block=False, stats=None, batch=True):
+        """ Asynchronously process tasks in a task list, given as (func, args, kwargs).
+
+        Returns a TaskBatch. Its results list is aligned with task_list and holds each task's
+        return value once it finishes. With batch=True, create_file and delete_file tasks are
+        planned up front and their remote commands are grouped per datanode into scripts of at
+        most batch_size operations; their result is the remote return code of the operation (None
+        if the operation was refused, e.g. the file already exists).
+        """
+        handle = TaskBatch(len(task_list))
+        pool = self.task_pool()
+        if batch:
+            # The scripts of one node run one at a time, in the order they were planned: a delete
+            # planned after a create of the same file must not run before it and leave an orphan.
+            with self.batch_order:
+                for index, task in self.batch_tasks(task_list, handle.results):
+                    handle.add(self.submit_task(pool, task, stats), index)
+        else:
+            for index, task in enumerate(task_list):
+                handle.add(self.submit_task(pool, task, stats), index)
 
         if block:
-            for t in threads:
-                t.join()
+            handle.wait()
+        return handle
+
+    def submit_task(self, pool, task, stats=None):
+        node = self.task_node(task)
+        return pool.submit(task, node=node, stats=stats, serial=node if task[0] == self.run_batch else None)
+
+    def batch_tasks(self, task_list, results):
+        """ Replace create/delete tasks by one run_batch task per datanode and flush window.
 
-    def print_file_info(self):
-        print("Filename, Priority, Node latency, Node")
-        print ("________________________________________")
+        Returns (index in task_list, task) pairs; index is None for the batch tasks. Called with
+        batch_order held.
+        """
+        planners = {self.create_file: self.plan_create, self.delete_file: self.plan_delete}
+        batch_size = self.config.get('batch_size', 1000)
+        pending = {}
+        remaining = []
+        # Index of each planned create -> [filename, persist, copies not run yet], to roll it back
+        # once the batches of all its copies are done, if one of them failed.
+        creates = {}
+        try:
+            for index, (func, args, kwargs) in enumerate(task_list):
+                if func not in planners:
+                    remaining.append((index, (func, args, kwargs)))
+                    continue
+                planned = planners[func](*args, **kwargs)
+                if planned is None:
+                    continue
+                if func == self.create_file:
+                    creates[index] = [args[0] if args else kwargs['filename'], kwargs.get('persist', True),
+                                      len(planned)]
+                for node, command in planned:
+                    pending.setdefault(node, []).append((index, command))
+        except Exception:
+            # Planning stopped part-way (e.g. out of space): nothing has been submitted yet, so undo
+            # the creates planned so far and carry out the deletes, whose entries are already gone,
+            # behind the scripts already queued for their nodes.
+            for filename, persist, _ in creates.values():
+                self.rollback_create(filename, persist=persist)
+            pool = self.task_pool()
+            futures = []
+            for node, ops in pending.items():
+                deletes = [(index, command) for index, command in ops if index not in creates]
+                if deletes:
+                    task = (self.run_batch, [node, deletes, [None] * len(task_list)], {})
+                    futures.append(self.submit_task(pool, task))
+            wait(futures)
+            raise
+        for node, ops in pending.items():
+            for i in range(0, len(ops), batch_size):
+                remaining.append((None, (self.run_batch, [node, ops[i:i + batch_size], results, creates], {})))
+        return remaining
+
+    def run_batch(self, node, ops, results, creates=None):
+        """ Run a list of (index, command) on a node as one remote script, recording return codes.
+
+        Creates (index -> [filename, persist, copies not run yet], as from batch_tasks) that failed
+        are rolled back by the last batch holding one of their copies.
+        """
+        wait = self.metrics.take_wait()
+        script = ''.join('( {} ) >/dev/null 2>&1; echo $?\n'.format(command) for _, command in ops)
+        start = time.time()
+        codes = []
+        try:
+            rc = self.transport.execute(node, 'sh -s', input=script.encode(), capture=True)
+            codes = rc.stdout.split()
+        finally:
+            self.metrics.observe('batch', time.time() - start, node=node, wait=wait,
+                                 error=len(codes) < len(ops) or any(code != b'0' for code in codes))
+            failed = []
+            with self.batch_lock:
+                for i, (index, _) in enumerate(ops):
+                    # Operations the script never reached (e.g. the connection dropped) count as failed.
+                    code = int(codes[i]) if i < len(codes) else 255
+                    # A replicated file has one operation per copy: keep the worst.
+                    results[index] = max(code, results[index] or 0)
+                    if creates and index in creates:
+                        create = creates[index]
+                        create[2] -= 1
+                        # Not before every copy has run: a later one would write the file back.
+                        if create[2] == 0 and results[index] != 0:
+                            failed.append(create)
+            for filename, persist, _ in failed:
+                self.rollback_create(filename, persist=persist)
+        return rc
+
+    def print_file_info(self, file=None):
+        print("Filename, Priority, Node latency, Node", file=file)
+        print ("________________________________________", file=file)
         for filename, info in self.metadata.items():
             if filename == "PSL":
                 continue
             node_id = info["node_id"]
-            print(filename, info["priority"], self.latencies[node_id], info["node"])
-        print()
+            print(filename, info["priority"], self.latencies[node_id], info["node"], file=file)
+        print(file=file)
 
-    def print_node_info(self):
-        print ("Node id,  available, latency, files")
-        print ("____________________________")
+    def print_node_info(self, file=None):
+        print ("Node id,  available, latency, files", file=file)
+        print ("____________________________", file=file)
         for i in range(self.num):
-            files = []
-            for filename, info in self.metadata.items():
-                if filename == "PSL":
-                    continue
-                node_id = info["node_id"]
-                if node_id == i:
-                    files.append(filename)
+            files = list(self.index.files_on_node(i))
             print(i, "        %0.3f" % (self.available[i]/1073741824.0), "GB   ", 
-                  self.latencies[i], "  ", files)
-        print()
+                  self.latencies[i], "  ", files, file=file)
+        print(file=file)
 
-    def print_stats(self):
-        print()
-        self.print_node_info()
-        self.print_file_info()
+    def print_stats(self, file=None):
+        """ Print the node and file tables, to file if given (default stdout). """
+        print(file=file)
+        self.print_node_info(file=file)
+        self.print_file_info(file=file)
 
 # End of file
@@ -0,0 +1,188 @@
+""" async_api.py
+
+asyncio API for PriorityStoreLite.
+
+AsyncPriorityStoreLite wraps a PriorityStoreLite: placement and metadata are handled by the same
+code as the blocking API, while the remote side runs as asyncio subprocesses over the configured
+transport. A single event loop can keep thousands of transfers in flight; at most max_channels of
+them run against any one datanode at a time, counting the blocking API's operations on the same
+transport.
+
+    psl = AsyncPriorityStoreLite('config')
+    await psl.create_file('a.psl', priority=0)
+    results = await psl.gather([(psl.retrieve_file, ['a.psl'], {'output': '/tmp/a'})])
+
+Author: Brian Tuan
+"""
+
+import asyncio
+import os
+import shutil
+import time
+from subprocess import CompletedProcess
+
+from api import PriorityStoreLite
+
+
+class AsyncPriorityStoreLite:
+    def __init__(self, config_dir, verbose=False):
+        self.psl = PriorityStoreLite(config_dir, verbose=verbose)
+        self.transport = self.psl.transport
+        self.channels = {}
+
+    def channel(self, node):
+        """ Queue of this loop's operations on the node, so at most max_channels of them wait in
+        acquire() (and hold an executor thread) at a time.
+        """
+        if node not in self.channels:
+            self.channels[node] = asyncio.Semaphore(self.transport.max_channels)
+        return self.channels[node]
+
+    async def acquire(self, node):
+        """ Take one of the transport's channels to the node, shared with the blocking API. """
+        transport = self.transport
+        if node in transport.last_used and transport.acquire(node, blocking=False):
+            return
+        # Waiting for a channel, or opening a session, blocks: keep it off the loop.
+        future = asyncio.get_running_loop().run_in_executor(None, transport.acquire, node)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The executor still takes the channel: give it back once it does.
+            future.add_done_callback(
+                lambda f: f.cancelled() or f.exception() is not None or transport.release(node))
+            raise
+
+    async def run(self, node, argv, input=None):
+        async with self.channel(node):
+            await self.acquire(node)
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *argv, stdin=asyncio.subprocess.PIPE if input is not None else None)
+                await proc.communicate(input)
+            finally:
+                self.transport.release(node)
+            return CompletedProcess(argv, proc.returncode)
+
+    async def execute_command(self, node, command, input=None):
+        return await self.run(node, self.transport.argv(node, command), input=input)
+
+    async def execute_all(self, planned, op=None, priority=None):
+        """ Run (node, command) pairs concurrently, e.g. one per replica. With op set, each command
+        is recorded in the metrics under op and its node, as PriorityStoreLite.execute_all does.
+        """
+        async def run(node, command):
+            start = time.time()
+            rc = await self.execute_command(node, command)
+            if op is not None:
+                self.psl.metrics.observe(op, time.time() - start, node=node, priority=priority,
+                                         error=rc.returncode != 0)
+            return rc
+        results = await asyncio.gather(*[run(*pair) for pair in planned])
+        return next((rc for rc in results if rc.returncode != 0), results[0])
+
+    async def create_file(self, filename, size=67108864, node_id=None, priority=2, persist=True):
+        planned = self.psl.plan_create(filename, size=size, node_id=node_id, priority=priority, persist=persist)
+        if planned is None:
+            return None
+        try:
+            rc = await self.execute_all(planned, op='create', priority=priority)
+        except BaseException:
+            await self.rollback_create(filename, persist)
+            raise
+        if rc.returncode != 0:
+            await self.rollback_create(filename, persist)
+        return rc
+
+    async def rollback_create(self, filename, persist=True):
+        """ Like PriorityStoreLite.rollback_create: give the space back and remove what got written. """
+        planned = self.psl.plan_delete(filename, persist=persist)
+        if planned is not None:
+            await self.execute_all(planned)
+
+    async def put_file(self, filename, source, priority=2, node_id=None, persist=True):
+        """ Upload real content (see upload.py); runs on the default executor. """
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.psl.put_file(filename, source, priority=priority, node_id=node_id, persist=persist))
+
+    async def delete_file(self, filename, persist=True):
+        info = self.psl.metadata.get(filename)
+        priority = info['priority'] if info is not None and filename != "PSL" else None
+        planned = self.psl.plan_delete(filename, persist=persist)
+        if planned is None:
+            return None
+        return await self.execute_all(planned, op='delete', priority=priority)
+
+    async def retrieve_file(self, filename, output='./'):
+        """ Like PriorityStoreLite.retrieve_file: through the read cache, and the transfer recorded
+        for replica ordering and metrics. Only the fetch itself runs on the event loop.
+        """
+        if 'chunks' in self.psl.metadata.get(filename, {}):
+            # Striped files are fetched chunk by chunk and reassembled by the blocking API.
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.psl.retrieve_file, filename, output)
+        planned = self.psl.plan_retrieve(filename)
+        if planned is None:
+            return None
+        info = self.psl.metadata.get(filename)
+        if info is None:
+            return None
+        if os.path.isdir(output):
+            output = os.path.join(output, os.path.basename(filename))
+        start = time.time()
+        rc = await self.read_file(filename, info, planned, output)
+        self.psl.metrics.observe('retrieve', time.time() - start, priority=info['priority'],
+                                 nbytes=info['size'] if rc.returncode == 0 else 0, error=rc.returncode != 0)
+        return rc
+
+    async def read_file(self, filename, info, planned, output):
+        """ Like PriorityStoreLite.read_file, fetching from the planned (node, remote path). """
+        loop = asyncio.get_running_loop()
+        cache = self.psl.cache
+        if cache is None:
+            return await self.fetch_file(planned, info, output)
+
+        if await loop.run_in_executor(None, cache.get, filename, output):
+            return CompletedProcess(['cache', filename, output], 0)
+        part = cache.admit(filename, info['size'], info['priority'])
+        if part is None:
+            return await self.fetch_file(planned, info, output)
+        ok = False
+        try:
+            rc = await self.fetch_file(planned, info, part)
+            if rc.returncode == 0:
+                await loop.run_in_executor(None, shutil.copyfile, part, output)
+            ok = rc.returncode == 0
+        finally:
+            cache.commit(filename, part, ok)
+        return rc
+
+    async def fetch_file(self, planned, info, output):
+        node, remote_path = planned
+        start = time.time()
+        ok = False
+        try:
+            rc = await self.run(node, self.transport.fetch_argv(node, remote_path, output))
+            ok = rc.returncode == 0
+        finally:
+            self.psl.fetched(self.psl.datanodes.index(node), start, info, info['size'], ok)
+        return rc
+
+    async def move_file(self, filename, node_id):
+        """ Migrate a file to another node (see migrate.py); runs on the default executor. """
+        if filename not in self.psl.metadata or node_id is None or not 0 <= node_id < self.psl.num:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(None, self.psl.migrate_file, filename, node_id)
+
+    async def gather(self, task_list):
+        """ Run (coroutine function, args, kwargs) tasks concurrently. Failed tasks return their exception. """
+        return await asyncio.gather(*[func(*args, **kwargs) for func, args, kwargs in task_list],
+                                    return_exceptions=True)
+
+    def list_files(self, **kwargs):
+        return self.psl.list_files(**kwargs)
+
+    def close(self):
+        self.psl.close()
+
+# End of file
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+""" benchmark.py
+
+Benchmarks of the PriorityStoreLite placement and metadata hot paths.
+
+For every combination of namespace size and cluster size, builds synthetic metadata in a scratch
+store (nothing goes over the network) and times placement_node_id, the placement_reassign planner,
+persist_metadata, draw_access_sample and list_files. Each result records the operations performed,
+the best wall time over the repeats, the resulting throughput and the peak memory allocated by one
+more run under tracemalloc. Results go to a JSON file, tagged with the git commit, so runs on different
+commits can be compared. The nodes are sized so that the reassign greedy can finish on every cluster.
+
+    $ ./benchmark.py --files 10000,100000,1000000 --nodes 16,64,256,1024 -o benchmark.json
+
+Author: Brian Tuan
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import time
+import tracemalloc
+
+import click
+import numpy as np
+
+from api import FILE_FREQUENCY
+from index import MetadataIndex
+from planner import plan_reassign
+from simulation import draw_access_sample, scratch_store
+
+PLACEMENTS = 10000
+SAMPLE_SIZE = 1000
+DIRECTORIES = 100
+
+
+def draw_priorities(rng, n):
+    shares = [FILE_FREQUENCY[0], FILE_FREQUENCY[1], 1.0 - FILE_FREQUENCY[0] - FILE_FREQUENCY[1]]
+    return rng.choice(3, size=n, p=shares).tolist()
+
+
+def synthetic_metadata(psl, num_files, seed=0):
+    """ Fill psl with num_files one-block files spread at random, with the FILE_FREQUENCY tiers.
+
+    Returns the per-node capacity used, sized so every node stays at most half full.
+    """
+    rng = np.random.default_rng(seed)
+    priorities = draw_priorities(rng, num_files)
+    nodes = rng.integers(psl.num, size=num_files).tolist()
+    mtime = int(time.time())
+    for i in range(num_files):
+        psl.metadata['dir{}/{}.psl'.format(i % DIRECTORIES, i)] = {
+            'node_id': nodes[i],
+            'mtime': mtime,
+            'priority': priorities[i],
+            'size': psl.block_size
+        }
+    capacity = max(psl.capacities[0], 2 * num_files * psl.block_size // psl.num)
+    counts = np.bincount(nodes, minlength=psl.num)
+    psl.capacities = [capacity] * psl.num
+    psl.available = [capacity - int(c) * psl.block_size for c in counts]
+    psl.priority_counter = [float(c) for c in np.bincount(priorities, minlength=3)]
+    psl.index = MetadataIndex(psl.metadata, lock=psl.metadata_lock)
+    psl.recompute_effectiveness()
+    return capacity
+
+
+def planning_capacity(psl, capacity):
+    """ Smallest per-node capacity, doubling from capacity, at which the reassign greedy finishes.
+
+    The greedy keeps placing on a node until its effectiveness falls below the empty nodes', which
+    can take more than the files' fair share of a node. The capacities and available space of psl
+    are resized to it; it always exists, since a node that can hold every file never runs out.
+    """
+    used = [c - a for c, a in zip(psl.capacities, psl.available)]
+    while True:
+        psl.capacities = [capacity] * psl.num
+        psl.available = [capacity - u for u in used]
+        psl.recompute_effectiveness()
+        try:
+            plan_reassign(psl, available=capacity)
+            return capacity
+        except AssertionError:
+            capacity *= 2
+
+
+def measure(run, ops, repeat=3, memory=True):
+    """ Time run() (which performs ops operations) repeat times; keep the best.
+
+    A run that trips one of the greedy's out-of-space assertions is reported with an error instead.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            run()
+        except AssertionError:
+            return {'ops': ops, 'seconds': None, 'ops_per_second': None, 'error': 'out of space'}
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    result = {'ops': ops, 'seconds': best, 'ops_per_second': ops / best if best > 0 else None}
+    if memory:
+        tracemalloc.start()
+        run()
+        result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result
+
+
+def bench_store(num_files, num_nodes, repeat=3, memory=True, seed=0):
+    """ Results of every benchmark for one namespace and cluster size, as {name: result}. """
+    results = {}
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    # Journal like a live store would, but never compact in the middle of a measurement.
+    psl, scratch = scratch_store(num_nodes, journal_compact_every=2**62)
+    try:
+        capacity = synthetic_metadata(psl, num_files, seed=seed)
+        results['setup'] = {'ops': num_files, 'seconds': time.perf_counter() - start}
+        if memory:
+            results['setup']['metadata_bytes'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+        capacity = planning_capacity(psl, capacity)
+        results['setup']['capacity'] = capacity
+
+        # placement_reassign without moving anything: the planner is the whole cost.
+        results['placement_reassign'] = measure(lambda: plan_reassign(psl, available=capacity), 1,
+                                                repeat, memory)
+        results['persist_metadata'] = measure(psl.persist_metadata, 1, repeat, memory)
+        results['draw_access_sample'] = measure(lambda: draw_access_sample(psl, SAMPLE_SIZE), SAMPLE_SIZE,
+                                                repeat, memory)
+
+        listing = psl.list_files(prefix='dir7/')
+        results['list_files_prefix'] = measure(lambda: dict(listing), len(listing), repeat, memory)
+        results['list_files_priority_page'] = measure(lambda: dict(psl.list_files(priority=0, limit=100)),
+                                                      100, repeat, memory)
+        results['list_files_all'] = measure(lambda: len(psl.list_files()), num_files, repeat, memory)
+
+        # Last, since it fills the nodes: the greedy may put every placement on the same node, so
+        # give each one room for all of them.
+        headroom = (repeat + 1) * PLACEMENTS * psl.block_size
+        psl.capacities = [c + headroom for c in psl.capacities]
+        psl.available = [a + headroom for a in psl.available]
+        psl.recompute_effectiveness()
+        rng = np.random.default_rng(seed)
+        priorities = draw_priorities(rng, PLACEMENTS)
+        def placements():
+            for priority in priorities:
+                psl.placement_node_id(priority, persist=False)
+        results['placement_node_id'] = measure(placements, PLACEMENTS, repeat, memory)
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option("--files", default="10000,100000,1000000", help="Comma-separated namespace sizes.")
+@click.option("--nodes", default="16,64,256,1024", help="Comma-separated cluster sizes.")
+@click.option("-r", "--repeat", default=3, help="Timed runs per benchmark; the best is kept.")
+@click.option("--memory/--no-memory", default=True, help="Also measure peak memory with tracemalloc.")
+@click.option("-o", "--output", default="benchmark.json", help="Path of the JSON results.")
+def run(files, nodes, repeat, memory, output):
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'results': []
+    }
+    for num_files in [int(n) for n in files.split(',')]:
+        for num_nodes in [int(n) for n in nodes.split(',')]:
+            for name, result in bench_store(num_files, num_nodes, repeat, memory).items():
+                result.update({'benchmark': name, 'files': num_files, 'nodes': num_nodes})
+                report['results'].append(result)
+                print("{:>8} files {:>5} nodes  {:<26} {:>10} s  {:>14} ops/s  {}".format(
+                    num_files, num_nodes, name,
+                    "%.4f" % result['seconds'] if result['seconds'] is not None else '-',
+                    "%.1f" % result['ops_per_second'] if result.get('ops_per_second') else '-',
+                    result.get('error', '')))
+    # ru_maxrss is in kilobytes on Linux.
+    report['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
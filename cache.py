@@ -0,0 +1,138 @@
+""" cache.py
+
+Size-bounded local read cache for PriorityStoreLite.retrieve_file.
+
+Files are kept on the master's local disk. Eviction is GreedyDual: every entry carries a credit of
+L + weight[priority], refreshed on each hit, and the entry with the lowest credit is evicted, L
+becoming that credit. High priority files therefore outlive low priority ones that were read at
+the same time, while files nobody reads any more still age out. Priority 0 can be pinned instead.
+
+Each cache keeps its files in a subdirectory of its own under the configured directory, so caches of
+several processes sharing a config directory never touch each other's files. A file is fetched into
+a private .part file that only the reader owns, and renamed into the cache when it is committed.
+
+Author: Brian Tuan
+"""
+
+import hashlib
+import heapq
+import os
+import shutil
+import tempfile
+from threading import Lock
+
+PRIORITY_WEIGHT = {0: 4.0, 1: 2.0, 2: 1.0}
+
+
+class ReadCache:
+    def __init__(self, directory, capacity, pin_priority0=False):
+        self.capacity = capacity
+        self.pin_priority0 = pin_priority0
+        self.lock = Lock()
+        self.entries = {}
+        self.heap = []
+        self.inflation = 0.0
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix='psl-cache-', dir=directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, hashlib.sha1(filename.encode()).hexdigest())
+
+    def credit(self, filename, priority):
+        credit = self.inflation + PRIORITY_WEIGHT.get(priority, 1.0)
+        self.entries[filename]['credit'] = credit
+        heapq.heappush(self.heap, (credit, filename))
+
+    def get(self, filename, output):
+        """ Copy a cached file to output. Returns False on a miss. """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or not entry['ready']:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.credit(filename, entry['priority'])
+            # An open file survives eviction, so the copy can run outside the lock.
+            src = open(self.path(filename), 'rb')
+        with src, open(output, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        return True
+
+    def admit(self, filename, size, priority):
+        """ Reserve room for a file about to be fetched. Returns the path to fetch into, or None.
+
+        The path belongs to the caller until it hands it back to commit: nothing else removes it.
+        """
+        with self.lock:
+            if size > self.capacity or filename in self.entries:
+                return None
+            while self.used + size > self.capacity:
+                if not self.evict():
+                    return None
+            fd, part = tempfile.mkstemp(suffix='.part', dir=self.directory)
+            os.close(fd)
+            self.entries[filename] = {'size': size, 'priority': priority, 'ready': False, 'part': part}
+            self.used += size
+            self.credit(filename, priority)
+            return part
+
+    def commit(self, filename, part, ok):
+        """ Publish (or drop, if the fetch failed) a file fetched into the part given by admit. """
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry.get('part') != part:
+                # Invalidated while it was being fetched (and maybe admitted again since).
+                os.remove(part)
+                return
+            if ok:
+                os.replace(part, self.path(filename))
+                del entry['part']
+                entry['ready'] = True
+                self.credit(filename, entry['priority'])
+            else:
+                os.remove(part)
+                self.drop(filename)
+
+    def evict(self):
+        while self.heap:
+            credit, filename = heapq.heappop(self.heap)
+            entry = self.entries.get(filename)
+            # Stale heap items: the entry was refreshed, removed, or is still being fetched.
+            if entry is None or entry['credit'] != credit or not entry['ready']:
+                continue
+            if self.pin_priority0 and entry['priority'] == 0:
+                continue
+            self.inflation = credit
+            self.drop(filename)
+            self.evictions += 1
+            return True
+        return False
+
+    def drop(self, filename):
+        entry = self.entries.pop(filename)
+        self.used -= entry['size']
+        # A part being fetched is left to its reader, whose commit removes it.
+        if entry['ready']:
+            os.remove(self.path(filename))
+
+    def invalidate(self, filename):
+        with self.lock:
+            if filename in self.entries:
+                self.drop(filename)
+
+    def close(self):
+        """ Remove this cache's files. """
+        with self.lock:
+            self.entries.clear()
+            self.used = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'used': self.used, 'capacity': self.capacity, 'files': len(self.entries)}
+
+# End of file
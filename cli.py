@@ -5,11 +5,16 @@
 Command-line interface for PriorityStoreLite. Requires click
     $ pip3 install click
 
+When a master daemon (daemon.py) is running for the config directory, commands are sent to it;
+otherwise, or with --local, they run against a PriorityStoreLite in this process. Only one
+PriorityStoreLite can hold a config directory, so --local is refused while the daemon runs.
+
 Author: Brian Tuan
 """
 
 import click
-from api import PriorityStoreLite
+import sys
+from client import connect
 from pprint import PrettyPrinter
 
 
@@ -17,57 +22,89 @@ from pprint import PrettyPrinter
 @click.option("-d", "--config_dir", help="Path to directory containing configuration files.")
 @click.option("-c", "--command", help="PriorityStore API command.", required=True)
 @click.option("-v", "--verbose", default=True, is_flag=True, help="Toggle for verbosity.")
-def run(command, config_dir, verbose):
+@click.option("--local", is_flag=True, help="Run in this process; refused while a daemon is running.")
+def run(command, config_dir, verbose, local):
     if not config_dir:
         config_dir = "config"
-    psl = PriorityStoreLite(config_dir)
+    psl = None if local else connect(config_dir)
+    in_process = psl is None
+    if in_process:
+        # Only imported without a daemon, so that the client path stays light.
+        from api import PriorityStoreLite
+        try:
+            psl = PriorityStoreLite(config_dir)
+        except RuntimeError as e:
+            # The daemon holds the config directory: two writers would lose journal records.
+            raise click.ClickException(str(e))
     p = PrettyPrinter(indent=4)
 
-    cmd = command.strip().split(' ')
-    if cmd[0] == 'ls':
-        print("Listing files...")
-        p.pprint(psl.list_files())
-
-    if cmd[0] == 'info':
-        print("Details on the system...")
-        psl.print_stats()
+    try:
+        cmd = command.strip().split(' ')
+        if cmd[0] == 'ls':
+            print("Listing files...")
+            files = psl.list_files(prefix=cmd[1] if len(cmd) > 1 else None)
+            p.pprint({filename: dict(info) for filename, info in files.items()})
 
-    #sys.stdout = Logger()
+        elif cmd[0] == 'info':
+            print("Details on the system...")
+            psl.print_stats()
 
-    elif cmd[0] == 'del':
-        if len(cmd) != 2:
-            print('ERROR: del command requires two arguments.')
-        rc = psl.delete_file(cmd[1])
-        if rc is None:
-            print('ERROR: {} does not exist in the filesystem.'.format(cmd[1]))
+        #sys.stdout = Logger()
 
-    elif cmd[0] == 'get':
-        if len(cmd) == 2:
-            rc = psl.retrieve_file(cmd[1])
-            if rc is None:
-                print('ERROR: {} does not exist in the filesystem.'.format(cmd[1]))
-        elif len(cmd) == 3:
-            rc = psl.retrieve_file(cmd[1], output=cmd[2])
+        elif cmd[0] == 'del':
+            if len(cmd) != 2:
+                print('ERROR: del command requires two arguments.')
+            rc = psl.delete_file(cmd[1])
             if rc is None:
                 print('ERROR: {} does not exist in the filesystem.'.format(cmd[1]))
 
-    elif cmd[0] == 'put':
-        if len(cmd) == 2:
-            rc = psl.create_file(cmd[1])
-            if rc is None:
-                print('ERROR: {} already exists in the filesystem.'.format(cmd[1]))
-        elif len(cmd) == 3:
-            rc = psl.create_file(cmd[1], node=cmd[2])
-            if rc is None:
-                print('ERROR: {} already exists in the filesystem, storage is full, '.format(cmd[1]) + ' OR ' +
-                      '{} is not a valid user@FQDN specification.'.format(cmd[2]))
-        else:
-            print('ERROR: syntax --- ./cli.py put <filename> <node>')
+        elif cmd[0] == 'get':
+            if len(cmd) == 2:
+                rc = psl.retrieve_file(cmd[1])
+                if rc is None:
+                    print('ERROR: {} does not exist in the filesystem.'.format(cmd[1]))
+            elif len(cmd) == 3:
+                rc = psl.retrieve_file(cmd[1], output=cmd[2])
+                if rc is None:
+                    print('ERROR: {} does not exist in the filesystem.'.format(cmd[1]))
+
+        elif cmd[0] == 'put':
+            if len(cmd) == 2:
+                rc = psl.create_file(cmd[1])
+                if rc is None:
+                    print('ERROR: {} already exists in the filesystem.'.format(cmd[1]))
+            elif len(cmd) in (3, 4):
+                # put <filename> <local path, or - for stdin> [<node id>]
+                source = sys.stdin.buffer if cmd[2] == '-' else cmd[2]
+                node_id = int(cmd[3]) if len(cmd) == 4 else None
+                rc = psl.put_file(cmd[1], source, node_id=node_id)
+                if rc is None and node_id is not None:
+                    print('ERROR: {} already exists in the filesystem, storage is full, '.format(cmd[1]) + ' OR ' +
+                          '{} is not a valid node id.'.format(node_id))
+                elif rc is None:
+                    print('ERROR: {} already exists in the filesystem or storage is full.'.format(cmd[1]))
+                elif rc.returncode != 0:
+                    print('ERROR: uploading {} failed.'.format(cmd[1]))
+            else:
+                print('ERROR: syntax --- ./cli.py put <filename> [<local path> [<node id>]]')
+
+        elif cmd[0] == 'scan':
+            # scan [repair] [adopt] [delete-orphans]
+            options = set(cmd[1:])
+            if not options <= {'repair', 'adopt', 'delete-orphans'}:
+                print('ERROR: syntax --- ./cli.py scan [repair] [adopt] [delete-orphans]')
+            else:
+                print("Scanning the datanodes...")
+                inventory = psl.reconcile(repair='repair' in options, adopt='adopt' in options,
+                                          delete_orphans='delete-orphans' in options)
+                inventory.print_report()
 
-    else:
-        print("Command not recognized: " + command)
-
-    return psl
+        else:
+            print("Command not recognized: " + command)
+    finally:
+        if in_process:
+            # Shuts the datanode sessions down rather than leaving them to time out.
+            psl.close()
 
 
 if __name__ == '__main__':
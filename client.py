@@ -0,0 +1,116 @@
+""" client.py
+
+Client of the PriorityStoreLite master daemon (see daemon.py for the protocol).
+
+Kept apart from the daemon so that talking to it does not import the API and its dependencies:
+connect returns a DaemonClient when a daemon is listening for the config directory, and None
+otherwise, for the caller to fall back to an in-process PriorityStoreLite.
+
+Author: Brian Tuan
+"""
+
+import json
+import os
+import socket
+import struct
+from subprocess import CompletedProcess
+
+from inventory import Inventory
+
+FRAME_SIZE = 1048576
+
+
+def socket_path(config_dir):
+    config_dir = config_dir + '/' if config_dir[-1] != '/' else config_dir
+    with open(config_dir + 'config.json', 'r') as f:
+        config = json.load(f) or {}
+    return config.get('daemon_socket', config_dir + 'psl.sock')
+
+
+def connect_socket(path):
+    """ A socket connected to the daemon at path, None if no daemon listens there. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+class DaemonClient:
+    def __init__(self, path):
+        self.path = path
+
+    def call(self, request, body=None):
+        sock = connect_socket(self.path)
+        if sock is None:
+            raise ConnectionError("No PriorityStoreLite daemon listens on {}".format(self.path))
+        with sock, sock.makefile('rb') as rfile:
+            sock.sendall(json.dumps(request).encode() + b'\n')
+            if body is not None:
+                try:
+                    for data in body:
+                        sock.sendall(struct.pack('>Q', len(data)) + data)
+                    sock.sendall(struct.pack('>Q', 0))
+                except OSError:
+                    # The daemon answered without reading everything, e.g. because the file exists.
+                    pass
+            line = rfile.readline()
+        if not line:
+            raise ConnectionError("The daemon closed the connection without answering")
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError("Daemon error: " + response['error'])
+        return response['result']
+
+    def completed(self, args, result):
+        return None if result is None else CompletedProcess(args, result['returncode'])
+
+    def create_file(self, filename, size=67108864, node_id=None, priority=2, persist=True):
+        return self.completed(['create', filename], self.call(
+            {'op': 'create', 'filename': filename, 'size': size, 'node_id': node_id, 'priority': priority,
+             'persist': persist}))
+
+    def retrieve_file(self, filename, output='./'):
+        return self.completed(['retrieve', filename], self.call(
+            {'op': 'retrieve', 'filename': filename, 'output': os.path.abspath(output)}))
+
+    def delete_file(self, filename, persist=True):
+        return self.completed(['delete', filename], self.call(
+            {'op': 'delete', 'filename': filename, 'persist': persist}))
+
+    def put_file(self, filename, source, priority=2, node_id=None, persist=True):
+        request = {'op': 'put', 'filename': filename, 'priority': priority, 'node_id': node_id, 'persist': persist}
+        body = None
+        if isinstance(source, (str, os.PathLike)):
+            request['source'] = os.path.abspath(source)
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            body = [bytes(source)]
+        elif hasattr(source, 'read'):
+            body = iter(lambda: source.read(FRAME_SIZE), b'')
+        else:
+            body = source
+        return self.completed(['put', filename], self.call(request, body))
+
+    def list_files(self, prefix=None, priority=None, offset=0, limit=None):
+        return self.call({'op': 'list', 'prefix': prefix, 'priority': priority, 'offset': offset, 'limit': limit})
+
+    def print_stats(self, file=None):
+        print(self.call({'op': 'stats'}), end='', file=file)
+
+    def reconcile(self, repair=False, adopt=False, delete_orphans=False):
+        return Inventory.from_json(self.call(
+            {'op': 'reconcile', 'repair': repair, 'adopt': adopt, 'delete_orphans': delete_orphans}))
+
+
+def connect(config_dir):
+    """ DaemonClient for config_dir's daemon, None if it is not running. """
+    path = socket_path(config_dir)
+    sock = connect_socket(path)
+    if sock is None:
+        return None
+    sock.close()
+    return DaemonClient(path)
+
+# End of file
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+""" daemon.py
+
+Long-running PriorityStoreLite master, serving the CRUD API over a UNIX domain socket.
+
+The daemon keeps the metadata, its indexes and the datanode sessions resident, so every request
+skips the startup of a fresh PriorityStoreLite. The socket is `daemon_socket` in config.json
+(default <config_dir>/psl.sock) and is only accessible to the user running the daemon.
+
+    $ ./daemon.py -d config
+
+Each request is one connection carrying one JSON line, answered by one JSON line:
+
+    {"op": "create", "filename": "a.psl", "size": 1024}     ->  {"result": {"returncode": 0}}
+    {"op": "retrieve", "filename": "a.psl", "output": "/abs/path"}
+    {"op": "delete", "filename": "a.psl"}
+    {"op": "put", "filename": "a.psl", "source": "/abs/path"}
+    {"op": "list", "prefix": "dir/"}                        ->  {"result": {"dir/a.psl": {...}}}
+    {"op": "stats"}                                         ->  {"result": "<print_stats output>"}
+    {"op": "reconcile", "repair": true}                     ->  {"result": {"missing": [...], ...}}
+
+A result of null means the API call returned None; failures come back as {"error": "..."}. Paths
+are resolved by the daemon, so clients send absolute ones. A put without a source streams the
+content after the request line, as frames of an 8-byte big-endian length and that many bytes,
+ending with an empty frame.
+
+client.py has the other end: DaemonClient, with the same methods as PriorityStoreLite for these
+calls.
+
+Author: Brian Tuan
+"""
+
+import io
+import json
+import os
+import signal
+import socketserver
+import struct
+from threading import Thread
+
+import click
+
+from api import PriorityStoreLite
+from client import connect_socket, socket_path
+
+
+def returncode(rc):
+    return None if rc is None else {'returncode': rc.returncode}
+
+
+def read_frames(rfile):
+    while True:
+        header = rfile.read(8)
+        if len(header) < 8:
+            raise EOFError("Stream ended without its last frame")
+        length, = struct.unpack('>Q', header)
+        if length == 0:
+            return
+        data = rfile.read(length)
+        if len(data) < length:
+            raise EOFError("Stream ended in the middle of a frame")
+        yield data
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            response = {'result': self.server.master.dispatch(json.loads(line), self.rfile)}
+        except Exception as e:
+            response = {'error': repr(e)}
+        try:
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+        except OSError:
+            # The client went away.
+            pass
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MasterDaemon:
+    def __init__(self, psl, path):
+        self.psl = psl
+        self.path = path
+        self.server = None
+
+    def dispatch(self, request, rfile):
+        psl = self.psl
+        op = request.pop('op')
+        if op == 'create':
+            return returncode(psl.create_file(**request))
+        if op == 'retrieve':
+            return returncode(psl.retrieve_file(**request))
+        if op == 'delete':
+            return returncode(psl.delete_file(**request))
+        if op == 'put':
+            source = request.pop('source', None)
+            return returncode(psl.put_file(source=read_frames(rfile) if source is None else source, **request))
+        if op == 'list':
+            return {filename: dict(info) for filename, info in psl.list_files(**request).items()}
+        if op == 'reconcile':
+            return psl.reconcile(**request).to_json()
+        if op == 'stats':
+            out = io.StringIO()
+            psl.print_stats(file=out)
+            return out.getvalue()
+        raise ValueError("Unknown operation: {}".format(op))
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            if connect_socket(self.path) is not None:
+                raise RuntimeError("A daemon is already listening on {}".format(self.path))
+            # Left behind by a daemon that died.
+            os.remove(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self.server = Server(self.path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.server.master = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.path)
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+
+@click.command()
+@click.option("-d", "--config_dir", help="Path to directory containing configuration files.")
+@click.option("-v", "--verbose", is_flag=True, help="Toggle for verbosity.")
+def run(config_dir, verbose):
+    if not config_dir:
+        config_dir = "config"
+    psl = PriorityStoreLite(config_dir, verbose=verbose)
+    daemon = MasterDaemon(psl, socket_path(config_dir))
+    def stop(signum, frame):
+        # shutdown blocks until serve_forever returns, so it cannot run on the serving thread.
+        Thread(target=daemon.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print("Serving PriorityStoreLite on", daemon.path)
+    try:
+        daemon.serve_forever()
+    finally:
+        psl.close()
+
+
+if __name__ == '__main__':
+    run()
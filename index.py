@@ -0,0 +1,172 @@
+""" index.py
+
+Secondary indexes over PriorityStoreLite metadata, kept up to date on create, delete and move:
+
+    by node id      node_id -> filenames with a copy there
+    by priority     priority -> filenames, as a list so a random file can be drawn in O(1)
+    by path         all filenames in sorted order, for prefix (directory) queries
+
+Also provides FileListing, the lazy read-only view returned by PriorityStoreLite.list_files, and
+the helpers describing where the pieces of a striped file live.
+
+Author: Brian Tuan
+"""
+
+from collections.abc import Mapping
+from itertools import islice
+from threading import Lock
+
+from sortedcontainers import SortedList
+
+
+def chunk_sizes(size, block_size):
+    """ Sizes of the block_size chunks a file of size bytes is striped into. """
+    sizes = [block_size] * (size // block_size)
+    if size % block_size:
+        sizes.append(size % block_size)
+    return sizes
+
+
+def chunk_name(filename, i):
+    return '{}.psl-chunk-{}'.format(filename, i)
+
+
+def entry_nodes(info):
+    """ Distinct node ids holding a replica or a chunk of the file. """
+    if 'chunks' in info:
+        return list(dict.fromkeys(info['chunks']))
+    return info.get('replicas', [info['node_id']])
+
+
+class MetadataIndex:
+    """ Built from the metadata on the first query, so that opening a large store stays cheap. Until
+    then add, remove and move have nothing to keep up to date.
+
+    lock is the one writers of the metadata hold while calling add, remove and move: the build holds
+    it too, so no change to the metadata slips in between reading it and the index being marked built.
+    """
+    def __init__(self, metadata=None, lock=None):
+        self.metadata = metadata
+        self.lock = Lock() if lock is None else lock
+        self.built = False
+        self.by_node = {}
+        self.by_priority = {}
+        self.priority_pos = {}
+        self.by_path = SortedList()
+
+    def build(self):
+        if self.built:
+            return
+        with self.lock:
+            if self.built:
+                return
+            names = []
+            for filename, info in (self.metadata or {}).items():
+                if filename != "PSL":
+                    self.insert(filename, info)
+                    names.append(filename)
+            self.by_path = SortedList(names)
+            self.built = True
+
+    def insert(self, filename, info):
+        for node_id in entry_nodes(info):
+            self.by_node.setdefault(node_id, {})[filename] = None
+        files = self.by_priority.setdefault(info['priority'], [])
+        self.priority_pos[filename] = len(files)
+        files.append(filename)
+
+    def add(self, filename, info):
+        if self.built:
+            self.insert(filename, info)
+            self.by_path.add(filename)
+
+    def remove(self, filename, info):
+        if not self.built:
+            return
+        for node_id in entry_nodes(info):
+            del self.by_node[node_id][filename]
+        # Swap the last file into the hole so removal stays O(1).
+        files = self.by_priority[info['priority']]
+        pos = self.priority_pos.pop(filename)
+        last = files.pop()
+        if last != filename:
+            files[pos] = last
+            self.priority_pos[last] = pos
+        self.by_path.remove(filename)
+
+    def move(self, filename, old_nodes, new_nodes):
+        """ The file's copies moved from old_nodes to new_nodes; only the by node index changes. """
+        if not self.built:
+            return
+        for node_id in old_nodes:
+            del self.by_node[node_id][filename]
+        for node_id in new_nodes:
+            self.by_node.setdefault(node_id, {})[filename] = None
+
+    def files_on_node(self, node_id):
+        self.build()
+        return self.by_node.get(node_id, {}).keys()
+
+    def files_with_priority(self, priority):
+        """ Live list of the files with this priority. Do not modify. """
+        self.build()
+        return self.by_priority.get(priority, [])
+
+    def files_with_prefix(self, prefix):
+        self.build()
+        for filename in self.by_path.irange(minimum=prefix):
+            if not filename.startswith(prefix):
+                break
+            yield filename
+
+
+class FileListing(Mapping):
+    """ Read-only view of the files matching a prefix and/or priority, optionally paginated.
+
+    Nothing is copied: the view reads the live metadata, so take dict(view) before mutating the store
+    while iterating over it.
+    """
+    def __init__(self, metadata, index, prefix=None, priority=None, offset=0, limit=None):
+        self.metadata = metadata
+        self.index = index
+        self.prefix = prefix
+        self.priority = priority
+        self.offset = offset
+        self.limit = limit
+
+    def matches(self, filename):
+        if filename == "PSL" or filename not in self.metadata:
+            return False
+        if self.prefix is not None and not filename.startswith(self.prefix):
+            return False
+        return self.priority is None or self.metadata[filename]['priority'] == self.priority
+
+    def candidates(self):
+        if self.priority is not None:
+            files = self.index.files_with_priority(self.priority)
+            if self.prefix is None:
+                return iter(files)
+            return (f for f in files if f.startswith(self.prefix))
+        if self.prefix is not None:
+            return self.index.files_with_prefix(self.prefix)
+        return (f for f in self.metadata if f != "PSL")
+
+    def __iter__(self):
+        stop = None if self.limit is None else self.offset + self.limit
+        return islice(self.candidates(), self.offset, stop)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __getitem__(self, filename):
+        if not self.matches(filename):
+            raise KeyError(filename)
+        return self.metadata[filename]
+
+    def __contains__(self, filename):
+        return self.matches(filename)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+# End of file
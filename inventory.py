@@ -0,0 +1,350 @@
+""" inventory.py
+
+Cluster inventory scan for PriorityStoreLite: reconciles the metadata with what the datanodes hold.
+
+Every datanode lists its whole config['path'] with one remote find printing the size, mtime and name
+of each file, all nodes in parallel. The listings are then diffed against the metadata:
+
+    missing     pieces (replicas or chunks) an entry expects on a node that are not there, or are
+                there with the wrong size
+    orphans     files on a node that no entry accounts for, including the temporaries of
+                interrupted uploads and migrations
+
+and, with repair, the metadata is brought in line with the nodes:
+
+    - a file that lost some replicas keeps the surviving ones; a file with no intact copy left, or
+      a striped file missing any chunk, is dropped and its leftover pieces become orphans
+    - with adopt, orphaned files and complete sets of orphaned chunks become entries again, which
+      rebuilds the metadata of a cluster whose metadata.bin was lost
+    - with delete_orphans, the orphans left after that are removed from their nodes
+    - available and priority_counter are recomputed from the entries
+
+Entries and files changed since the scan started are left alone, so a live cluster can be scanned
+and repaired. adopt is the exception: run it while nothing is being deleted, or it can bring back a
+file whose delete raced the listing.
+
+Author: Brian Tuan
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import re
+import time
+
+# Files modified this close to the start of the scan may be in flight: remote clocks can be off a bit.
+GRACE = 60
+TEMPORARY = ('.psl-upload', '.psl-migrate')
+CHUNK = re.compile(r'^(.*)\.psl-chunk-(\d+)$')
+# Missing files and orphans printed by print_report, per kind.
+PRINT_LIMIT = 20
+
+
+def listing_command(root):
+    return ('if [ -d "{0}" ]; then cd "{0}" && find . -type f -printf \'%s %T@ %P\\0\'; fi'.format(root))
+
+
+def parse_listing(output):
+    """ {stored name: (size, mtime)} from the NUL-separated output of listing_command. """
+    files = {}
+    for record in output.split(b'\0'):
+        if not record:
+            continue
+        size, mtime, name = record.split(b' ', 2)
+        files[name.decode('utf-8', 'surrogateescape')] = (int(size), int(float(mtime)))
+    return files
+
+
+def list_node(psl, node_id):
+    """ Listing of every file under the node's config['path'], None if the node could not be listed. """
+    node = psl.datanodes[node_id]
+    rc = psl.transport.execute(node, listing_command(psl.remote_path(node, '')), capture=True)
+    if rc.returncode != 0:
+        return None
+    return parse_listing(rc.stdout)
+
+
+def same_placement(a, b):
+    # mtime changes on every read: only a change of the pieces makes the scan stale.
+    return all(a.get(key) == b.get(key) for key in ('node_id', 'size', 'replicas', 'chunks'))
+
+
+class Inventory:
+    """ What differs between the metadata and the datanodes, and what reconcile did about it. """
+    def __init__(self, num, started):
+        self.started = started
+        self.seconds = None
+        self.unreachable = []
+        # Per node: files and bytes found.
+        self.files = [0] * num
+        self.bytes = [0] * num
+        # (filename, node id, stored name, expected size, size found or None)
+        self.missing = []
+        # (node id, stored name, size, mtime)
+        self.orphans = []
+        # Entries and remote files changed since the scan started.
+        self.skipped = 0
+        self.damaged = {}
+        # (node id, stored name) of the pieces of dropped copies: known bad, never adopted.
+        self.dropped = set()
+        self.repairs = {}
+        self.listings = None
+
+    def to_json(self):
+        return {
+            'started': self.started,
+            'seconds': self.seconds,
+            'unreachable': self.unreachable,
+            'files': self.files,
+            'bytes': self.bytes,
+            'missing': [list(missing) for missing in self.missing],
+            'orphans': [list(orphan) for orphan in self.orphans],
+            'skipped': self.skipped,
+            'repairs': self.repairs
+        }
+
+    @classmethod
+    def from_json(cls, value):
+        inventory = cls(len(value['files']), value['started'])
+        inventory.seconds = value['seconds']
+        inventory.unreachable = value['unreachable']
+        inventory.files = value['files']
+        inventory.bytes = value['bytes']
+        inventory.missing = [tuple(missing) for missing in value['missing']]
+        inventory.orphans = [tuple(orphan) for orphan in value['orphans']]
+        inventory.skipped = value['skipped']
+        inventory.repairs = value['repairs']
+        return inventory
+
+    def print_report(self):
+        print("Scanned %d files (%0.3f GB) on %d nodes in %0.1f s" % (
+            sum(self.files), sum(self.bytes)/1073741824.0, len(self.files), self.seconds))
+        if self.unreachable:
+            print("Could not list nodes", self.unreachable)
+        for kind, items in (('Missing', self.missing), ('Orphans', self.orphans)):
+            print("%s: %d" % (kind, len(items)))
+            for item in items[:PRINT_LIMIT]:
+                print("   ", *item)
+            if len(items) > PRINT_LIMIT:
+                print("    ... and %d more" % (len(items) - PRINT_LIMIT))
+        if self.skipped:
+            print("Skipped %d entries and files changed during the scan" % self.skipped)
+        for action, count in self.repairs.items():
+            print("Repair:", action, count)
+
+
+def scan(psl):
+    """ List every datanode in parallel and diff the listings against the metadata. """
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=psl.num) as executor:
+        listings = list(executor.map(lambda node_id: list_node(psl, node_id), range(psl.num)))
+    inventory = diff(psl, listings, started)
+    inventory.seconds = time.time() - started
+    return inventory
+
+
+def diff(psl, listings, started):
+    inventory = Inventory(psl.num, started)
+    inventory.listings = listings
+    expected = [set() for _ in range(psl.num)]
+    for filename, info in psl.metadata.items():
+        if filename == "PSL":
+            continue
+        copies = psl.copies(filename, info)
+        for node_id, name, _ in copies:
+            expected[node_id].add(name)
+        if info['mtime'] >= int(started):
+            # Created (or read) since the scan started: its pieces may not be listed yet.
+            inventory.skipped += 1
+            continue
+        for node_id, name, size in copies:
+            listing = listings[node_id]
+            found = None if listing is None else listing.get(name)
+            if listing is None or (found is not None and found[0] == size):
+                continue
+            if found is not None and found[1] >= started - GRACE:
+                inventory.skipped += 1
+                continue
+            inventory.missing.append((filename, node_id, name, size, None if found is None else found[0]))
+            inventory.damaged[filename] = info.to_json()
+
+    for node_id, listing in enumerate(listings):
+        if listing is None:
+            inventory.unreachable.append(node_id)
+            continue
+        for name, (size, mtime) in listing.items():
+            inventory.files[node_id] += 1
+            inventory.bytes[node_id] += size
+            if name in expected[node_id]:
+                continue
+            if mtime >= started - GRACE:
+                inventory.skipped += 1
+                continue
+            inventory.orphans.append((node_id, name, size, mtime))
+    return inventory
+
+
+def repair_entry(psl, filename, info, bad, inventory):
+    """ Drop the bad (node id, stored name) pieces from filename's entry, or the entry if nothing usable is left. """
+    with psl.file_locks(filename):
+        current = psl.metadata.get(filename)
+        if current is None or not same_placement(current, info):
+            inventory.skipped += 1
+            return None
+        copies = psl.copies(filename, current)
+        survivors = [node_id for node_id, name, _ in copies if (node_id, name) not in bad]
+        if 'chunks' in current or not survivors:
+            survivors = []
+        entry = current.to_json()
+        with psl.metadata_lock:
+            for node_id, name, size in copies:
+                if node_id not in survivors:
+                    psl.reserve(node_id, size)
+            psl.remove_entry(filename)
+            if survivors:
+                entry['node_id'] = survivors[0]
+                entry.pop('replicas', None)
+                if len(survivors) > 1:
+                    entry['replicas'] = survivors
+                psl.add_entry(filename, entry)
+    if psl.cache is not None:
+        psl.cache.invalidate(filename)
+    # What is left of the dropped copies on the nodes is no longer accounted for.
+    for node_id, name, _ in copies:
+        listing = inventory.listings[node_id]
+        if node_id not in survivors and listing is not None and name in listing:
+            inventory.orphans.append((node_id, name) + listing[name])
+            inventory.dropped.add((node_id, name))
+    return 'trimmed' if survivors else 'dropped'
+
+
+def adoptable(psl, orphans):
+    """ {filename: entry} for the orphans that can be files again: whole files, and complete chunk sets. """
+    whole = {}
+    chunked = {}
+    for node_id, name, size, mtime in orphans:
+        if name.endswith(TEMPORARY):
+            continue
+        match = CHUNK.match(name)
+        if match is None:
+            whole.setdefault(name, []).append((mtime, size, node_id))
+            continue
+        chunks = chunked.setdefault(match.group(1), {})
+        i = int(match.group(2))
+        # The same chunk on two nodes: no way to tell which belongs to the file.
+        chunks[i] = None if i in chunks else (node_id, size, mtime)
+
+    entries = {}
+    for filename, copies in whole.items():
+        # The newest copy decides the size; the others of that size are replicas of it.
+        mtime, size, _ = max(copies)
+        replicas = [node_id for _, copy_size, node_id in copies if copy_size == size]
+        entries[filename] = {'node_id': replicas[0], 'mtime': mtime, 'priority': 2, 'size': size}
+        if len(replicas) > 1:
+            entries[filename]['replicas'] = replicas
+    for filename, chunks in chunked.items():
+        pieces = [chunks.get(i) for i in range(len(chunks))]
+        if len(pieces) < 2 or None in pieces or any(size != psl.block_size for _, size, _ in pieces[:-1]) \
+                or not 0 < pieces[-1][1] <= psl.block_size:
+            continue
+        entries[filename] = {'node_id': pieces[0][0], 'mtime': max(mtime for _, _, mtime in pieces),
+                             'priority': 2, 'size': sum(size for _, size, _ in pieces),
+                             'chunks': [node_id for node_id, _, _ in pieces]}
+    return entries
+
+
+def adopt(psl, inventory):
+    """ Add entries for the adoptable orphans and take them off the orphan list. Returns the number of files added. """
+    adopted = set()
+    files = 0
+    orphans = [orphan for orphan in inventory.orphans if (orphan[0], orphan[1]) not in inventory.dropped]
+    for filename, entry in adoptable(psl, orphans).items():
+        with psl.file_locks(filename):
+            if filename in psl.metadata or filename in psl.claims or filename == "PSL":
+                continue
+            with psl.metadata_lock:
+                for node_id, name, size in psl.copies(filename, entry):
+                    psl.reserve(node_id, -size)
+                    adopted.add((node_id, name))
+                psl.add_entry(filename, entry)
+            files += 1
+    inventory.orphans = [orphan for orphan in inventory.orphans if (orphan[0], orphan[1]) not in adopted]
+    return files
+
+
+def still_orphaned(psl, node_id, name):
+    """ False if name on node_id has become a piece of a file since the scan. """
+    match = CHUNK.match(name)
+    filename = name if match is None else match.group(1)
+    info = psl.metadata.get(filename) if filename != "PSL" else None
+    if info is None:
+        return True
+    return all((piece_node, piece_name) != (node_id, name) for piece_node, piece_name, _ in psl.copies(filename, info))
+
+
+def delete_orphans(psl, inventory):
+    """ Remove the orphans from their nodes, one remote command per node. Returns the number removed. """
+    by_node = {}
+    for orphan in inventory.orphans:
+        if still_orphaned(psl, orphan[0], orphan[1]):
+            by_node.setdefault(orphan[0], []).append(orphan)
+    def remove(node_id):
+        node = psl.datanodes[node_id]
+        paths = b''.join(psl.remote_path(node, name).encode('utf-8', 'surrogateescape') + b'\0'
+                         for _, name, _, _ in by_node[node_id])
+        return psl.transport.execute(node, 'xargs -0 rm -f --', input=paths).returncode == 0
+    with ThreadPoolExecutor(max_workers=max(len(by_node), 1)) as executor:
+        removed = dict(zip(by_node, executor.map(remove, by_node)))
+    # Only the orphans of nodes where the removal failed are left.
+    inventory.orphans = [orphan for node_id, ok in removed.items() if not ok for orphan in by_node[node_id]]
+    return sum(len(by_node[node_id]) for node_id, ok in removed.items() if ok)
+
+
+def rebuild_accounting(psl):
+    """ Recompute available and priority_counter from the entries.
+
+    False, with nothing changed, while an upload is in flight: its space is reserved before its
+    entry exists.
+    """
+    with psl.metadata_lock:
+        if psl.claims:
+            return False
+        used = [0] * psl.num
+        counter = [0.0] * len(psl.priority_counter)
+        for filename, info in psl.metadata.items():
+            if filename == "PSL":
+                continue
+            counter[info['priority']] += 1
+            for node_id, _, size in psl.copies(filename, info):
+                used[node_id] += size
+        for node_id in range(psl.num):
+            delta = psl.capacities[node_id] - used[node_id] - psl.available[node_id]
+            if delta:
+                psl.reserve(node_id, delta)
+        psl.priority_counter[:] = counter
+    return True
+
+
+def reconcile(psl, repair=False, adopt_orphans=False, remove_orphans=False):
+    """ Scan the cluster and, with repair, fix the metadata (see the module docstring). Adopting or
+    removing orphans implies repair.
+    """
+    inventory = scan(psl)
+    if not (repair or adopt_orphans or remove_orphans):
+        return inventory
+    repairs = {'trimmed': 0, 'dropped': 0}
+    bad = {}
+    for filename, node_id, name, _, _ in inventory.missing:
+        bad.setdefault(filename, set()).add((node_id, name))
+    for filename, pieces in bad.items():
+        outcome = repair_entry(psl, filename, inventory.damaged[filename], pieces, inventory)
+        if outcome is not None:
+            repairs[outcome] += 1
+    if adopt_orphans:
+        repairs['adopted'] = adopt(psl, inventory)
+    if remove_orphans:
+        repairs['removed'] = delete_orphans(psl, inventory)
+    repairs['accounting'] = rebuild_accounting(psl)
+    inventory.repairs = repairs
+    inventory.seconds = time.time() - inventory.started
+    return inventory
+
+# End of file
@@ -0,0 +1,188 @@
+""" journal.py
+
+Write-ahead journal for PriorityStoreLite metadata.
+
+Every metadata mutation is appended to config_dir/metadata.journal as one small JSON record:
+
+    {"seq": 12, "op": "create", "file": "a.psl", "entry": {...}}
+    {"seq": 13, "op": "delete", "file": "a.psl"}
+    {"seq": 14, "op": "move", "file": "a.psl", "node_id": 3}
+    {"seq": 15, "op": "capacity", "node_id": 3, "available": 17112760320}
+
+Records are written immediately and fsynced in batches, at most sync_interval seconds after they
+were committed. Once the journal holds compact_every records it is rotated and folded into a fresh
+metadata.bin snapshot (see metastore.py) on a background thread. The snapshot stores the sequence
+number of the last record it contains, so recovery is: load the snapshot, then replay newer records
+from the rotated and the live journal, in that order.
+
+A journal created with enabled=False records nothing: only persist_metadata snapshots survive a
+restart. Offline simulations use it, since their metadata is thrown away anyway.
+
+Author: Brian Tuan
+"""
+
+import json
+import os
+import shutil
+import time
+from threading import Condition, Lock, Thread
+
+from metastore import SNAPSHOT_NAME
+
+
+class MetadataJournal:
+    def __init__(self, config_dir, sync_interval=0.1, compact_every=100000, enabled=True):
+        self.path = config_dir + 'metadata.journal'
+        self.rotated_path = config_dir + 'metadata.journal.old'
+        self.snapshot_path = config_dir + SNAPSHOT_NAME
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.enabled = enabled
+        self.lock = Lock()
+        self.synced = Condition(self.lock)
+        self.seq = 0
+        self.records = 0
+        self.dirty = False
+        self.compactor = None
+        self.f = None
+        self.closed = False
+        # Per journal file: byte offset just past its last intact record, as found by records_after.
+        self.valid_ends = {}
+        self.flusher = Thread(target=self.flush_loop, daemon=True)
+
+    def records_after(self, seq):
+        """ Yield the journaled records newer than seq, oldest first. """
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            end = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Torn write at the tail of the journal: everything after it is lost.
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    end += len(line)
+                    if record['seq'] > seq:
+                        yield record
+            self.valid_ends[path] = end
+
+    def open(self, seq):
+        """ Start appending after the last replayed sequence number.
+
+        A torn tail found by records_after is cut off first: records appended after it would be
+        unreadable on the next recovery.
+        """
+        for path, end in self.valid_ends.items():
+            if os.path.exists(path) and os.path.getsize(path) > end:
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+        self.seq = seq
+        self.f = open(self.path, 'a')
+        self.flusher.start()
+
+    def append(self, op, **fields):
+        if not self.enabled:
+            return self.seq
+        fields['op'] = op
+        with self.lock:
+            self.seq += 1
+            fields['seq'] = self.seq
+            self.f.write(json.dumps(fields) + '\n')
+            self.records += 1
+            self.dirty = True
+            return self.seq
+
+    def commit(self, wait=False):
+        """ Hand buffered records to the OS. With wait=True, block until they are fsynced. """
+        with self.lock:
+            self.f.flush()
+            if wait:
+                while self.dirty and not self.closed:
+                    self.synced.wait()
+
+    def flush_loop(self):
+        while not self.closed:
+            time.sleep(self.sync_interval)
+            with self.lock:
+                if self.dirty and not self.closed:
+                    self.f.flush()
+                    os.fsync(self.f.fileno())
+                    self.dirty = False
+                    self.synced.notify_all()
+
+    def interrupted(self):
+        return os.path.exists(self.rotated_path)
+
+    def needs_compaction(self):
+        return self.records >= self.compact_every and self.compactor is None
+
+    def rotate(self):
+        """ Close the live journal and start a new one. Returns the last sequence number rotated out. """
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            if os.path.exists(self.rotated_path):
+                # A compaction never finished and its records are not in the snapshot yet: keep them,
+                # followed by the live ones, until the snapshot that covers both is written.
+                with open(self.rotated_path, 'ab') as rotated, open(self.path, 'rb') as live:
+                    shutil.copyfileobj(live, rotated)
+                    rotated.flush()
+                    os.fsync(rotated.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+            self.f = open(self.path, 'a')
+            self.records = 0
+            self.dirty = False
+            self.synced.notify_all()
+            return self.seq
+
+    def write_snapshot(self, snapshot):
+        tmp = self.snapshot_path + '.tmp'
+        snapshot.write(tmp)
+        os.replace(tmp, self.snapshot_path)
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def compact(self, snapshot, background=True, written=None):
+        """ Write a metastore Snapshot (its "PSL" entry carrying the rotated journal_seq) over metadata.bin.
+
+        written, if given, is called with the snapshot's path once it is in place.
+        """
+        if not background:
+            self.write_snapshot(snapshot)
+            if written is not None:
+                written(self.snapshot_path)
+            return
+        self.compactor = Thread(target=self.compact_worker, args=[snapshot, written], daemon=True)
+        self.compactor.start()
+
+    def compact_worker(self, snapshot, written):
+        try:
+            self.write_snapshot(snapshot)
+            if written is not None:
+                written(self.snapshot_path)
+        finally:
+            self.compactor = None
+
+    def wait_compaction(self):
+        compactor = self.compactor
+        if compactor is not None:
+            compactor.join()
+
+    def close(self):
+        self.wait_compaction()
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            self.closed = True
+            self.synced.notify_all()
+
+# End of file
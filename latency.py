@@ -0,0 +1,81 @@
+""" latency.py
+
+Observed per-node latencies for PriorityStoreLite: an exponentially weighted moving average and a
+window of recent samples for percentiles, per node id.
+
+Transfers recorded with their size are also kept as seconds per byte, per node and size class
+(sizes within a factor of 4 of each other), so a deadline for a transfer of a given size comes
+from transfers of about that size rather than from a mix of small and large ones.
+
+Author: Brian Tuan
+"""
+
+from collections import deque
+from threading import Lock
+
+import numpy as np
+
+
+def size_class(nbytes):
+    return max(int(nbytes), 1).bit_length() // 2
+
+
+class LatencyTracker:
+    def __init__(self, alpha=0.2, window=256):
+        self.alpha = alpha
+        self.window = window
+        self.lock = Lock()
+        self.ewma = {}
+        self.samples = {}
+        # node id -> {size class: seconds per byte of recent transfers}
+        self.per_byte = {}
+
+    def record(self, node_id, seconds, nbytes=None):
+        with self.lock:
+            if node_id not in self.ewma:
+                self.ewma[node_id] = seconds
+                self.samples[node_id] = deque(maxlen=self.window)
+            else:
+                self.ewma[node_id] += self.alpha * (seconds - self.ewma[node_id])
+            self.samples[node_id].append(seconds)
+            if nbytes:
+                classes = self.per_byte.setdefault(node_id, {})
+                classes.setdefault(size_class(nbytes), deque(maxlen=self.window)).append(seconds / nbytes)
+
+    def estimate(self, node_id):
+        """ Smoothed latency of the node, None if it was never observed. """
+        return self.ewma.get(node_id)
+
+    def percentile(self, node_id, q):
+        with self.lock:
+            samples = self.samples.get(node_id)
+            if not samples:
+                return None
+            return float(np.percentile(list(samples), q))
+
+    def deadline(self, node_id, nbytes, q):
+        """ q-th percentile of the time to transfer nbytes from the node, None if it was never observed.
+
+        Taken from the transfers of the same size class, or of the closest one that has any, scaled
+        to nbytes.
+        """
+        with self.lock:
+            classes = self.per_byte.get(node_id)
+            if not classes:
+                return None
+            wanted = size_class(nbytes)
+            closest = min(classes, key=lambda c: (abs(c - wanted), c))
+            return float(np.percentile(list(classes[closest]), q)) * max(nbytes, 1)
+
+    def to_json(self):
+        with self.lock:
+            return {str(node_id): {'ewma': self.ewma[node_id], 'samples': list(self.samples[node_id])}
+                    for node_id in self.ewma}
+
+    def load_json(self, data):
+        with self.lock:
+            for node_id, value in data.items():
+                self.ewma[int(node_id)] = value['ewma']
+                self.samples[int(node_id)] = deque(value['samples'], maxlen=self.window)
+
+# End of file
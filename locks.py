@@ -0,0 +1,27 @@
+""" locks.py
+
+Per-file operation locks for PriorityStoreLite.
+
+Operations on one file (create, delete, move, re-prioritize) must not interleave, including the
+remote commands they run, but operations on different files should not wait for each other over
+those. ShardedLocks keeps a fixed number of locks and maps each filename to one of them by hash, so
+the number of locks does not grow with the namespace and two files only contend when they share a
+shard. The metadata itself is not sharded: its updates still go through PriorityStoreLite's single
+metadata_lock, which is only held for the local bookkeeping.
+
+Author: Brian Tuan
+"""
+
+from threading import RLock
+
+
+class ShardedLocks:
+    def __init__(self, shards=64):
+        # Re-entrant, so a locked operation can call another one on the same file.
+        self.locks = [RLock() for _ in range(shards)]
+
+    def __call__(self, key):
+        """ The lock guarding key, to use as `with locks(filename):`. """
+        return self.locks[hash(key) % len(self.locks)]
+
+# End of file
@@ -0,0 +1,526 @@
+""" metastore.py
+
+Compact, columnar store of PriorityStoreLite metadata.
+
+A MetadataStore maps filenames to Entry records, plus the "PSL" system information, like the
+metadata.json dict it replaces, but holds most of them in a binary snapshot (metadata.bin) that is
+memory-mapped rather than parsed:
+
+    name_offsets    uint64[n + 1]   filenames, sorted by their UTF-8 bytes, packed in names
+    names           bytes
+    node_id         int32[n]        interned: an index into datanodes.json, not the user@host string
+    priority        int8[n]
+    size            int64[n]
+    mtime           int64[n]        seconds since the epoch
+    replicas_offsets, replicas      the replica node ids of each file (empty for a single copy)
+    chunks_offsets, chunks          the chunk node ids of each striped file
+
+The file starts with b'PSLMETA1', the length of a JSON header (file count, system information and
+where each column starts, relative to the 8-byte aligned end of the header) and the header itself.
+
+Opening a snapshot maps it copy-on-write and reads the header, so it takes the same time for any
+number of files. A file is found by binary search over the sorted names and its Entry built on
+demand. Changes to the fixed-width columns of snapshotted files are written in place (into private
+copies of the touched pages, never the file); replica and chunk lists that change, deletions and new
+files are kept on the side until the next snapshot folds them in. All of it lives in one State, which
+a rebase onto a new snapshot replaces as a whole, so reads need no lock.
+
+On first open, metadata.json is migrated: its entries are converted and written to metadata.bin,
+which is used from then on. metadata.json is left as it was.
+
+Author: Brian Tuan
+"""
+
+import bisect
+import calendar
+import json
+import mmap
+import os
+import struct
+import time
+from collections.abc import ItemsView, Mapping, MutableMapping, ValuesView
+
+import numpy as np
+
+MAGIC = b'PSLMETA1'
+SNAPSHOT_NAME = 'metadata.bin'
+LEGACY_NAME = 'metadata.json'
+DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+COLUMNS = (('node_id', np.int32), ('priority', np.int8), ('size', np.int64), ('mtime', np.int64))
+FIELDS = tuple(name for name, _ in COLUMNS)
+LISTS = ('replicas', 'chunks')
+
+
+def format_modified(mtime):
+    return time.strftime(DATE_FORMAT, time.gmtime(mtime))
+
+
+def parse_modified(modified):
+    return calendar.timegm(time.strptime(modified, DATE_FORMAT))
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+class Entry(Mapping):
+    """ One file's metadata. Reads like the dicts of metadata.json: node and modified are derived. """
+    __slots__ = ('nodes', 'node_id', 'priority', 'size', 'mtime', 'replicas', 'chunks')
+
+    def __init__(self, nodes, node_id, priority, size, mtime, replicas=None, chunks=None):
+        self.nodes = nodes
+        self.node_id = node_id
+        self.priority = priority
+        self.size = size
+        self.mtime = mtime
+        self.replicas = replicas or None
+        self.chunks = chunks or None
+
+    @classmethod
+    def from_dict(cls, nodes, entry):
+        """ Entry of a metadata.json or journal dict, with either an mtime or a modified date. """
+        if 'mtime' in entry:
+            mtime = entry['mtime']
+        elif 'modified' in entry:
+            mtime = parse_modified(entry['modified'])
+        else:
+            mtime = int(time.time())
+        return cls(nodes, entry['node_id'], entry['priority'], entry['size'], mtime,
+                   entry.get('replicas'), entry.get('chunks'))
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            return getattr(self, key)
+        if key == 'node':
+            return self.nodes[self.node_id]
+        if key == 'modified':
+            return format_modified(self.mtime)
+        if key in LISTS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in LISTS:
+            return getattr(self, key) is not None
+        return key in FIELDS or key in ('node', 'modified')
+
+    def __iter__(self):
+        yield from ('node_id', 'node', 'modified', 'priority', 'size')
+        for key in LISTS:
+            if getattr(self, key) is not None:
+                yield key
+
+    def __len__(self):
+        return 5 + sum(getattr(self, key) is not None for key in LISTS)
+
+    def to_json(self):
+        """ Compact dict form, as journaled. """
+        entry = {name: getattr(self, name) for name in FIELDS}
+        for key in LISTS:
+            if getattr(self, key) is not None:
+                entry[key] = getattr(self, key)
+        return entry
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Names:
+    """ The snapshot's sorted filenames as a sequence of bytes, for bisect. """
+    # Every FENCE-th name is kept as bytes, so a search only decodes names within one fence.
+    FENCE = 64
+
+    def __init__(self, blob, offsets):
+        # Plain memoryviews: indexing them is several times faster than indexing NumPy arrays.
+        self.blob = memoryview(blob).cast('B')
+        self.offsets = memoryview(np.ascontiguousarray(offsets, dtype=np.uint64)).cast('B').cast('Q')
+        self.fences = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def search(self, key):
+        """ Index of the first name >= key. """
+        if self.fences is None:
+            # Built on the first search rather than on open.
+            self.fences = [self[i] for i in range(0, len(self), self.FENCE)]
+        fence = bisect.bisect_right(self.fences, key) - 1
+        if fence < 0:
+            return 0
+        lo = fence * self.FENCE
+        return bisect.bisect_left(self, key, lo, min(lo + self.FENCE, len(self)))
+
+
+class StoreItems(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class StoreValues(ValuesView):
+    def __iter__(self):
+        return (entry for _, entry in self._mapping.iter_items())
+
+
+class State:
+    """ Everything a read of the store looks at: the mapped snapshot and the changes on its side.
+
+    rebase swaps the whole State with one assignment, and every read takes the reference once, so a
+    read never mixes the row numbers of one snapshot with the columns of another.
+    """
+    def __init__(self, path=None):
+        # Files created since the snapshot.
+        self.added = {}
+        # Snapshot row -> (replicas, chunks), for rows whose lists changed since the snapshot.
+        self.lists = {}
+        self.deleted = None
+        self.dead = 0
+        self.system = None
+        self.mm = None
+        self.count = 0
+        self.columns = {name: np.zeros(0, dtype) for name, dtype in COLUMNS}
+        self.list_columns = {key: (np.zeros(1, np.uint64), np.zeros(0, np.int32)) for key in LISTS}
+        self.blob = b''
+        self.offsets = np.zeros(1, np.uint64)
+        if path is not None:
+            self.load(path)
+        self.names = Names(self.blob, self.offsets)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            # Copy-on-write: in-place updates never reach the file, which may be replaced under us.
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a PriorityStoreLite metadata snapshot".format(path))
+        header_len, = struct.unpack_from('<Q', self.mm, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(self.mm[start:start + header_len])
+        base = align(start + header_len)
+        def column(name):
+            offset, dtype, length = header['columns'][name]
+            if length == 0:
+                return np.zeros(0, dtype)
+            return np.frombuffer(self.mm, dtype=dtype, count=length, offset=base + offset)
+        self.system = header['system']
+        self.count = header['count']
+        self.columns = {name: column(name) for name in FIELDS}
+        self.list_columns = {key: (column(key + '_offsets'), column(key)) for key in LISTS}
+        self.blob = column('names')
+        self.offsets = column('name_offsets')
+
+    def row(self, filename):
+        """ Snapshot row of filename, None if it is not there (or was deleted). """
+        if self.count == 0:
+            return None
+        key = filename.encode()
+        i = self.names.search(key)
+        if i < self.count and self.names[i] == key and (self.deleted is None or not self.deleted.item(i)):
+            return i
+        return None
+
+    def row_lists(self, row):
+        if row in self.lists:
+            return self.lists[row]
+        result = []
+        for key in LISTS:
+            offsets, ids = self.list_columns[key]
+            start, end = offsets.item(row), offsets.item(row + 1)
+            result.append(ids[start:end].tolist() if end > start else None)
+        return tuple(result)
+
+    def entry_at(self, nodes, row):
+        columns = self.columns
+        replicas, chunks = self.row_lists(row)
+        return Entry(nodes, columns['node_id'].item(row), columns['priority'].item(row),
+                     columns['size'].item(row), columns['mtime'].item(row), replicas, chunks)
+
+    def iter_rows(self):
+        """ (filename, row) of every live snapshot row, in order. """
+        offsets = self.offsets.tolist()
+        deleted = None if self.deleted is None else self.deleted.tolist()
+        blob = bytes(self.names.blob)
+        for i in range(self.count):
+            if deleted is None or not deleted[i]:
+                yield blob[offsets[i]:offsets[i + 1]].decode(), i
+
+
+class MetadataStore(MutableMapping):
+    """ Mutations must be serialized by the caller (PriorityStoreLite holds metadata_lock for them);
+    reads need no lock.
+    """
+    def __init__(self, nodes, path=None):
+        self.nodes = nodes
+        self.state = State(path)
+        self.system = self.state.system
+        # Files created, changed or deleted since the last snapshot(), carried over by rebase.
+        self.changed = set()
+
+    @property
+    def added(self):
+        return self.state.added
+
+    @property
+    def count(self):
+        return self.state.count
+
+    def row(self, filename):
+        return self.state.row(filename)
+
+    def __getitem__(self, filename):
+        if filename == "PSL":
+            if self.system is None:
+                raise KeyError(filename)
+            return self.system
+        state = self.state
+        entry = state.added.get(filename)
+        if entry is not None:
+            return entry
+        row = state.row(filename)
+        if row is None:
+            raise KeyError(filename)
+        return state.entry_at(self.nodes, row)
+
+    def __contains__(self, filename):
+        if filename == "PSL":
+            return self.system is not None
+        state = self.state
+        return filename in state.added or state.row(filename) is not None
+
+    def __setitem__(self, filename, entry):
+        if filename == "PSL":
+            self.system = entry
+            return
+        if not isinstance(entry, Entry):
+            entry = Entry.from_dict(self.nodes, entry)
+        self.changed.add(filename)
+        state = self.state
+        if filename not in state.added:
+            row = state.row(filename)
+            if row is not None:
+                # A whole new entry: lists it leaves out are gone, not kept from the old one.
+                fields = entry.to_json()
+                fields.update((key, getattr(entry, key)) for key in LISTS)
+                self.update_row(state, row, fields)
+                return
+        state.added[filename] = entry
+
+    def __delitem__(self, filename):
+        if filename == "PSL":
+            if self.system is None:
+                raise KeyError(filename)
+            self.system = None
+            return
+        self.changed.add(filename)
+        state = self.state
+        if state.added.pop(filename, None) is not None:
+            return
+        row = state.row(filename)
+        if row is None:
+            raise KeyError(filename)
+        if state.deleted is None:
+            state.deleted = np.zeros(state.count, dtype=bool)
+        state.deleted[row] = True
+        state.dead += 1
+        state.lists.pop(row, None)
+
+    def update_entry(self, filename, **fields):
+        """ Change some of node_id, priority, size, mtime, replicas and chunks of filename's entry. """
+        self.changed.add(filename)
+        state = self.state
+        entry = state.added.get(filename)
+        if entry is not None:
+            for key, value in fields.items():
+                if key in LISTS:
+                    value = value or None
+                setattr(entry, key, value)
+            return
+        row = state.row(filename)
+        if row is None:
+            raise KeyError(filename)
+        self.update_row(state, row, fields)
+
+    def update_row(self, state, row, fields):
+        """ Write fields into a snapshot row; the lists not among them are left as they are. """
+        for name in FIELDS:
+            if name in fields:
+                state.columns[name][row] = fields[name]
+        replicas, chunks = state.row_lists(row)
+        if 'replicas' in fields or 'chunks' in fields or replicas or chunks:
+            state.lists[row] = (fields.get('replicas', replicas) or None, fields.get('chunks', chunks) or None)
+
+    def __iter__(self):
+        if self.system is not None:
+            yield "PSL"
+        state = self.state
+        for filename, _ in state.iter_rows():
+            yield filename
+        yield from list(state.added)
+
+    def iter_items(self):
+        if self.system is not None:
+            yield "PSL", self.system
+        state = self.state
+        for filename, row in state.iter_rows():
+            yield filename, state.entry_at(self.nodes, row)
+        yield from list(state.added.items())
+
+    def items(self):
+        return StoreItems(self)
+
+    def values(self):
+        return StoreValues(self)
+
+    def __len__(self):
+        state = self.state
+        return state.count - state.dead + len(state.added) + (self.system is not None)
+
+    def snapshot(self):
+        """ Frozen copy of the store, to write out (even on another thread) while it keeps changing. """
+        snapshot = Snapshot(self)
+        self.changed = set()
+        return snapshot
+
+    def rebase(self, path):
+        """ Map the snapshot at path, written from this store's last snapshot(), in place of the one
+        it was opened on. The changes made since that snapshot() are carried over, so new files only
+        stay on the side until the next snapshot, not for the life of the process.
+        """
+        carried = {}
+        for filename in self.changed:
+            entry = self.get(filename)
+            carried[filename] = None if entry is None else entry.to_json()
+        fresh = MetadataStore(self.nodes, path)
+        for filename, entry in carried.items():
+            if entry is not None:
+                fresh[filename] = entry
+            elif filename in fresh:
+                del fresh[filename]
+        # One assignment: concurrent reads see either the old state or the new one, never a mix.
+        self.state = fresh.state
+
+
+class Snapshot:
+    def __init__(self, store):
+        # Copy everything that can still change; the mapped names and lists are never written.
+        self.system = json.loads(json.dumps(store.system))
+        state = self.state = store.state
+        self.live = None if state.deleted is None else ~state.deleted
+        self.columns = {name: state.columns[name].copy() if self.live is None else state.columns[name][self.live]
+                        for name in FIELDS}
+        self.lists = dict(state.lists)
+        self.added = sorted((filename.encode(), entry.to_json()) for filename, entry in list(state.added.items()))
+
+    def live_names(self):
+        """ (blob, offsets) of the snapshot rows that are still there. """
+        state = self.state
+        blob = np.frombuffer(state.blob, dtype=np.uint8) if isinstance(state.blob, bytes) else state.blob
+        lengths = np.diff(state.offsets.astype(np.int64))
+        if self.live is None:
+            return blob, state.offsets.astype(np.int64)
+        blob = blob[np.repeat(self.live, lengths)]
+        lengths = lengths[self.live]
+        return blob, np.concatenate([[0], np.cumsum(lengths)])
+
+    def live_lists(self, key):
+        """ {live row: ids} of the snapshot rows with a non-empty key list. """
+        state = self.state
+        offsets, ids = state.list_columns[key]
+        k = LISTS.index(key)
+        rows = set(np.flatnonzero(np.diff(offsets.astype(np.int64))).tolist()) | set(self.lists)
+        result = {}
+        for row in rows:
+            if self.live is not None and not self.live[row]:
+                continue
+            if row in self.lists:
+                value = self.lists[row][k]
+            else:
+                value = ids[offsets[row]:offsets[row + 1]].tolist()
+            if value:
+                result[row] = value
+        if self.live is None or not result:
+            return result
+        # Renumber the rows past the deleted ones.
+        dead_before = np.concatenate([[0], np.cumsum(~self.live)])
+        return {row - int(dead_before[row]): value for row, value in result.items()}
+
+    def write(self, path):
+        state = self.state
+        blob, offsets = self.live_names()
+        base_count = len(offsets) - 1
+        # Where each new file goes among the live rows, keeping the names sorted.
+        full = [state.names.search(name) for name, _ in self.added]
+        if self.live is not None:
+            dead_before = np.concatenate([[0], np.cumsum(~self.live)])
+            positions = [pos - int(dead_before[pos]) for pos in full]
+        else:
+            positions = full
+        count = base_count + len(self.added)
+
+        columns = {}
+        for name, dtype in COLUMNS:
+            columns[name] = np.insert(self.columns[name], positions,
+                                      np.array([entry[name] for _, entry in self.added], dtype=dtype))
+        parts = []
+        lengths = np.diff(offsets)
+        last = 0
+        for pos, (name, _) in zip(positions, self.added):
+            parts.append(blob[offsets[last]:offsets[pos]].tobytes())
+            parts.append(name)
+            last = pos
+        parts.append(blob[offsets[last]:offsets[base_count]].tobytes())
+        lengths = np.insert(lengths, positions, [len(name) for name, _ in self.added])
+        columns['names'] = np.frombuffer(b''.join(parts), dtype=np.uint8)
+        columns['name_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.uint64)
+
+        # Final row of every live row and of every new file.
+        shift = np.searchsorted(np.array(positions, dtype=np.int64), np.arange(base_count), side='right')
+        for key in LISTS:
+            rows = {row + int(shift[row]): value for row, value in self.live_lists(key).items()}
+            for i, (pos, (_, entry)) in enumerate(zip(positions, self.added)):
+                if entry.get(key):
+                    rows[pos + i] = entry[key]
+            sizes = np.zeros(count, dtype=np.int64)
+            ids = []
+            for row in sorted(rows):
+                sizes[row] = len(rows[row])
+                ids.extend(rows[row])
+            columns[key + '_offsets'] = np.concatenate([[0], np.cumsum(sizes)]).astype(np.uint64)
+            columns[key] = np.array(ids, dtype=np.int32)
+
+        layout = {}
+        offset = 0
+        for name, array in columns.items():
+            layout[name] = [offset, array.dtype.str, len(array)]
+            offset = align(offset + array.nbytes)
+        header = json.dumps({'count': count, 'system': self.system, 'columns': layout}).encode()
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * (align(len(MAGIC) + 8 + len(header)) - len(MAGIC) - 8 - len(header)))
+            for name, array in columns.items():
+                f.write(array.tobytes())
+                f.write(b'\0' * (align(array.nbytes) - array.nbytes))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def open_store(config_dir, nodes):
+    """ The metadata of config_dir, migrating metadata.json to metadata.bin if it was not done yet. """
+    path = config_dir + SNAPSHOT_NAME
+    if not os.path.exists(path):
+        store = MetadataStore(nodes)
+        if os.path.exists(config_dir + LEGACY_NAME):
+            with open(config_dir + LEGACY_NAME, 'r') as f:
+                for filename, entry in (json.load(f) or {}).items():
+                    store[filename] = entry
+        tmp = path + '.tmp'
+        store.snapshot().write(tmp)
+        os.replace(tmp, path)
+    return MetadataStore(nodes, path)
+
+# End of file
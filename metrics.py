@@ -0,0 +1,235 @@
+""" metrics.py
+
+Operation-level metrics for PriorityStoreLite.
+
+Every observation is labelled with the operation, the datanode and the file priority (either may
+be None) and adds to that series:
+
+    latency     service time histogram, with p50/p99/p999
+    wait        time the task queued in the worker pool before it started (pooled tasks only)
+    bytes       bytes transferred
+    errors      failed operations
+
+Histograms use fixed log-spaced buckets (8 per doubling, so quantiles are within ~9%), so recording
+is O(1) and memory does not grow with traffic. A snapshot can be exported as JSON or in the
+Prometheus text format, to a file or over HTTP when metrics_port is configured:
+
+    GET /metrics        Prometheus text
+    GET /metrics.json   JSON
+
+Author: Brian Tuan
+"""
+
+import json
+import math
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, local
+
+QUANTILES = {0.5: 'p50', 0.99: 'p99', 0.999: 'p999'}
+
+
+class Histogram:
+    PER_OCTAVE = 8
+    # From 2**-20 s (about a microsecond) to 2**14 s (about 4.5 hours).
+    MIN_EXP = -20
+    MAX_EXP = 14
+    SIZE = (MAX_EXP - MIN_EXP) * PER_OCTAVE + 1
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    @classmethod
+    def bucket(cls, value):
+        if value <= 0:
+            return 0
+        i = int((math.log2(value) - cls.MIN_EXP) * cls.PER_OCTAVE) + 1
+        return min(max(i, 0), cls.SIZE - 1)
+
+    def upper_bound(self, i):
+        return 2.0 ** (self.MIN_EXP + i / self.PER_OCTAVE)
+
+    def buckets(self):
+        """ (bucket, count) of the non-empty buckets, in order. """
+        return ((i, n) for i, n in enumerate(self.counts) if n)
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile, capped at the largest value seen. """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in self.buckets():
+            seen += n
+            if seen >= rank:
+                # The last bucket also holds everything past its bound.
+                return self.max if i == self.SIZE - 1 else min(self.upper_bound(i), self.max)
+        return self.max
+
+    def to_json(self):
+        summary = {'count': self.count, 'sum': self.sum, 'max': self.max}
+        for q, name in QUANTILES.items():
+            summary[name] = self.quantile(q)
+        return summary
+
+
+class SparseHistogram(Histogram):
+    """ Same buckets and quantiles as Histogram, but only the non-empty buckets are kept: for the
+    many small histograms of a breakdown, which would otherwise each hold SIZE counters.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        i = self.bucket(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def buckets(self):
+        return sorted(self.counts.items())
+
+
+class Series:
+    def __init__(self):
+        self.latency = Histogram()
+        self.wait = Histogram()
+        self.bytes = 0
+        self.errors = 0
+
+
+class Metrics:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = Lock()
+        self.series = {}
+        self.started = time.time()
+        self.local = local()
+        self.server = None
+
+    def queued(self, seconds):
+        """ Note that the task about to run on this thread waited seconds in the pool (None: not pooled). """
+        self.local.wait = seconds
+
+    def take_wait(self):
+        """ Pool wait of the task running on this thread, for its top-level operation to record once. """
+        wait = getattr(self.local, 'wait', None)
+        self.local.wait = None
+        return wait
+
+    def observe(self, op, seconds, node=None, priority=None, nbytes=0, error=False, wait=None):
+        if not self.enabled:
+            return
+        key = (op, node, priority)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = Series()
+            series.latency.record(seconds)
+            if wait is not None:
+                series.wait.record(wait)
+            series.bytes += nbytes
+            if error:
+                series.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'uptime': time.time() - self.started,
+                'series': [{'op': op, 'node': node, 'priority': priority,
+                            'latency': series.latency.to_json(), 'wait': series.wait.to_json(),
+                            'bytes': series.bytes, 'errors': series.errors}
+                           for (op, node, priority), series in self.series.items()]
+            }
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            items = list(self.series.items())
+            summaries = [('psl_operation_seconds', 'Service time of PriorityStoreLite operations.', 'latency'),
+                         ('psl_queue_wait_seconds', 'Time tasks waited in the worker pool.', 'wait')]
+            for name, help_text, field in summaries:
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} summary'.format(name))
+                for key, series in items:
+                    histogram = getattr(series, field)
+                    if histogram.count == 0:
+                        continue
+                    labels = prometheus_labels(key)
+                    for q in QUANTILES:
+                        lines.append('{}{{{},quantile="{}"}} {}'.format(name, labels, q, histogram.quantile(q)))
+                    lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, labels, histogram.count))
+            counters = [('psl_bytes_total', 'Bytes transferred by PriorityStoreLite operations.', 'bytes'),
+                        ('psl_errors_total', 'Failed PriorityStoreLite operations.', 'errors')]
+            for name, help_text, field in counters:
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} counter'.format(name))
+                for key, series in items:
+                    lines.append('{}{{{}}} {}'.format(name, prometheus_labels(key), getattr(series, field)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Write a snapshot to path, as Prometheus text if it ends in .prom, JSON otherwise. """
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if path.endswith('.prom') else self.to_json())
+
+    def serve(self, port, host='127.0.0.1'):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = metrics.to_json(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def prometheus_labels(key):
+    op, node, priority = key
+    values = [('op', op), ('node', '' if node is None else node),
+              ('priority', '' if priority is None else str(priority))]
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for k, v in values)
+
+# End of file
@@ -0,0 +1,187 @@
+""" migrate.py
+
+Node-to-node file migration for PriorityStoreLite rebalancing.
+
+A migration streams the file's bytes from the source node into a temporary file on the
+destination, relayed through the master (the nodes need no credentials for each other), under
+per-node and global bandwidth caps. Once the checksums of both copies match, the temporary file is
+renamed into place, the metadata is flipped to the destination, and only then is the source copy
+deleted.
+
+A batch of moves is recorded in config_dir/migration.json before it starts and every completed
+move is appended to migration.done, so an interrupted placement_reassign resumes where it stopped.
+
+Author: Brian Tuan
+"""
+
+import json
+import os
+import subprocess
+import time
+from threading import Lock
+
+
+class Throttle:
+    """ Token bucket over bytes per second. A rate of 0 means unlimited. """
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.lock = Lock()
+        self.next = time.time()
+
+    def consume(self, num_bytes):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            # Unused time only carries over as up to burst seconds' worth of credit.
+            self.next = max(self.next, now - self.burst) + num_bytes / self.rate
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Migrator:
+    def __init__(self, psl, bandwidth=0, node_bandwidth=0, chunk_size=1048576):
+        self.psl = psl
+        self.chunk_size = chunk_size
+        self.node_bandwidth = node_bandwidth
+        self.throttle = Throttle(bandwidth)
+        self.node_throttles = {}
+        self.lock = Lock()
+        self.plan_path = psl.config_dir + 'migration.json'
+        self.done_path = psl.config_dir + 'migration.done'
+
+    def node_throttle(self, node):
+        with self.lock:
+            if node not in self.node_throttles:
+                self.node_throttles[node] = Throttle(self.node_bandwidth)
+            return self.node_throttles[node]
+
+    # Resumable batches
+
+    def begin(self, moves):
+        with open(self.plan_path + '.tmp', 'w') as f:
+            json.dump({'moves': moves}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.plan_path + '.tmp', self.plan_path)
+        if os.path.exists(self.done_path):
+            os.remove(self.done_path)
+
+    def pending(self):
+        """ Moves of an interrupted batch that have not completed, {} if there is none. """
+        if not os.path.exists(self.plan_path):
+            return {}
+        with open(self.plan_path, 'r') as f:
+            moves = json.load(f)['moves']
+        if os.path.exists(self.done_path):
+            with open(self.done_path, 'r') as f:
+                for line in f:
+                    moves.pop(line.rstrip('\n'), None)
+        return {filename: node_id for filename, node_id in moves.items()
+                if filename in self.psl.metadata and self.psl.metadata[filename]['node_id'] != node_id}
+
+    def completed(self, filename):
+        with self.lock:
+            with open(self.done_path, 'a') as f:
+                f.write(filename + '\n')
+
+    def finish(self):
+        for path in (self.plan_path, self.done_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Single file
+
+    def migrate(self, filename, node_id):
+        """ Move one file's primary copy to node_id. Returns True once the move is complete. """
+        psl = self.psl
+        info = psl.metadata.get(filename)
+        if info is None:
+            return False
+        if 'chunks' in info:
+            # Striped files are not re-placed as a whole.
+            return False
+        source_id = info['node_id']
+        if source_id == node_id:
+            return True
+        if node_id in psl.replicas(info):
+            # The destination already holds a copy: it simply becomes the primary.
+            with psl.file_locks(filename):
+                if filename not in psl.metadata:
+                    return False
+                psl.move_entry(filename, node_id)
+            self.completed(filename)
+            return True
+
+        source = psl.datanodes[source_id]
+        dest = psl.datanodes[node_id]
+        source_path = psl.remote_path(source, filename)
+        dest_path = psl.remote_path(dest, filename)
+        tmp_path = dest_path + '.psl-migrate'
+        if not self.copy(source, source_path, dest, tmp_path):
+            psl.execute_command(dest, 'rm -f "{}"'.format(tmp_path))
+            return False
+
+        with psl.file_locks(filename):
+            current = psl.metadata.get(filename)
+            if current is None or current['node_id'] != source_id:
+                # Deleted or moved elsewhere while it was being copied.
+                psl.execute_command(dest, 'rm -f "{}"'.format(tmp_path))
+                return False
+            if psl.execute_command(dest, 'mv "{}" "{}"'.format(tmp_path, dest_path)).returncode != 0:
+                return False
+            psl.move_entry(filename, node_id)
+        psl.commit_metadata()
+        self.completed(filename)
+        psl.execute_command(source, 'rm -f "{}"'.format(source_path))
+        return True
+
+    def copy(self, source, source_path, dest, tmp_path):
+        """ Stream source_path into tmp_path on dest and check both copies have the same checksum. """
+        transport = self.psl.transport
+        tmp_dir = tmp_path[:tmp_path.rfind('/')]
+        # Take both channels in a fixed order so opposite migrations cannot deadlock each other.
+        for node in sorted([source, dest]):
+            transport.acquire(node)
+        reader = writer = None
+        try:
+            reader = subprocess.Popen(transport.argv(source, 'cat "{}"'.format(source_path)),
+                                      stdout=subprocess.PIPE)
+            writer = subprocess.Popen(transport.argv(dest, 'mkdir -p "{}" && cat > "{}"'.format(tmp_dir, tmp_path)),
+                                      stdin=subprocess.PIPE)
+            throttles = [self.throttle, self.node_throttle(source), self.node_throttle(dest)]
+            try:
+                while True:
+                    chunk = reader.stdout.read1(self.chunk_size)
+                    if not chunk:
+                        break
+                    for throttle in throttles:
+                        throttle.consume(len(chunk))
+                    writer.stdin.write(chunk)
+                writer.stdin.close()
+            except BrokenPipeError:
+                # The destination died; its exit code reports the failure below.
+                pass
+            writer.wait()
+            reader.wait()
+        finally:
+            for proc in (reader, writer):
+                if proc is not None and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            if reader is not None:
+                reader.stdout.close()
+            for node in (source, dest):
+                transport.release(node)
+        if reader.returncode != 0 or writer.returncode != 0:
+            return False
+        expected = self.checksum(source, source_path)
+        return expected is not None and expected == self.checksum(dest, tmp_path)
+
+    def checksum(self, node, path):
+        rc = self.psl.transport.execute(node, 'cksum < "{}"'.format(path), capture=True)
+        return rc.stdout.strip() if rc.returncode == 0 else None
+
+# End of file
@@ -0,0 +1,33 @@
+""" placement.py
+
+Rank index over node effectiveness for PriorityStoreLite placement. Requires sortedcontainers
+    $ pip3 install sortedcontainers
+
+Nodes are kept ordered by decreasing effectiveness (ties by node id, which is the order the old
+full sort produced), so the node at a given rank is found in O(log n) and a node's effectiveness
+is updated in O(log n) instead of re-sorting the whole cluster on every placement.
+
+Author: Brian Tuan
+"""
+
+from sortedcontainers import SortedList
+
+
+class PlacementIndex:
+    def __init__(self, values):
+        self.values = list(values)
+        self.order = SortedList((-v, i) for i, v in enumerate(self.values))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, rank):
+        """ Node id at the given rank, 0 being the most effective node. """
+        return self.order[rank][1]
+
+    def update(self, node_id, value):
+        self.order.remove((-self.values[node_id], node_id))
+        self.values[node_id] = value
+        self.order.add((-value, node_id))
+
+# End of file
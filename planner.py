@@ -0,0 +1,88 @@
+""" planner.py
+
+Batch planner for PriorityStoreLite.placement_reassign.
+
+Produces the same moves as replaying fake_placement file by file, lowest priority tier first, but
+does the bookkeeping on NumPy arrays: the metadata is turned into priority/node/size columns once
+and the rank the greedy picks from is fixed per tier. What is left per file is one O(log n) rank
+lookup and the new effectiveness of the node it lands on, which only depends on how many files the
+plan has put there so far.
+
+Author: Brian Tuan
+"""
+
+import numpy as np
+
+from placement import PlacementIndex
+
+# The greedy plans against empty nodes of this size, whatever the configured capacities.
+PLANNING_AVAILABLE = 17179869184
+
+
+class ReassignPlan:
+    """ Files to move, as {filename: target node id}, and the number of bytes that will be copied. """
+    def __init__(self, moves, num_bytes):
+        self.moves = moves
+        self.bytes = num_bytes
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __repr__(self):
+        return "ReassignPlan({} moves, {} bytes)".format(len(self.moves), self.bytes)
+
+
+def effectiveness_after(psl, node, count, available=PLANNING_AVAILABLE):
+    """ Effectiveness of node after count placements, as effectiveness_for_node_helper computes it.
+
+    Worked out per placement rather than tabulated for every count up front, which would take
+    nodes x capacity memory.
+    """
+    # The same expression, in the same order, so the floats come out identical.
+    avg_latency = max(0.5*(psl.capacities[node] - (available - count*psl.block_size))*psl.latencies[node]
+                      / psl.block_size, psl.latencies[node])
+    return 1.0 - (avg_latency/psl.worst_latency)
+
+
+def plan_reassign(psl, available=PLANNING_AVAILABLE):
+    """ Plan against empty nodes with available bytes each (simulations of large namespaces need more). """
+    # Striped files are already spread over several nodes; only whole files are re-placed.
+    names = [filename for filename, info in psl.metadata.items() if filename != "PSL" and 'chunks' not in info]
+    count = len(names)
+    if count == 0:
+        return ReassignPlan({}, 0)
+    entries = [psl.metadata[filename] for filename in names]
+    priorities = np.fromiter((e['priority'] for e in entries), dtype=np.int64, count=count)
+    current = np.fromiter((e['node_id'] for e in entries), dtype=np.int64, count=count)
+    sizes = np.fromiter((e['size'] for e in entries), dtype=np.int64, count=count)
+
+    # Placements past this would leave a node without space, which the greedy asserts against.
+    max_count = (available - 1) // psl.block_size
+    # Before the first placement the greedy starts from 1/latency.
+    index = PlacementIndex(1.0/latency for latency in psl.latencies)
+    placed = [0] * psl.num
+    target = current.copy()
+
+    for priority in sorted(set(priorities.tolist()), reverse=True):
+        rank = psl.effective_rank(psl.num, priority)
+        rows = np.flatnonzero(priorities == priority)
+        previous = current[rows].tolist()
+        chosen = []
+        for prev in previous:
+            node = index[rank]
+            # No need to move if effectiveness is small.
+            if abs(node - prev) <= 1:
+                node = prev
+            placed[node] += 1
+            assert placed[node] <= max_count
+            index.update(node, effectiveness_after(psl, node, placed[node], available))
+            chosen.append(node)
+        target[rows] = chosen
+
+    # Same order the file-by-file greedy visits them in: by descending priority, stable.
+    order = np.argsort(-priorities, kind='stable')
+    moving = order[target[order] != current[order]]
+    moves = {names[i]: int(target[i]) for i in moving.tolist()}
+    return ReassignPlan(moves, int(sizes[moving].sum()))
+
+# End of file
@@ -0,0 +1,167 @@
+""" pool.py
+
+Long-lived worker pool for PriorityStoreLite tasks.
+
+Work is SSH-bound, so the pool is sized for I/O concurrency rather than CPU count. Submitting
+returns a concurrent.futures.Future and blocks once max_pending tasks are outstanding, which gives
+producers backpressure. Tasks tagged with a datanode are limited to node_limit running at a time
+per node: a task for a saturated node is parked and picked up by the worker that finishes that
+node's next task, so one slow node cannot hold every worker. Tasks submitted with the same serial
+key run one at a time, in the order they were submitted.
+
+Author: Brian Tuan
+"""
+
+from collections import deque
+from concurrent.futures import Future, wait
+import queue
+import time
+from threading import Condition, Lock, Semaphore, Thread
+
+
+class TaskPool:
+    def __init__(self, run, num_workers=64, max_pending=10000, node_limit=8):
+        """ run(task, stats, wait) executes one task in a worker thread; wait is how long it queued. """
+        self.run = run
+        self.node_limit = node_limit
+        self.tasks = queue.Queue()
+        self.pending = Semaphore(max_pending)
+        self.lock = Lock()
+        self.idle = Condition(self.lock)
+        self.outstanding = 0
+        self.active = {}
+        self.parked = {}
+        # serial key -> tasks submitted behind the one of that key that is queued or running.
+        self.serial = {}
+        self.closed = False
+        self.workers = []
+        for _ in range(num_workers):
+            t = Thread(target=self.worker, daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, task, node=None, stats=None, serial=None):
+        if self.closed:
+            raise RuntimeError("TaskPool is shut down")
+        self.pending.acquire()
+        future = Future()
+        item = (future, task, node, stats, time.time(), serial)
+        with self.lock:
+            self.outstanding += 1
+            if serial is not None:
+                if serial in self.serial:
+                    # Started once the previous task of this key is done.
+                    self.serial[serial].append(item)
+                    return future
+                self.serial[serial] = deque()
+        self.tasks.put(item)
+        return future
+
+    def worker(self):
+        while True:
+            item = self.tasks.get()
+            if item is None:
+                break
+            while item is not None:
+                node = item[2]
+                if node is not None:
+                    with self.lock:
+                        if self.active.get(node, 0) >= self.node_limit:
+                            self.parked.setdefault(node, deque()).append(item)
+                            break
+                        self.active[node] = self.active.get(node, 0) + 1
+                self.execute(*item)
+                item = None
+                if node is not None:
+                    with self.lock:
+                        self.active[node] -= 1
+                        if self.parked.get(node):
+                            item = self.parked[node].popleft()
+
+    def execute(self, future, task, node, stats, submitted, serial=None):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.run(task, stats, time.time() - submitted))
+                except BaseException as e:
+                    future.set_exception(e)
+        finally:
+            self.pending.release()
+            following = None
+            with self.lock:
+                self.outstanding -= 1
+                if self.outstanding == 0:
+                    self.idle.notify_all()
+                if serial is not None:
+                    if self.serial[serial]:
+                        following = self.serial[serial].popleft()
+                    else:
+                        del self.serial[serial]
+            if following is not None:
+                self.tasks.put(following)
+
+    def join(self):
+        """ Block until every submitted task has finished. """
+        with self.lock:
+            while self.outstanding > 0:
+                self.idle.wait()
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        self.closed = True
+        if cancel_pending:
+            with self.lock:
+                parked = [item for items in self.parked.values() for item in items]
+                self.parked.clear()
+                for items in self.serial.values():
+                    # Only the queued or running task of a key releases it.
+                    parked.extend(item[:-1] + (None,) for item in items)
+                    items.clear()
+            while True:
+                try:
+                    item = self.tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    parked.append(item)
+            for item in parked:
+                item[0].cancel()
+                self.execute(*item)
+        if wait:
+            self.join()
+        for _ in self.workers:
+            self.tasks.put(None)
+        if wait:
+            for t in self.workers:
+                t.join()
+
+
+class TaskBatch:
+    """ Handle on the tasks of one submit_tasks call. """
+    def __init__(self, size):
+        self.futures = []
+        self.results = [None] * size
+
+    def add(self, future, index=None):
+        """ Track future; if index is given its result becomes results[index]. """
+        self.futures.append(future)
+        if index is not None:
+            future.add_done_callback(lambda f: self.set_result(index, f))
+
+    def set_result(self, index, future):
+        if not future.cancelled() and future.exception() is None:
+            self.results[index] = future.result()
+
+    def wait(self, timeout=None):
+        """ Wait for every task, returns True if all of them finished in time. """
+        _, not_done = wait(self.futures, timeout=timeout)
+        return len(not_done) == 0
+
+    def cancel(self):
+        """ Cancel the tasks that have not started yet. """
+        return sum(1 for f in self.futures if f.cancel())
+
+    def errors(self):
+        return [f.exception() for f in self.futures
+                if f.done() and not f.cancelled() and f.exception() is not None]
+
+# End of file
@@ -0,0 +1,108 @@
+""" prober.py
+
+Background prober measuring each datanode's round-trip time and transfer bandwidth.
+
+Every interval seconds each node runs a no-op (RTT) and streams probe_bytes of zeros back to the
+master (bandwidth). Both are smoothed per node (EWMA, plus a window for percentiles) and turned
+into the node's latency: the expected time to read one block. PriorityStoreLite.update_latencies
+then re-scores the nodes for placement, so placement follows the nodes as their performance drifts.
+
+The configured latencies are relative weights, not seconds, and placement compares nodes against
+each other: the measured ones replace them all at once, after a round in which every node has been
+measured at least once, never one node at a time. Until then, the configured ones stay in use.
+
+Author: Brian Tuan
+"""
+
+import time
+from threading import Event, Thread
+
+from latency import LatencyTracker
+
+
+class NodeProber:
+    def __init__(self, psl, interval=60, probe_bytes=4194304):
+        self.psl = psl
+        self.interval = interval
+        self.probe_bytes = probe_bytes
+        self.rtt = LatencyTracker()
+        self.bandwidth = LatencyTracker()
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.probe_all()
+            self.stopped.wait(self.interval)
+
+    def probe_all(self):
+        for node_id in range(self.psl.num):
+            if self.stopped.is_set():
+                return
+            try:
+                self.probe(node_id)
+            except OSError as e:
+                if self.psl.verbose:
+                    print("Probing node", node_id, "failed:", e)
+        unmeasured = [node_id for node_id in range(self.psl.num)
+                      if self.rtt.estimate(node_id) is None or self.bandwidth.estimate(node_id) is None]
+        if unmeasured:
+            if self.psl.verbose:
+                print("Keeping the configured latencies: never measured nodes", unmeasured)
+            return
+        # A node that failed this round keeps its last estimate.
+        self.psl.update_latencies([self.block_latency(node_id) for node_id in range(self.psl.num)])
+
+    def probe(self, node_id):
+        node = self.psl.datanodes[node_id]
+        transport = self.psl.transport
+
+        if node not in transport.last_used:
+            # The first operation opens the node's session (an SSH ControlMaster): not part of the RTT.
+            transport.execute(node, 'true')
+        start = time.time()
+        if transport.execute(node, 'true').returncode != 0:
+            return
+        rtt = time.time() - start
+
+        start = time.time()
+        proc = transport.open(node, 'head -c {} </dev/zero'.format(self.probe_bytes))
+        try:
+            received = 0
+            while True:
+                chunk = proc.stdout.read1(1048576)
+                if not chunk:
+                    break
+                received += len(chunk)
+            proc.wait()
+        finally:
+            proc.stdout.close()
+            transport.release(node)
+        elapsed = time.time() - start
+        if proc.returncode != 0 or received == 0:
+            return
+
+        self.rtt.record(node_id, rtt)
+        self.bandwidth.record(node_id, received / max(elapsed - rtt, 1e-6))
+
+    def block_latency(self, node_id):
+        """ Expected seconds to read one block from the node. """
+        return self.rtt.estimate(node_id) + self.psl.block_size / self.bandwidth.estimate(node_id)
+
+    def to_json(self):
+        return {'rtt': self.rtt.to_json(), 'bandwidth': self.bandwidth.to_json()}
+
+    def load_json(self, data):
+        self.rtt.load_json(data.get('rtt', {}))
+        self.bandwidth.load_json(data.get('bandwidth', {}))
+
+# End of file
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+""" replay.py
+
+Replays a trace of file operations through the PriorityStoreLite API and reports the achieved
+throughput and latency percentiles, to compare placement policies on real access patterns.
+
+A trace is a JSONL file with one operation per line, in time order:
+
+    {"time": 0.000, "op": "put", "file": "logs/a.psl", "size": 1048576, "priority": 1}
+    {"time": 0.250, "op": "get", "file": "logs/a.psl"}
+    {"time": 1.500, "op": "del", "file": "logs/a.psl"}
+
+time is in seconds (any origin), size and priority are optional. Puts create files of that size, like
+the simulation does; gets are read to /dev/null. The trace is streamed, never loaded whole.
+
+Two modes:
+
+    open      operations start at their trace time (divided by --speed), however long earlier ones
+              take, on up to --concurrency threads; latency is measured from the scheduled start,
+              so a backlog shows up in the latencies instead of slowing the arrivals down.
+    closed    --concurrency threads issue the operations back to back, as fast as the store
+              answers; time is ignored.
+
+    $ ./replay.py trace.jsonl -d config --mode open --speed 10 -o replay.json
+
+Operations go to an in-process PriorityStoreLite, or with --daemon to the running master daemon.
+
+Author: Brian Tuan
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+from threading import Lock, Semaphore, Thread
+
+import click
+
+from client import connect
+from metrics import Histogram
+
+OPS = ('put', 'get', 'del')
+
+
+def read_trace(path):
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if record.get('op') not in OPS or 'file' not in record:
+                raise ValueError("{}:{}: not a put, get or del of a file: {}".format(path, n, line))
+            yield record
+
+
+class Replayer:
+    def __init__(self, psl, concurrency=16):
+        self.psl = psl
+        self.concurrency = concurrency
+        self.lock = Lock()
+        self.latency = {op: Histogram() for op in OPS}
+        # Per op: completed, failed, and no-ops (put of an existing file, get or del of a missing one).
+        self.outcomes = {op: {'ok': 0, 'error': 0, 'missing': 0} for op in OPS}
+        self.lag = 0.0
+        self.elapsed = None
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'put':
+            kwargs = {key: record[key] for key in ('size', 'priority') if key in record}
+            return self.psl.create_file(record['file'], **kwargs)
+        if op == 'get':
+            return self.psl.retrieve_file(record['file'], output='/dev/null')
+        return self.psl.delete_file(record['file'])
+
+    def run_one(self, record, start):
+        try:
+            rc = self.apply(record)
+            outcome = 'missing' if rc is None else 'ok' if rc.returncode == 0 else 'error'
+        except Exception:
+            outcome = 'error'
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.latency[record['op']].record(latency)
+            self.outcomes[record['op']][outcome] += 1
+
+    def open_loop(self, records, speed=1.0, max_pending=10000):
+        started = time.perf_counter()
+        origin = None
+        slots = Semaphore(max_pending)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for record in records:
+                if origin is None:
+                    origin = record['time']
+                start = started + (record['time'] - origin) / speed
+                delay = start - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.lag = max(self.lag, -delay)
+                slots.acquire()
+                future = executor.submit(self.run_one, record, start)
+                future.add_done_callback(lambda _: slots.release())
+        self.elapsed = time.perf_counter() - started
+
+    def closed_loop(self, records):
+        started = time.perf_counter()
+        records = iter(records)
+        lock = Lock()
+        def worker():
+            while True:
+                with lock:
+                    record = next(records, None)
+                if record is None:
+                    return
+                self.run_one(record, time.perf_counter())
+        threads = [Thread(target=worker) for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - started
+
+    def report(self):
+        total = sum(sum(outcomes.values()) for outcomes in self.outcomes.values())
+        result = {
+            'operations': total,
+            'seconds': self.elapsed,
+            'throughput': total / self.elapsed if self.elapsed else None,
+            'max_dispatch_lag': self.lag,
+            'ops': {}
+        }
+        for op in OPS:
+            if self.latency[op].count:
+                result['ops'][op] = dict(self.latency[op].to_json(), **self.outcomes[op])
+        return result
+
+
+@click.command()
+@click.argument("trace")
+@click.option("-d", "--config_dir", help="Path to directory containing configuration files.")
+@click.option("--mode", type=click.Choice(['open', 'closed']), default='open', help="Open- or closed-loop replay.")
+@click.option("--speed", default=1.0, help="Open loop: replay this many times faster than the trace.")
+@click.option("-c", "--concurrency", default=16, help="Operations in flight at once.")
+@click.option("--daemon", is_flag=True, help="Send the operations to the running master daemon.")
+@click.option("-o", "--output", help="Also write the report to this JSON file.")
+def run(trace, config_dir, mode, speed, concurrency, daemon, output):
+    if not config_dir:
+        config_dir = "config"
+    if daemon:
+        psl = connect(config_dir)
+        if psl is None:
+            raise click.ClickException("No master daemon is running for {}".format(config_dir))
+    else:
+        from api import PriorityStoreLite
+        psl = PriorityStoreLite(config_dir)
+    replayer = Replayer(psl, concurrency=concurrency)
+    try:
+        if mode == 'open':
+            replayer.open_loop(read_trace(trace), speed=speed)
+        else:
+            replayer.closed_loop(read_trace(trace))
+    finally:
+        if not daemon:
+            psl.close()
+    result = replayer.report()
+    print("{} operations in {:.2f} s: {:.1f} ops/s".format(result['operations'], result['seconds'],
+                                                          result['throughput'] or 0.0))
+    for op, value in result['ops'].items():
+        print("{:<4} p50 {:.4f} p99 {:.4f} p999 {:.4f} s   ok {} error {} missing {}".format(
+            op, value['p50'], value['p99'], value['p999'], value['ok'], value['error'], value['missing']))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
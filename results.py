@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+""" results.py
+
+Simulation results as an append-only stream of events, one JSON object per line.
+
+The first line describes the run; every access then adds one event as it completes:
+
+    {"event": "start", "time": 1760000000.0, "config": {...}}
+    {"event": "read", "step": 12, "time": 12.4, "file": "87.psl", "priority": 2, "node": 3, "latency": 0.021}
+
+While the simulation runs, a ResultStream keeps running aggregates (a latency histogram per
+priority, and count, sum and max per priority for the latest steps) that are updated once per event
+and do not grow with the length of the run. After the run, summarize_stream reads the stream back
+and computes per-priority and per-step latency percentiles:
+
+    $ ./results.py sim_output.jsonl -o summary.json
+
+Percentiles come from the log-bucketed histograms of metrics.py, so they are within ~9%.
+
+Author: Brian Tuan
+"""
+
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import click
+
+from metrics import Histogram, SparseHistogram
+
+# Steps of per-step running aggregates kept for progress reports.
+RECENT_STEPS = 60
+
+
+class Running:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def to_json(self):
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else None, 'max': self.max}
+
+
+class ResultStream:
+    """ Appends read events to path and keeps running aggregates of them.
+
+    Can be passed as the stats of submit_tasks: pool workers call record for every task with a step.
+    Reads from an odd datanode get latency_diff added, like the live simulation's slower nodes.
+    """
+    def __init__(self, path, psl, latency_diff=0.0, config=None):
+        self.path = path
+        self.psl = psl
+        self.latency_diff = latency_diff
+        self.lock = Lock()
+        self.file = open(path, 'w')
+        self.total = 0
+        self.priorities = {}
+        self.steps = OrderedDict()
+        self.file.write(json.dumps({'event': 'start', 'time': time.time(), 'config': config}) + '\n')
+
+    def record(self, step, filename, latency, at=None):
+        info = self.psl.metadata.get(filename)
+        if info is None:
+            return
+        node_id = info['node_id']
+        if self.latency_diff and node_id % 2 != 0:
+            latency += self.latency_diff
+        priority = info['priority']
+        event = {'event': 'read', 'step': step, 'time': time.time() if at is None else at, 'file': filename,
+                 'priority': priority, 'node': node_id, 'latency': latency}
+        line = json.dumps(event) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.total += 1
+            histogram = self.priorities.get(priority)
+            if histogram is None:
+                histogram = self.priorities[priority] = Histogram()
+            histogram.record(latency)
+            if step not in self.steps:
+                self.steps[step] = {}
+                while len(self.steps) > RECENT_STEPS:
+                    self.steps.popitem(last=False)
+            per_step = self.steps[step]
+            if priority not in per_step:
+                per_step[priority] = Running()
+            per_step[priority].add(latency)
+
+    def progress(self):
+        """ Running aggregates so far: per priority, and per priority for the latest steps. """
+        with self.lock:
+            return {
+                'events': self.total,
+                'priorities': {p: h.to_json() for p, h in sorted(self.priorities.items())},
+                'steps': {step: {p: r.to_json() for p, r in sorted(per_step.items())}
+                          for step, per_step in self.steps.items()}
+            }
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def summarize_stream(path):
+    """ Per-priority and per-step latency percentiles of the read events in the stream at path. """
+    priorities = {}
+    steps = {}
+    for event in read_events(path):
+        if event.get('event') != 'read':
+            continue
+        priority = event['priority']
+        if priority not in priorities:
+            priorities[priority] = Histogram()
+        priorities[priority].record(event['latency'])
+        per_step = steps.setdefault(event['step'], {})
+        if priority not in per_step:
+            # Thousands of these on a long run: a full Histogram each would take hundreds of MB.
+            per_step[priority] = SparseHistogram()
+        per_step[priority].record(event['latency'])
+    return {
+        'priorities': {p: summary(h) for p, h in sorted(priorities.items())},
+        'steps': {step: {p: summary(h) for p, h in sorted(per_step.items())}
+                  for step, per_step in sorted(steps.items())}
+    }
+
+
+def summary(histogram):
+    result = histogram.to_json()
+    result['mean'] = histogram.sum / histogram.count if histogram.count else None
+    return result
+
+
+def print_summary(result, details=True):
+    for pr, value in result['priorities'].items():
+        print("Priority", pr, "mean %0.3f p50 %0.3f p99 %0.3f p999 %0.3f" % (
+            value['mean'], value['p50'], value['p99'], value['p999']), " with # {} files".format(value['count']))
+    print()
+    if details:
+        for step, info in result['steps'].items():
+            for pr, value in info.items():
+                print("Step", step, " for priority ", pr, " mean %0.3f p50 %0.3f p99 %0.3f" % (
+                    value['mean'], value['p50'], value['p99']), " with # {} files".format(value['count']))
+            print()
+
+
+@click.command()
+@click.argument("path")
+@click.option("-o", "--output", help="Also write the summary to this JSON file.")
+@click.option("--details/--no-details", default=False, help="Print the per-step percentiles too.")
+def run(path, output, details):
+    result = summarize_stream(path)
+    print_summary(result, details)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,163 @@
+""" simcluster.py
+
+Simulated cluster backend for offline PriorityStoreLite simulations.
+
+Nothing is transferred: every datanode is a SimNode serving reads from a FIFO queue with a fixed
+number of channels, each read taking a round trip plus size/bandwidth, both drawn from the node's
+distributions. Time is virtual and advanced by a VirtualClock, a discrete-event loop, so a day of
+accesses runs as fast as the events can be processed.
+
+A distribution is given in simulation.json either as a number (constant) or as a dict:
+
+    {"dist": "constant", "value": 0.02}
+    {"dist": "uniform", "low": 0.01, "high": 0.03}
+    {"dist": "normal", "mean": 0.02, "std": 0.005}         (clipped at 0)
+    {"dist": "lognormal", "mean": 0.02, "sigma": 0.5}
+    {"dist": "exponential", "mean": 0.02}
+
+Author: Brian Tuan
+"""
+
+import heapq
+
+import numpy as np
+
+# A 1 Gbit/s link, with a few milliseconds of round trip.
+DEFAULT_RTT = {"dist": "lognormal", "mean": 0.005, "sigma": 0.5}
+DEFAULT_BANDWIDTH = {"dist": "normal", "mean": 125000000, "std": 12500000}
+
+
+def make_distribution(spec):
+    """ Function (rng, n) -> n samples of the distribution described by spec. """
+    if not isinstance(spec, dict):
+        return lambda rng, n: np.full(n, float(spec))
+    dist = spec['dist']
+    if dist == 'constant':
+        return lambda rng, n: np.full(n, float(spec['value']))
+    if dist == 'uniform':
+        return lambda rng, n: rng.uniform(spec['low'], spec['high'], n)
+    if dist == 'normal':
+        return lambda rng, n: np.maximum(rng.normal(spec['mean'], spec['std'], n), 0.0)
+    if dist == 'lognormal':
+        # Parameterized by its mean rather than the mean of the underlying normal.
+        mu = np.log(spec['mean']) - spec['sigma']**2 / 2
+        return lambda rng, n: rng.lognormal(mu, spec['sigma'], n)
+    if dist == 'exponential':
+        return lambda rng, n: rng.exponential(spec['mean'], n)
+    raise ValueError("Unknown distribution: {}".format(dist))
+
+
+def scale_distribution(spec, factor):
+    """ spec with every location parameter multiplied by factor. """
+    if not isinstance(spec, dict):
+        return float(spec) * factor
+    scaled = dict(spec)
+    for key in ('value', 'low', 'high', 'mean', 'std'):
+        if key in scaled:
+            scaled[key] *= factor
+    return scaled
+
+
+class Sampler:
+    """ Draws samples one at a time from a distribution, generating them in batches. """
+    def __init__(self, spec, rng, batch=4096):
+        self.draw = make_distribution(spec)
+        self.rng = rng
+        self.batch = batch
+        self.samples = []
+
+    def __call__(self):
+        if not self.samples:
+            self.samples = self.draw(self.rng, self.batch).tolist()
+        return self.samples.pop()
+
+    def mean(self, n=100000):
+        return float(self.draw(self.rng, n).mean())
+
+
+class VirtualClock:
+    """ Discrete-event loop: callbacks run in timestamp order and now jumps from one to the next. """
+    def __init__(self):
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+
+    def schedule(self, at, callback, *args):
+        # seq keeps events with equal timestamps in scheduling order.
+        heapq.heappush(self.events, (at, self.seq, callback, args))
+        self.seq += 1
+
+    def every(self, interval, callback, start=None):
+        """ Run callback every interval seconds, starting at start (default now + interval). """
+        def tick():
+            callback()
+            self.schedule(self.now + interval, tick)
+        self.schedule(self.now + interval if start is None else start, tick)
+
+    def run(self, until=None):
+        while self.events and (until is None or self.events[0][0] <= until):
+            at, _, callback, args = heapq.heappop(self.events)
+            self.now = at
+            callback(*args)
+        if until is not None:
+            self.now = max(self.now, until)
+
+
+class SimNode:
+    def __init__(self, rtt, bandwidth, rng, channels=8):
+        self.rtt = Sampler(rtt, rng)
+        self.bandwidth = Sampler(bandwidth, rng)
+        # When each channel is next free.
+        self.free = [0.0] * channels
+        self.served = 0
+        self.busy = 0.0
+
+    def serve(self, arrival, size):
+        """ Queue a read of size bytes arriving at arrival. Returns when it completes. """
+        service = self.rtt() + size / max(self.bandwidth(), 1.0)
+        finish = max(arrival, self.free[0]) + service
+        heapq.heapreplace(self.free, finish)
+        self.served += 1
+        self.busy += service
+        return finish
+
+    def expected_latency(self, size):
+        return self.rtt.mean() + size / self.bandwidth.mean()
+
+
+class SimCluster:
+    """ num_nodes SimNodes configured from the "cluster" section of simulation.json.
+
+    Keys: "nodes", a list of per-node {"rtt", "bandwidth", "channels"} overrides, and "rtt",
+    "bandwidth", "channels" as the defaults for every node. Without per-node settings, every other
+    node is slower by latency_difference, like the live simulation sets up its latencies.
+    """
+    def __init__(self, config, num_nodes, latency_difference=0.0, seed=None):
+        self.rng = np.random.default_rng(seed)
+        rtt = config.get('rtt', DEFAULT_RTT)
+        bandwidth = config.get('bandwidth', DEFAULT_BANDWIDTH)
+        channels = config.get('channels', 8)
+        overrides = config.get('nodes', [])
+        self.nodes = []
+        for i in range(num_nodes):
+            if i < len(overrides):
+                spec = overrides[i]
+                node = SimNode(spec.get('rtt', rtt), spec.get('bandwidth', bandwidth), self.rng,
+                               channels=spec.get('channels', channels))
+            elif not overrides and i % 2 == 0:
+                slow = 1.0 + latency_difference
+                node = SimNode(scale_distribution(rtt, slow), scale_distribution(bandwidth, 1.0/slow),
+                               self.rng, channels=channels)
+            else:
+                node = SimNode(rtt, bandwidth, self.rng, channels=channels)
+            self.nodes.append(node)
+
+    def latencies(self, block_size):
+        """ Expected seconds to read one block from each node, for placement. """
+        return [node.expected_latency(block_size) for node in self.nodes]
+
+    def read(self, pieces, arrival):
+        """ Latency of a read fetching (node id, size) pieces in parallel, arriving at arrival. """
+        return max(self.nodes[node_id].serve(arrival, size) for node_id, size in pieces) - arrival
+
+# End of file
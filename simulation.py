@@ -2,18 +2,33 @@
 
 Simulates a workload on a PriorityStoreLite cluster.
 
-Outputs node statistics as they are available.
+Outputs node statistics as they are available. Every access is appended to output_path as it
+completes (see results.py); once the run is over, per-priority and per-step latency percentiles are
+printed and saved to <output_path without extension>_summary.json.
+
+With --offline the workload runs against a simulated cluster (see simcluster.py) in virtual time:
+placement and metadata go through the real PriorityStoreLite code, but reads are served by
+simulated nodes and no step waits for the wall clock. The "cluster" section of simulation.json
+configures the simulated nodes, "capacity" their size (default: room for twice the files), and
+"reassign_interval" how often, in virtual seconds, placement_reassign runs (default: only once, up
+front, like the live simulation).
 
 Author: Brian Tuan
 """
 
 import click
 import json
+import os
+import shutil
+import tempfile
 import time
 import sys
 
 from api import PriorityStoreLite, FILE_FREQUENCY, ACCESS_FREQUENCY
+from planner import plan_reassign
 from random import random, randrange
+from results import ResultStream, print_summary, summarize_stream
+from simcluster import SimCluster, VirtualClock
 
 """ ACCESS DISTRIBUTION WITH RESPECT TO FILE PRIORITY 
 PRIORITY LEVELS:
@@ -29,18 +44,10 @@ def load_configs(config_dir):
         config = json.load(f)
     return config
 
-def init_key(ddict, key):
-    if key not in ddict:
-        ddict[key] = {}
-        ddict[key]["latency"] = 0.0
-        ddict[key]["counter"] = 0
-    return
-
 def draw_access_sample(psl, num_files):
-    files_hi = [k for k, v in psl.metadata.items() if k != "PSL" and v['priority'] == 0]
-    files_med = [k for k, v in psl.metadata.items() if k != "PSL" and v['priority'] == 1]
-    files_lo = [k for k, v in psl.metadata.items() if k != "PSL" and v['priority'] == 2]
-    files = files_hi + files_med + files_lo
+    files_hi = psl.index.files_with_priority(0)
+    files_med = psl.index.files_with_priority(1)
+    files_lo = psl.index.files_with_priority(2)
 
     file_list = []
     for _ in range(num_files):
@@ -52,6 +59,7 @@ def draw_access_sample(psl, num_files):
         elif len(files_lo) > 0:
             file_list.append(files_lo[randrange(len(files_lo))])
         else:
+            files = files_hi + files_med + files_lo
             file_list.append(files[randrange(len(files))])
 
     return file_list
@@ -83,146 +91,201 @@ def simulate(config_dir, output_path, verbose):
     verbose = True
     config = load_configs(config_dir)
     psl = PriorityStoreLite(config_dir, verbose=verbose)
-     
-    # Initialize filesystem
-    # First, delete all files that are currently in this PSL instance (synchronous).
-    task_list = []
-    if verbose:
-        print("PSL simulation beginning. Deleting all files currently in system.")
-    files = psl.list_files()
-    for filename in files.keys():
-        task_list.append((psl.delete_file, [filename], {'persist': False}))
-    psl.submit_tasks(task_list, block=True)
-    psl.persist_metadata()
-    # Reset PSL metadata
-    del psl.metadata["PSL"]
-    psl.setup_system_info()
-    # Determine current latencies of the datanodes
-    set_bottomline_latency(psl, config)
-    print()
-
-    # Next, populate PSL with simulation files (synchronous).
-    file_size = config['size_per_file'] if 'size_per_file' in config else None
-    if verbose:
-        print("Creating PSL simulation files, each of size {}.".format(file_size))
-    task_list = []
-    for i in range(config['num_files']):
-        num = random()
-        if num < FILE_FREQUENCY[0]:
-            priority = 0
-        elif num < FILE_FREQUENCY[0] + FILE_FREQUENCY[1]:
-            priority = 1
-        else:
-            priority = 2
-
-        filename = '{}.psl'.format(i)
-        if file_size is not None:
-            task_list.append((psl.create_file, [filename], {'size': file_size, 'persist': False, 'priority': priority}))
-        else:
-            task_list.append((psl.create_file, [filename], {'persist': False, 'priority': priority}))
-    psl.submit_tasks(task_list, block=True)
-    psl.persist_metadata()
-    psl.print_stats()
-    print()
-
-    if verbose:
-        print("Re-assigning blocks")
-    psl.placement_reassign()
-    psl.print_stats()
-    print()
+    try:
+        # Initialize filesystem
+        # First, delete all files that are currently in this PSL instance (synchronous).
+        task_list = []
+        if verbose:
+            print("PSL simulation beginning. Deleting all files currently in system.")
+        files = psl.list_files()
+        for filename in files.keys():
+            task_list.append((psl.delete_file, [filename], {'persist': False}))
+        psl.submit_tasks(task_list, block=True)
+        psl.persist_metadata()
+        # Reset PSL metadata
+        del psl.metadata["PSL"]
+        psl.setup_system_info()
+        # Determine current latencies of the datanodes
+        set_bottomline_latency(psl, config)
+        print()
 
-    # Access a file per second
-    stats = {}
-    if verbose:
-        print("Simulating file accesses.")
-    for i in range(config['duration']):
+        # Next, populate PSL with simulation files (synchronous).
+        file_size = config['size_per_file'] if 'size_per_file' in config else None
         if verbose:
-            print("Time step", i)
-        stats[i] = {}
-        file_list = draw_access_sample(psl, config['accesses_per_second'])
-        task_list = [(psl.retrieve_file, [name], {'output': '/dev/null', 'step' : i}) for name in file_list]
-        psl.submit_tasks(task_list, stats=stats)
-        time.sleep(1)
-        if i % 10 == 0:
-            #with open('stats.json', 'w') as f:
-            #    json.dump(stats, f)
-            print("Step stats", stats)
+            print("Creating PSL simulation files, each of size {}.".format(file_size))
+        task_list = []
+        for i in range(config['num_files']):
+            num = random()
+            if num < FILE_FREQUENCY[0]:
+                priority = 0
+            elif num < FILE_FREQUENCY[0] + FILE_FREQUENCY[1]:
+                priority = 1
+            else:
+                priority = 2
+
+            filename = '{}.psl'.format(i)
+            if file_size is not None:
+                task_list.append((psl.create_file, [filename], {'size': file_size, 'persist': False, 'priority': priority}))
+            else:
+                task_list.append((psl.create_file, [filename], {'persist': False, 'priority': priority}))
+        psl.submit_tasks(task_list, block=True)
+        psl.persist_metadata()
+        psl.print_stats()
         print()
 
-    # wait until all processed finish
-    num_retrieved_files = sum([len(v) for step, v in stats.items()])
-    while num_retrieved_files < config['duration'] * config['accesses_per_second'] - 2:
-        time.sleep(10)
-        num_retrieved_files = sum([len(v) for step, v in stats.items()]) 
-        #if len(stats[config['duration'] - 1]) > config['accesses_per_second']/2.0:
-        #    break
-    
-        with open('stats.json', 'w') as f:
-            json.dump(stats, f)
+        if verbose:
+            print("Re-assigning blocks")
+        psl.placement_reassign()
+        psl.print_stats()
+        print()
 
+        # Access a file per second
+        results = ResultStream(output_path, psl, latency_diff=psl.latency_diff, config=config)
         if verbose:
-            print("Stats", stats)
-            file_stats = {}
-            priority_stats = {}
-            priority_stats_per_step = {}
-            for step, value in stats.items():
-                priority_stats_per_step[step] = {}
-                for filename, l in value.items():
-                    latency = l
-                    if psl.metadata[filename]["node_id"] % 2 != 0:
-                        # adding default latency difference
-                        latency += psl.latency_diff
-                    pr = psl.metadata[filename]['priority']
-                    init_key(priority_stats, pr)
-                    priority_stats[pr]["latency"] += latency
-                    priority_stats[pr]["counter"] += 1
-                    # Add statistics on files
-                    init_key(file_stats, filename)
-                    file_stats[filename]["latency"] += latency
-                    file_stats[filename]["counter"] += 1
-                    # Add statistics per step
-                    init_key(priority_stats_per_step[step], pr)
-                    priority_stats_per_step[step][pr]["latency"] += latency
-                    priority_stats_per_step[step][pr]["counter"] += 1
-
-            # Save again, now that we've updated the latencies
-            with open('stats.json', 'w') as f:
-                json.dump(stats, f)
-            with open('file_stats.json', 'w') as f:
-                json.dump(file_stats, f)
-            with open('priority_stats.json', 'w') as f:
-                json.dump(priority_stats, f)
-            with open('priority_stats_per_step.json', 'w') as f:
-                json.dump(priority_stats_per_step, f)
+            print("Simulating file accesses.")
+        for i in range(config['duration']):
+            if verbose:
+                print("Time step", i)
+            file_list = draw_access_sample(psl, config['accesses_per_second'])
+            task_list = [(psl.retrieve_file, [name], {'output': '/dev/null', 'step' : i}) for name in file_list]
+            psl.submit_tasks(task_list, stats=results)
+            time.sleep(1)
+            if i % 10 == 0:
+                print("Step stats", results.progress())
+            print()
 
+        # wait until all processed finish
+        while results.total < config['duration'] * config['accesses_per_second'] - 2:
+            time.sleep(10)
+            if verbose:
+                print("Stats", results.progress())
+        results.close()
+        if verbose:
             psl.print_stats()
+        report(output_path, details=verbose)
+
+        print ("DONNNNEEEEEEE ****")
+    finally:
+        psl.close()
+
+def report(output_path, details=True):
+    """ Print the percentiles of the results at output_path and save them next to it. """
+    result = summarize_stream(output_path)
+    with open(os.path.splitext(output_path)[0] + '_summary.json', 'w') as f:
+        json.dump(result, f, indent=2)
+    print_summary(result, details)
+
+
+def draw_priority():
+    num = random()
+    if num < FILE_FREQUENCY[0]:
+        return 0
+    elif num < FILE_FREQUENCY[0] + FILE_FREQUENCY[1]:
+        return 1
+    return 2
+
+def scratch_store(num_nodes, **config):
+    """ PriorityStoreLite over a scratch directory with num_nodes placeholder datanodes.
+
+    Nothing is ever sent to the nodes. Returns the store and the directory, for the caller to remove.
+    """
+    scratch = tempfile.mkdtemp(prefix='psl-sim-')
+    with open(os.path.join(scratch, 'config.json'), 'w') as f:
+        json.dump(dict({'path': '/psl/', 'transport': 'local', 'local_root': os.path.join(scratch, 'nodes')},
+                       **config), f)
+    with open(os.path.join(scratch, 'datanodes.json'), 'w') as f:
+        json.dump({'nodelist': ['sim{}'.format(i) for i in range(num_nodes)]}, f)
+    with open(os.path.join(scratch, 'metadata.json'), 'w') as f:
+        json.dump({}, f)
+    return PriorityStoreLite(scratch), scratch
+
+def offline_store(config_dir, config):
+    """ Scratch store with one placeholder datanode per simulated node. """
+    with open(config_dir + 'datanodes.json', 'r') as f:
+        num_nodes = config.get('cluster', {}).get('num_nodes', len(json.load(f)['nodelist']))
+    # The metadata is thrown away at the end: no need to journal it.
+    return scratch_store(num_nodes, journal=False)
+
+def offline_reassign(psl, capacity):
+    plan = plan_reassign(psl, available=capacity)
+    print("Placement reassign: Need to move %d (%d bytes)" % (len(plan), plan.bytes))
+    for filename, node_id in plan.moves.items():
+        psl.move_entry(filename, node_id)
+    return plan
+
+def offline_read(psl, cluster, filename, arrival):
+    info = psl.metadata[filename]
+    if 'chunks' in info:
+        pieces = [(node_id, size) for node_id, _, size in psl.copies(filename, info)]
+    else:
+        pieces = [(psl.replica_order(info)[0], info['size'])]
+    return cluster.read(pieces, arrival)
+
+def simulate_offline(config_dir, output_path, verbose):
+    """ The simulate() workload against a simulated cluster, in virtual time. """
+    config_dir = config_dir + '/' if config_dir[-1] != '/' else config_dir
+    config = load_configs(config_dir)
+    psl, scratch = offline_store(config_dir, config)
+    started = time.time()
+    try:
+        cluster = SimCluster(config.get('cluster', {}), psl.num,
+                             latency_difference=config.get('latency_difference', 0.0), seed=config.get('seed'))
+        file_size = config.get('size_per_file', psl.block_size)
+        capacity = config.get('capacity', max(psl.capacities[0],
+                                              2 * config['num_files'] * file_size // psl.num))
+        psl.capacities = [capacity] * psl.num
+        psl.available = [capacity] * psl.num
+        psl.latencies = cluster.latencies(psl.block_size)
+        psl.recompute_effectiveness()
+        if verbose:
+            print("Simulated node latencies are", psl.latencies)
 
-            # And finally...
-            for filename, value in file_stats.items():
-                print(filename, psl.metadata[filename]['priority'], "%0.3f" % (value["latency"]/value["counter"]))
-            print()
-            for pr, value in priority_stats.items():
-                print("Priority", pr, 
-                      "%0.3f" % (value["latency"]/value["counter"]), " with # {} files".format(value["counter"]))
-            print()
-            for step, info in priority_stats_per_step.items():
-                for pr, value in info.items():
-                    print("Step", step, " for priority ", pr, 
-                          " %0.3f" % (value["latency"]/value["counter"]), " with # {} files".format(value["counter"]))
-                print()
-            print()
-
-    print ("DONNNNEEEEEEE ****")
+        if verbose:
+            print("Creating {} simulated files, each of size {}.".format(config['num_files'], file_size))
+        for i in range(config['num_files']):
+            filename = '{}.psl'.format(i)
+            psl.add_entry(filename, psl.place_entry(filename, file_size, priority=draw_priority()))
+        if verbose:
+            print("Re-assigning blocks")
+        offline_reassign(psl, capacity)
+
+        clock = VirtualClock()
+        results = ResultStream(output_path, psl, config=config)
+        def step(i):
+            file_list = draw_access_sample(psl, config['accesses_per_second'])
+            # Accesses arrive spread over the second, in order.
+            offsets = sorted(random() for _ in file_list)
+            for filename, offset in zip(file_list, offsets):
+                at = clock.now + offset
+                results.record(i, filename, offline_read(psl, cluster, filename, at), at=at)
+        for i in range(config['duration']):
+            clock.schedule(i, step, i)
+        if config.get('reassign_interval', 0) > 0:
+            clock.every(config['reassign_interval'], lambda: offline_reassign(psl, capacity))
+        clock.run(until=config['duration'])
+
+        results.close()
+        if verbose:
+            print("Simulated {} s with {} accesses in {:.1f} s.".format(
+                config['duration'], results.total, time.time() - started))
+        report(output_path, details=False)
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
 
 
 @click.command()
 @click.option("-d", "--config_dir", help="Path to directory containing configuration files.")
-@click.option("-o", "--output_path", help="Path to location of simulation output.", default="sim_output.json")
+@click.option("-o", "--output_path", help="Path to location of simulation output.", default="sim_output.jsonl")
 @click.option("-v", "--verbose", default=True, is_flag=True, help="Toggle for verbosity.")
-def run(config_dir, output_path, verbose):
+@click.option("--offline", is_flag=True, help="Simulate the cluster in virtual time instead of using the datanodes.")
+def run(config_dir, output_path, verbose, offline):
     if not config_dir:
         config_dir = "config"
-    simulate(config_dir, output_path, verbose)
+    if offline:
+        simulate_offline(config_dir, output_path, verbose)
+    else:
+        simulate(config_dir, output_path, verbose)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+""" stream.py
+
+Streaming, ranged reads from the datanodes.
+
+RemoteReader is a raw file object over the stdout of a remote `tail -c | head -c`, so only the
+requested byte range crosses the network and the first bytes are available as soon as the node
+sends them. A read-ahead thread keeps up to read_ahead chunks buffered while the consumer works.
+ChainedReader reads a striped file as the concatenation of several such ranges, opening the next
+one while the current one is consumed.
+
+Author: Brian Tuan
+"""
+
+import io
+import queue
+from collections import deque
+from threading import Thread
+
+
+def range_command(path, offset=0, length=None):
+    """ Shell command printing length bytes of path starting at offset (to the end if length is None). """
+    command = 'cat "{}"'.format(path) if offset == 0 else 'tail -c +{} "{}"'.format(offset + 1, path)
+    if length is not None:
+        command += ' | head -c {}'.format(length)
+    return command
+
+
+class RemoteReader(io.RawIOBase):
+    def __init__(self, transport, node, command, chunk_size=1048576, read_ahead=4):
+        self.transport = transport
+        self.node = node
+        self.proc = transport.open(node, command)
+        self.chunk_size = chunk_size
+        self.chunks = queue.Queue(maxsize=max(read_ahead, 1))
+        self.pending = b''
+        self.eof = False
+        self.reader = Thread(target=self.fill, daemon=True)
+        self.reader.start()
+
+    def fill(self):
+        # read1 returns whatever is available instead of waiting for a full chunk.
+        stdout = self.proc.stdout
+        try:
+            while True:
+                chunk = stdout.read1(self.chunk_size)
+                self.chunks.put(chunk)
+                if not chunk:
+                    break
+        except (ValueError, OSError):
+            # The pipe was closed under us by close().
+            self.chunks.put(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not self.pending and not self.eof:
+            self.pending = self.chunks.get()
+            if not self.pending:
+                self.eof = True
+                self.finish()
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def finish(self):
+        if self.proc.wait() != 0:
+            raise IOError("Reading from {} failed with exit code {}".format(self.node, self.proc.returncode))
+
+    def close(self):
+        if not self.closed:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            # Unblock the read-ahead thread so it sees the end of the pipe.
+            while self.reader.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.transport.release(self.node)
+        super().close()
+
+
+class ChainedReader(io.RawIOBase):
+    """ Raw file object over segments read one after another; open_segment(segment) returns a reader. """
+    def __init__(self, open_segment, segments, prefetch=1):
+        self.open_segment = open_segment
+        self.segments = deque(segments)
+        self.prefetch = prefetch
+        self.readers = deque()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            while self.segments and len(self.readers) <= self.prefetch:
+                self.readers.append(self.open_segment(self.segments.popleft()))
+            if not self.readers:
+                return 0
+            n = self.readers[0].readinto(buf)
+            if n:
+                return n
+            self.readers.popleft().close()
+
+    def close(self):
+        if not self.closed:
+            while self.readers:
+                self.readers.popleft().close()
+            self.segments.clear()
+        super().close()
+
+
+def iter_chunks(f, chunk_size):
+    """ Yield the contents of file object f in chunks, closing it at the end. """
+    try:
+        while True:
+            chunk = f.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+# End of file
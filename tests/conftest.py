@@ -0,0 +1,23 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulation import scratch_store
+
+
+@pytest.fixture
+def make_store():
+    """ Scratch PriorityStoreLite factory over placeholder datanodes; closed and removed afterwards. """
+    stores = []
+    def make(num_nodes, **config):
+        psl, scratch = scratch_store(num_nodes, journal=False, **config)
+        stores.append((psl, scratch))
+        return psl
+    yield make
+    for psl, scratch in stores:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
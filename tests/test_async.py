@@ -0,0 +1,59 @@
+import asyncio
+import shutil
+import threading
+
+from async_api import AsyncPriorityStoreLite
+from simulation import scratch_store
+
+
+def test_sync_and_async_share_channels():
+    psl, scratch = scratch_store(1, max_channels=2)
+    psl.close()
+    apsl = AsyncPriorityStoreLite(scratch)
+    try:
+        transport = apsl.transport
+        node = apsl.psl.datanodes[0]
+        busiest = [0]
+        enter = transport.enter
+        def counting_enter(node):
+            enter(node)
+            with transport.lock:
+                busiest[0] = max(busiest[0], transport.active[node])
+        transport.enter = counting_enter
+
+        threads = [threading.Thread(target=apsl.psl.execute_command, args=[node, 'sleep 0.05'])
+                   for _ in range(4)]
+        async def main():
+            for thread in threads:
+                thread.start()
+            return await asyncio.gather(*[apsl.execute_command(node, 'sleep 0.05') for _ in range(4)])
+        results = asyncio.run(main())
+        for thread in threads:
+            thread.join()
+        assert all(rc.returncode == 0 for rc in results)
+        assert busiest[0] == 2
+        assert transport.active[node] == 0
+    finally:
+        apsl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_create_and_delete_are_recorded():
+    psl, scratch = scratch_store(2, replication={"0": 2})
+    psl.close()
+    apsl = AsyncPriorityStoreLite(scratch)
+    try:
+        async def main():
+            await apsl.create_file('a', size=1024, priority=0)
+            await apsl.create_file('b', size=1024, node_id=1)
+            await apsl.delete_file('a')
+        asyncio.run(main())
+        series = {(s['op'], s['node'], s['priority']): s for s in apsl.psl.metrics.snapshot()['series']}
+        nodes = apsl.psl.datanodes
+        assert sorted(series) == sorted([('create', nodes[0], 0), ('create', nodes[1], 0),
+                                         ('create', nodes[1], 2), ('delete', nodes[0], 0),
+                                         ('delete', nodes[1], 0)])
+        assert all(s['latency']['count'] == 1 and s['errors'] == 0 for s in series.values())
+    finally:
+        apsl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
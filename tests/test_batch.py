@@ -0,0 +1,144 @@
+""" Batched create/delete tasks: failures must leave the metadata and the datanodes in agreement. """
+
+import os
+import random
+import re
+from subprocess import CompletedProcess
+import threading
+import time
+
+import pytest
+
+
+def small_store(make_store, num_nodes, blocks, **config):
+    """ Store whose nodes each hold blocks files of one (small) block. """
+    psl = make_store(num_nodes, **config)
+    psl.block_size = 1024
+    psl.capacities = [blocks * psl.block_size] * psl.num
+    psl.available = list(psl.capacities)
+    psl.recompute_effectiveness()
+    return psl
+
+
+def stored_files(psl):
+    root = psl.transport.root
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+
+def test_planning_failure_rolls_back(make_store):
+    psl = small_store(make_store, 2, 10)
+    psl.create_file('kept', size=psl.block_size)
+    tasks = [(psl.create_file, ['f%d' % i], {'size': psl.block_size}) for i in range(30)]
+    tasks.insert(5, (psl.delete_file, ['kept'], {}))
+    with pytest.raises(AssertionError):
+        psl.submit_tasks(tasks, block=True)
+    assert [filename for filename in psl.metadata if filename != "PSL"] == []
+    assert psl.available == psl.capacities
+    assert psl.priority_counter == [0.0, 0.0, 0.0]
+    assert stored_files(psl) == []
+
+
+class FakeNodes:
+    """ Stand-in for the datanodes behind psl.transport.execute: keeps the set of stored paths.
+
+    Creates on a failing node still write their file before failing, as a partial write would.
+    Scripts with creates on the other nodes run after delay seconds.
+    """
+    def __init__(self, failing=(), delay=0.0):
+        self.failing = set(failing)
+        self.delay = delay
+        self.paths = set()
+        self.lock = threading.Lock()
+
+    def run(self, node, command):
+        created = re.search(r'head -c \d+ </dev/urandom > "(.*)"$', command)
+        with self.lock:
+            if created is not None:
+                self.paths.add(created.group(1))
+                return 1 if node in self.failing else 0
+            removed = re.match(r'rm -rf "(.*)"$', command)
+            self.paths.discard(removed.group(1))
+            return 0
+
+    def execute(self, node, command, input=None, capture=False):
+        if input is None:
+            return CompletedProcess(command, self.run(node, command))
+        lines = input.decode().splitlines()
+        if self.delay and node not in self.failing and any('head -c' in line for line in lines):
+            time.sleep(self.delay)
+        codes = [str(self.run(node, line[2:line.rindex(' ) >/dev/null')])) for line in lines]
+        return CompletedProcess(command, 0, stdout=('\n'.join(codes) + '\n').encode())
+
+
+def check_consistent(psl, nodes):
+    """ Space, counters and stored pieces all match the metadata. """
+    expected = set()
+    used = [0] * psl.num
+    counter = [0.0] * 3
+    for filename, info in psl.metadata.items():
+        if filename == "PSL":
+            continue
+        counter[info['priority']] += 1
+        for node_id, name, size in psl.copies(filename, info):
+            used[node_id] += size
+            expected.add(psl.remote_path(psl.datanodes[node_id], name))
+    assert nodes.paths == expected
+    assert psl.available == [capacity - u for capacity, u in zip(psl.capacities, used)]
+    assert psl.priority_counter == counter
+
+
+def test_failed_replica_rolls_back_after_all_copies(make_store):
+    psl = small_store(make_store, 2, 100, replication={"2": 2})
+    nodes = FakeNodes(failing=[psl.datanodes[0]], delay=0.05)
+    psl.transport.execute = nodes.execute
+    tasks = [(psl.create_file, ['f%d' % i], {'size': psl.block_size}) for i in range(20)]
+    handle = psl.submit_tasks(tasks, block=True)
+    assert all(code != 0 for code in handle.results)
+    assert [filename for filename in psl.metadata if filename != "PSL"] == []
+    check_consistent(psl, nodes)
+
+
+def test_concurrent_creates_and_deletes(make_store):
+    psl = small_store(make_store, 6, 10000, replication={"0": 3, "1": 2}, batch_size=16, io_workers=16)
+    nodes = FakeNodes(failing=[psl.datanodes[3]])
+    psl.transport.execute = nodes.execute
+
+    def worker(t):
+        rng = random.Random(t)
+        names = ['t%d/f%d' % (t, i) for i in range(40)]
+        for _ in range(5):
+            tasks = [(psl.create_file, [name], {'size': psl.block_size * rng.randint(1, 3),
+                                                'priority': rng.randint(0, 2)})
+                     for name in rng.sample(names, 20)]
+            tasks += [(psl.delete_file, [name], {}) for name in rng.sample(names, 10)]
+            rng.shuffle(tasks)
+            psl.submit_tasks(tasks, block=True)
+            name = rng.choice(names)
+            if rng.random() < 0.5:
+                psl.create_file(name, size=psl.block_size, priority=rng.randint(0, 2))
+            else:
+                psl.delete_file(name)
+
+    threads = [threading.Thread(target=worker, args=[t]) for t in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(psl.metadata) > 1
+    check_consistent(psl, nodes)
+
+
+def test_batches_run_in_planned_order(make_store):
+    psl = small_store(make_store, 2, 100)
+    # The create scripts are slow: without ordering the delete script would overtake them.
+    nodes = FakeNodes(delay=0.2)
+    psl.transport.execute = nodes.execute
+    names = ['f%d' % i for i in range(10)]
+    created = psl.submit_tasks([(psl.create_file, [name], {'size': psl.block_size}) for name in names])
+    deleted = psl.submit_tasks([(psl.delete_file, [name], {}) for name in names])
+    assert created.wait(timeout=10) and deleted.wait(timeout=10)
+    assert created.results == [0] * 10 and deleted.results == [0] * 10
+    assert nodes.paths == set()
+    check_consistent(psl, nodes)
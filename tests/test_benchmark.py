@@ -0,0 +1,12 @@
+from benchmark import bench_store
+
+
+def test_small_cell_runs_clean():
+    # 64 nodes: the reassign greedy needs more than the default capacity to finish.
+    results = bench_store(2000, 64, repeat=1, memory=False)
+    assert set(results) >= {'setup', 'placement_reassign', 'persist_metadata', 'draw_access_sample',
+                            'list_files_prefix', 'list_files_priority_page', 'list_files_all',
+                            'placement_node_id'}
+    for name, result in results.items():
+        assert 'error' not in result, name
+        assert result['seconds'] is not None, name
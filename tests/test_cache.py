@@ -0,0 +1,41 @@
+import os
+
+from cache import ReadCache
+
+
+def test_leaves_other_files_alone(tmp_path):
+    (tmp_path / 'mine.txt').write_bytes(b'user data')
+    first = ReadCache(str(tmp_path), 1000)
+    second = ReadCache(str(tmp_path), 1000)
+    assert first.directory != second.directory
+    part = first.admit('a', 10, 2)
+    with open(part, 'wb') as f:
+        f.write(b'0123456789')
+    first.commit('a', part, True)
+    second.close()
+    assert (tmp_path / 'mine.txt').read_bytes() == b'user data'
+    output = str(tmp_path / 'out')
+    assert first.get('a', output)
+    first.close()
+    assert not os.path.exists(first.directory) and (tmp_path / 'mine.txt').exists()
+
+
+def test_invalidate_during_fetch(tmp_path):
+    cache = ReadCache(str(tmp_path), 1000)
+    part = cache.admit('a', 10, 2)
+    with open(part, 'wb') as f:
+        f.write(b'stale')
+    cache.invalidate('a')
+    # Admitted again by another reader before the first one commits.
+    other = cache.admit('a', 10, 2)
+    # The first reader's part is still there to be copied out, but is not published.
+    assert os.path.exists(part) and other != part
+    cache.commit('a', part, True)
+    assert not os.path.exists(part)
+    assert not cache.get('a', str(tmp_path / 'out'))
+    with open(other, 'wb') as f:
+        f.write(b'fresh')
+    cache.commit('a', other, True)
+    assert cache.get('a', str(tmp_path / 'out'))
+    assert (tmp_path / 'out').read_bytes() == b'fresh'
+    assert os.listdir(cache.directory) == [os.path.basename(cache.path('a'))]
@@ -0,0 +1,127 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+from api import PriorityStoreLite
+from metastore import MetadataStore
+from simulation import scratch_store
+
+
+def test_rebase_keeps_later_changes():
+    psl, scratch = scratch_store(4)
+    try:
+        for i in range(50):
+            psl.plan_create('f%d' % i, 1000, priority=1)
+        psl.persist_metadata()
+        assert not psl.metadata.added and psl.metadata.count == 50
+
+        # Changes between the rotation and the rebase go through the journal and are carried over.
+        rebase = psl.rebase_metadata
+        def late(path):
+            psl.plan_create('late', 1000, priority=1)
+            psl.plan_delete('f1')
+            rebase(path)
+        psl.rebase_metadata = late
+        psl.plan_delete('f0')
+        psl.persist_metadata()
+        assert sorted(psl.metadata.added) == ['late'] and psl.metadata.count == 49
+        assert 'f1' not in psl.metadata
+
+        expected = {filename: info.to_json() for filename, info in psl.metadata.items() if filename != "PSL"}
+        psl.close()
+        psl = PriorityStoreLite(scratch)
+        assert {filename: info.to_json() for filename, info in psl.metadata.items() if filename != "PSL"} == expected
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_assignment_replaces_lists():
+    store = MetadataStore(['n0', 'n1', 'n2'])
+    store['f'] = {'node_id': 0, 'mtime': 0, 'priority': 0, 'size': 10, 'replicas': [0, 1]}
+    store['g'] = {'node_id': 0, 'mtime': 0, 'priority': 2, 'size': 10, 'chunks': [0, 1, 2]}
+    scratch = tempfile.mkdtemp(prefix='psl-test-')
+    try:
+        path = os.path.join(scratch, 'metadata.bin')
+        store.snapshot().write(path)
+        store = MetadataStore(store.nodes, path)
+        store['f'] = {'node_id': 2, 'mtime': 0, 'priority': 0, 'size': 10}
+        store['g'] = {'node_id': 1, 'mtime': 0, 'priority': 2, 'size': 10, 'replicas': [1, 2]}
+        assert store['f'].to_json() == {'node_id': 2, 'mtime': 0, 'priority': 0, 'size': 10}
+        assert store['g'].to_json() == {'node_id': 1, 'mtime': 0, 'priority': 2, 'size': 10, 'replicas': [1, 2]}
+        # A partial update keeps the lists it does not name.
+        store.update_entry('g', priority=1)
+        assert store['g']['replicas'] == [1, 2] and 'chunks' not in store['g']
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_rebase_keeps_trimmed_replicas():
+    psl, scratch = scratch_store(4)
+    try:
+        psl.add_entry('f', {'node_id': 0, 'mtime': 0, 'priority': 0, 'size': 1000, 'replicas': [0, 1]})
+        psl.add_entry('g', {'node_id': 1, 'mtime': 0, 'priority': 0, 'size': 1000, 'replicas': [1, 2, 3]})
+        psl.persist_metadata()
+        assert psl.metadata.row('f') is not None
+
+        # Trimmed the way repair_entry does it, between the snapshot and the rebase.
+        rebase = psl.rebase_metadata
+        def late(path):
+            entry = psl.metadata['f'].to_json()
+            psl.remove_entry('f')
+            entry['node_id'] = 1
+            del entry['replicas']
+            psl.add_entry('f', entry)
+            psl.metadata.update_entry('g', replicas=[1, 2])
+            rebase(path)
+        psl.rebase_metadata = late
+        psl.persist_metadata()
+        assert 'replicas' not in psl.metadata['f'] and psl.metadata['f']['node_id'] == 1
+        assert psl.metadata['g']['replicas'] == [1, 2]
+
+        expected = {filename: info.to_json() for filename, info in psl.metadata.items() if filename != "PSL"}
+        psl.rebase_metadata = rebase
+        psl.persist_metadata()
+        psl.close()
+        psl = PriorityStoreLite(scratch)
+        assert {filename: info.to_json() for filename, info in psl.metadata.items() if filename != "PSL"} == expected
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_reads_during_rebase():
+    psl, scratch = scratch_store(4)
+    try:
+        for i in range(20000):
+            psl.add_entry('f%05d' % i, psl.make_entry(i % 4, 2, i))
+        psl.persist_metadata()
+        bad = []
+        stop = threading.Event()
+        def reader(seed):
+            rng = random.Random(seed)
+            while not stop.is_set():
+                i = rng.randrange(20000)
+                info = psl.metadata.get('f%05d' % i)
+                if info is None or info['size'] != i:
+                    bad.append((i, info))
+        readers = [threading.Thread(target=reader, args=[seed]) for seed in range(4)]
+        for thread in readers:
+            thread.start()
+        try:
+            # New names sort before every existing one: each rebase shifts all the rows.
+            for round in range(10):
+                for i in range(500):
+                    psl.add_entry('a%02d-%03d' % (round, i), psl.make_entry(0, 2, 1))
+                psl.persist_metadata()
+        finally:
+            stop.set()
+            for thread in readers:
+                thread.join()
+        assert bad == []
+        assert psl.metadata.count == 25000
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,50 @@
+import contextlib
+import io
+import shutil
+
+import pytest
+
+from api import PriorityStoreLite
+from daemon import MasterDaemon
+from simulation import scratch_store
+
+
+def test_config_dir_has_one_writer():
+    psl, scratch = scratch_store(2)
+    try:
+        with pytest.raises(RuntimeError):
+            PriorityStoreLite(scratch)
+        psl.close()
+        psl = PriorityStoreLite(scratch)
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_failed_open_releases_config_dir():
+    psl, scratch = scratch_store(2)
+    psl.close()
+    try:
+        with open(scratch + '/datanodes.json') as f:
+            datanodes = f.read()
+        with open(scratch + '/datanodes.json', 'w') as f:
+            f.write('{"nodelist": []}')
+        with pytest.raises(AssertionError):
+            PriorityStoreLite(scratch)
+        with open(scratch + '/datanodes.json', 'w') as f:
+            f.write(datanodes)
+        psl = PriorityStoreLite(scratch)
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def test_stats_leave_stdout_alone(make_store):
+    psl = make_store(2)
+    psl.add_entry('a.psl', psl.place_entry('a.psl', 1024, priority=0))
+    daemon = MasterDaemon(psl, None)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        stats = daemon.dispatch({'op': 'stats'}, None)
+    assert out.getvalue() == ''
+    assert 'a.psl' in stats and 'Node id' in stats
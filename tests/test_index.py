@@ -0,0 +1,74 @@
+""" MetadataIndex kept up to date through create, delete, move and re-prioritize, and after replay. """
+
+import random
+import shutil
+
+from api import PriorityStoreLite
+from index import MetadataIndex
+from simulation import scratch_store
+
+
+def contents(index):
+    """ What the index holds, in a form that does not depend on the order it was built in. """
+    for priority, files in index.by_priority.items():
+        assert all(files[index.priority_pos[filename]] == filename for filename in files)
+    assert len(index.priority_pos) == sum(len(files) for files in index.by_priority.values())
+    return ({node_id: set(files) for node_id, files in index.by_node.items() if files},
+            {priority: set(files) for priority, files in index.by_priority.items() if files},
+            list(index.by_path))
+
+
+def check_index(psl):
+    """ The incrementally maintained index matches one built from scratch. """
+    assert psl.index.built
+    fresh = MetadataIndex(psl.metadata)
+    fresh.build()
+    assert contents(psl.index) == contents(fresh)
+    return contents(fresh)
+
+
+def churn(psl, rng, names):
+    for _ in range(300):
+        name = rng.choice(names)
+        action = rng.random()
+        if name not in psl.metadata:
+            size = rng.choice([100, psl.block_size + 100])
+            psl.plan_create(name, size, priority=rng.randint(0, 2))
+        elif action < 0.3:
+            psl.plan_delete(name)
+        elif action < 0.6 and 'chunks' not in psl.metadata[name]:
+            psl.move_entry(name, rng.randrange(psl.num))
+        else:
+            psl.set_priority(name, rng.randint(0, 2))
+
+
+def test_index_consistency_and_replay():
+    psl, scratch = scratch_store(5, replication={"0": 2})
+    try:
+        psl.block_size = 1024
+        psl.capacities = [1000 * psl.block_size] * psl.num
+        psl.available = list(psl.capacities)
+        psl.recompute_effectiveness()
+        rng = random.Random(0)
+        names = ['d%d/f%d' % (i % 4, i) for i in range(60)]
+        psl.index.build()
+        churn(psl, rng, names)
+        before = check_index(psl)
+        assert any('chunks' in info for filename, info in psl.metadata.items() if filename != "PSL")
+        assert any('replicas' in info for filename, info in psl.metadata.items() if filename != "PSL")
+        listed = sorted(psl.list_files(prefix='d1/'))
+        assert listed == [name for name in before[2] if name.startswith('d1/')]
+
+        # Nothing was snapshotted: reopening replays every change from the journal.
+        psl.close()
+        psl = PriorityStoreLite(scratch)
+        psl.index.build()
+        assert check_index(psl) == before
+
+        # Not part of the metadata: set again, as on the first store.
+        psl.block_size = 1024
+        churn(psl, rng, names)
+        check_index(psl)
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
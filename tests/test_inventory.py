@@ -0,0 +1,170 @@
+""" Inventory reconcile over the local transport: the metadata is brought back in line with the nodes. """
+
+import os
+import time
+
+import inventory
+
+OLD = time.time() - 3600
+
+
+def small_store(make_store, num_nodes, **config):
+    psl = make_store(num_nodes, **config)
+    psl.block_size = 1024
+    psl.capacities = [100 * psl.block_size] * psl.num
+    psl.available = list(psl.capacities)
+    psl.recompute_effectiveness()
+    return psl
+
+
+def stored(psl, node_id, name):
+    return psl.remote_path(psl.datanodes[node_id], name)
+
+
+def age(psl):
+    """ Date every entry and stored file back an hour, so the scan does not take them for in-flight. """
+    for filename, info in list(psl.metadata.items()):
+        if filename != "PSL":
+            entry = info.to_json()
+            entry['mtime'] = int(OLD)
+            psl.metadata[filename] = entry
+    for directory, _, names in os.walk(psl.transport.root):
+        for name in names:
+            os.utime(os.path.join(directory, name), (OLD, OLD))
+
+
+def write(psl, node_id, name, size, mtime=OLD):
+    path = stored(psl, node_id, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    os.utime(path, (mtime, mtime))
+
+
+def entries(psl):
+    return sorted(filename for filename in psl.metadata if filename != "PSL")
+
+
+def test_missing_and_truncated_pieces(make_store):
+    psl = small_store(make_store, 3, replication={"0": 2})
+    psl.create_file('gone', size=1000, node_id=0)
+    psl.create_file('short', size=1000, node_id=1)
+    psl.create_file('kept', size=1000, node_id=2)
+    psl.create_file('twice', size=1000, priority=0)
+    first, second = psl.replicas(psl.metadata['twice'])
+    os.remove(stored(psl, 0, 'gone'))
+    os.truncate(stored(psl, 1, 'short'), 10)
+    os.remove(stored(psl, second, 'twice'))
+    age(psl)
+
+    found = psl.reconcile()
+    assert sorted(found.missing) == [('gone', 0, 'gone', 1000, None), ('short', 1, 'short', 1000, 10),
+                                     ('twice', second, 'twice', 1000, None)]
+    assert found.orphans == [] and found.repairs == {}
+    assert entries(psl) == ['gone', 'kept', 'short', 'twice']
+
+    repaired = psl.reconcile(repair=True)
+    assert repaired.repairs == {'trimmed': 1, 'dropped': 2, 'accounting': True}
+    assert entries(psl) == ['kept', 'twice']
+    assert psl.replicas(psl.metadata['twice']) == [first]
+    # The truncated copy of the dropped file is an orphan now.
+    assert [orphan[:3] for orphan in repaired.orphans] == [(1, 'short', 10)]
+    used = [0] * 3
+    used[2] += 1000
+    used[first] += 1000
+    assert psl.available == [capacity - u for capacity, u in zip(psl.capacities, used)]
+    assert psl.priority_counter == [1.0, 0.0, 1.0]
+
+
+def test_adopt_orphans(make_store):
+    psl = small_store(make_store, 3)
+    write(psl, 0, 'whole', 500)
+    write(psl, 1, 'whole', 500)
+    write(psl, 0, 'striped.psl-chunk-0', psl.block_size)
+    write(psl, 2, 'striped.psl-chunk-1', 100)
+    # Not a complete set of chunks, and the temporary of an interrupted upload: neither is a file.
+    write(psl, 1, 'partial.psl-chunk-1', 100)
+    write(psl, 2, 'upload.psl-upload', 100)
+
+    repaired = psl.reconcile(adopt=True)
+    assert repaired.repairs['adopted'] == 2
+    assert entries(psl) == ['striped', 'whole']
+    assert psl.replicas(psl.metadata['whole']) == [0, 1]
+    assert psl.metadata['striped']['chunks'] == [0, 2]
+    assert psl.metadata['striped']['size'] == psl.block_size + 100
+    assert sorted(orphan[:2] for orphan in repaired.orphans) == [(1, 'partial.psl-chunk-1'),
+                                                                  (2, 'upload.psl-upload')]
+    assert psl.available == [psl.capacities[0] - 500 - psl.block_size, psl.capacities[1] - 500,
+                             psl.capacities[2] - 100]
+    assert psl.priority_counter == [0.0, 0.0, 2.0]
+
+
+def test_delete_orphans(make_store):
+    psl = small_store(make_store, 2)
+    psl.create_file('kept', size=1000, node_id=0)
+    age(psl)
+    write(psl, 0, 'stray', 10)
+    write(psl, 1, 'dir/upload.psl-upload', 10)
+
+    repaired = psl.reconcile(delete_orphans=True)
+    assert repaired.repairs['removed'] == 2
+    assert repaired.orphans == []
+    assert not os.path.exists(stored(psl, 0, 'stray'))
+    assert not os.path.exists(stored(psl, 1, 'dir/upload.psl-upload'))
+    assert os.path.exists(stored(psl, 0, 'kept'))
+    assert entries(psl) == ['kept']
+
+
+def test_skips_changes_since_the_scan(make_store, monkeypatch):
+    psl = small_store(make_store, 2)
+    psl.create_file('moved', size=1000, node_id=0)
+    psl.create_file('fresh', size=1000, node_id=0)
+    age(psl)
+    # Written just now, as an upload in flight would be: not an orphan yet.
+    write(psl, 1, 'in-flight', 10, mtime=time.time())
+    entry = psl.metadata['fresh'].to_json()
+    entry['mtime'] = int(time.time()) + 10
+    psl.metadata['fresh'] = entry
+    os.remove(stored(psl, 0, 'fresh'))
+    os.remove(stored(psl, 0, 'moved'))
+
+    # The file is deleted and created again on the other node between the scan and the repair.
+    scan = inventory.scan
+    def racing(psl):
+        found = scan(psl)
+        psl.delete_file('moved')
+        psl.create_file('moved', size=1000, node_id=1)
+        return found
+    monkeypatch.setattr(inventory, 'scan', racing)
+
+    repaired = psl.reconcile(repair=True)
+    assert repaired.missing == [('moved', 0, 'moved', 1000, None)]
+    assert repaired.orphans == []
+    # fresh and in-flight at the scan, moved at the repair.
+    assert repaired.skipped == 3
+    assert repaired.repairs == {'trimmed': 0, 'dropped': 0, 'accounting': True}
+    assert entries(psl) == ['fresh', 'moved']
+    assert psl.metadata['moved']['node_id'] == 1
+
+
+def test_recomputes_accounting(make_store):
+    psl = small_store(make_store, 2)
+    psl.create_file('a', size=1000, node_id=0, priority=0)
+    psl.create_file('b', size=2000, node_id=1, priority=1)
+    psl.create_file('c', size=500, node_id=1, priority=1)
+    age(psl)
+    # Accounting that drifted, e.g. from a crash between a reservation and its entry.
+    psl.available = [psl.capacities[0], 5]
+    psl.priority_counter = [3.0, 0.0, 7.0]
+
+    repaired = psl.reconcile(repair=True)
+    assert repaired.repairs['accounting'] is True
+    assert psl.available == [psl.capacities[0] - 1000, psl.capacities[1] - 2500]
+    assert psl.priority_counter == [1.0, 2.0, 0.0]
+
+    # Not while an upload holds space its entry does not account for yet.
+    psl.claims.add('uploading')
+    psl.available = [0, 0]
+    assert psl.reconcile(repair=True).repairs['accounting'] is False
+    assert psl.available == [0, 0]
+    psl.claims.discard('uploading')
@@ -0,0 +1,42 @@
+import time
+
+from latency import LatencyTracker
+
+
+def test_deadline_scales_with_size():
+    tracker = LatencyTracker()
+    for _ in range(20):
+        # Small reads are dominated by the round trip, large ones by the bandwidth.
+        tracker.record(0, 0.05, nbytes=4096)
+        tracker.record(0, 1.0, nbytes=100 * 2**20)
+    assert abs(tracker.deadline(0, 4096, 95) - 0.05) < 1e-9
+    assert abs(tracker.deadline(0, 100 * 2**20, 95) - 1.0) < 1e-9
+    # Sizes never read go by the closest size class, scaled.
+    assert abs(tracker.deadline(0, 400 * 2**20, 95) - 4.0) < 1e-9
+    assert tracker.deadline(1, 4096, 95) is None
+
+
+def test_unmeasured_replicas_get_tried(make_store):
+    psl = make_store(3, replica_explore=0.5)
+    psl.latency.record(0, 0.1, nbytes=1024)
+    psl.latency.record(1, 0.2, nbytes=1024)
+    info = psl.make_entry(0, 0, 1024, replicas=[0, 1, 2])
+    firsts = [psl.replica_order(info)[0] for _ in range(400)]
+    assert set(firsts) == {0, 2}
+    assert 100 < firsts.count(2) < 300
+
+
+def test_probe_leaves_session_setup_out_of_rtt(make_store):
+    psl = make_store(2)
+    transport = psl.transport
+    open_session = transport.open_session
+    def slow_open(node):
+        time.sleep(0.3)
+        open_session(node)
+    transport.open_session = slow_open
+    psl.prober.probe(0)
+    assert psl.prober.rtt.estimate(0) < 0.2
+    # Also once the session was reaped in between.
+    transport.close()
+    psl.prober.probe(0)
+    assert max(psl.prober.rtt.to_json()['0']['samples']) < 0.2
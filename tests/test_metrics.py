@@ -0,0 +1,85 @@
+""" Metrics histograms and their Prometheus export. """
+
+import json
+
+from metrics import Histogram, Metrics, SparseHistogram
+
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) is None
+    values = [0.001 * i for i in range(1, 1001)]
+    for value in values:
+        histogram.record(value)
+    # Each quantile is the upper bound of its bucket: at most one bucket (2**(1/8)) above the true value.
+    for q, exact in [(0.5, 0.5), (0.99, 0.99), (0.999, 0.999)]:
+        assert exact <= histogram.quantile(q) <= exact * 2 ** (1 / Histogram.PER_OCTAVE)
+    assert histogram.quantile(1.0) == 1.0
+    summary = histogram.to_json()
+    assert summary['count'] == 1000 and summary['max'] == 1.0
+    assert abs(summary['sum'] - sum(values)) < 1e-9
+
+    sparse = SparseHistogram()
+    for value in values:
+        sparse.record(value)
+    assert sparse.to_json() == summary
+    assert len(sparse.counts) < 100
+
+
+def test_histogram_edges():
+    histogram = Histogram()
+    for value in [0.0, 0.25, 0.25, 1e9]:
+        histogram.record(value)
+    assert histogram.quantile(0.25) == Histogram().upper_bound(0)
+    # Capped at the largest value seen, however wide its bucket.
+    assert histogram.quantile(0.5) == histogram.quantile(0.75) < 0.3
+    assert histogram.quantile(1.0) == 1e9
+
+
+def test_prometheus_output():
+    metrics = Metrics()
+    metrics.observe('get', 0.25, node='n1', priority=0, nbytes=10, wait=0.5)
+    metrics.observe('get', 0.25, node='n1', priority=0, nbytes=6, error=True)
+    metrics.observe('put', 1.0, node='a"b')
+    lines = metrics.to_prometheus().splitlines()
+    get = 'op="get",node="n1",priority="0"'
+    put = 'op="put",node="a\\"b",priority=""'
+    assert lines == [
+        '# HELP psl_operation_seconds Service time of PriorityStoreLite operations.',
+        '# TYPE psl_operation_seconds summary',
+        'psl_operation_seconds{%s,quantile="0.5"} 0.25' % get,
+        'psl_operation_seconds{%s,quantile="0.99"} 0.25' % get,
+        'psl_operation_seconds{%s,quantile="0.999"} 0.25' % get,
+        'psl_operation_seconds_sum{%s} 0.5' % get,
+        'psl_operation_seconds_count{%s} 2' % get,
+        'psl_operation_seconds{%s,quantile="0.5"} 1.0' % put,
+        'psl_operation_seconds{%s,quantile="0.99"} 1.0' % put,
+        'psl_operation_seconds{%s,quantile="0.999"} 1.0' % put,
+        'psl_operation_seconds_sum{%s} 1.0' % put,
+        'psl_operation_seconds_count{%s} 1' % put,
+        '# HELP psl_queue_wait_seconds Time tasks waited in the worker pool.',
+        '# TYPE psl_queue_wait_seconds summary',
+        'psl_queue_wait_seconds{%s,quantile="0.5"} 0.5' % get,
+        'psl_queue_wait_seconds{%s,quantile="0.99"} 0.5' % get,
+        'psl_queue_wait_seconds{%s,quantile="0.999"} 0.5' % get,
+        'psl_queue_wait_seconds_sum{%s} 0.5' % get,
+        'psl_queue_wait_seconds_count{%s} 1' % get,
+        '# HELP psl_bytes_total Bytes transferred by PriorityStoreLite operations.',
+        '# TYPE psl_bytes_total counter',
+        'psl_bytes_total{%s} 16' % get,
+        'psl_bytes_total{%s} 0' % put,
+        '# HELP psl_errors_total Failed PriorityStoreLite operations.',
+        '# TYPE psl_errors_total counter',
+        'psl_errors_total{%s} 1' % get,
+        'psl_errors_total{%s} 0' % put,
+    ]
+
+    series = json.loads(metrics.to_json())['series']
+    assert [(s['op'], s['latency']['count'], s['wait']['count'], s['bytes']) for s in series] == \
+        [('get', 2, 1, 16), ('put', 1, 0, 0)]
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    metrics.observe('get', 0.25)
+    assert metrics.snapshot()['series'] == []
@@ -0,0 +1,73 @@
+""" Migrator over the local transport: resumable batches and the checksum check before the flip. """
+
+import os
+
+from migrate import Migrator
+
+
+def small_store(make_store, num_nodes, **config):
+    psl = make_store(num_nodes, **config)
+    psl.block_size = 1024
+    psl.capacities = [100 * psl.block_size] * psl.num
+    psl.available = list(psl.capacities)
+    psl.recompute_effectiveness()
+    return psl
+
+
+def stored(psl, node_id, name):
+    return psl.remote_path(psl.datanodes[node_id], name)
+
+
+def test_interrupted_batch_resumes(make_store):
+    psl = small_store(make_store, 3)
+    contents = {}
+    for name in ('a', 'b', 'c', 'd'):
+        contents[name] = os.urandom(500)
+        assert psl.put_file(name, contents[name], node_id=0).returncode == 0
+    moves = {'a': 1, 'b': 1, 'c': 2, 'd': 2}
+    psl.migrator.begin(moves)
+    assert psl.migrator.migrate('a', 1)
+    # Flipped, but interrupted before it was recorded as done.
+    assert psl.migrator.migrate('b', 1)
+    with open(psl.migrator.done_path, 'w') as f:
+        f.write('a\n')
+
+    # What a restarted process finds in config_dir.
+    assert Migrator(psl).pending() == {'c': 2, 'd': 2}
+    psl.resume_migration()
+    assert not os.path.exists(psl.migrator.plan_path)
+    assert not os.path.exists(psl.migrator.done_path)
+    assert Migrator(psl).pending() == {}
+    for name, node_id in moves.items():
+        assert psl.metadata[name]['node_id'] == node_id
+        assert not os.path.exists(stored(psl, 0, name))
+        assert psl.open_file(name).read() == contents[name]
+    assert psl.available == [psl.capacities[0], psl.capacities[1] - 1000, psl.capacities[2] - 1000]
+
+
+def test_checksum_mismatch_keeps_source(make_store, monkeypatch):
+    psl = small_store(make_store, 2)
+    data = os.urandom(5000)
+    assert psl.put_file('a', data, node_id=0).returncode == 0
+    # The destination drops the last byte of what it is sent, but exits fine.
+    argv = psl.transport.argv
+    def corrupting(node, command):
+        if command.endswith('.psl-migrate"'):
+            command = command.replace('cat >', 'head -c -1 >')
+        return argv(node, command)
+    monkeypatch.setattr(psl.transport, 'argv', corrupting)
+
+    psl.run_migration({'a': 1})
+    assert psl.metadata['a']['node_id'] == 0
+    assert psl.available == [psl.capacities[0] - 5000, psl.capacities[1]]
+    assert psl.open_file('a').read() == data
+    assert not os.path.exists(stored(psl, 1, 'a'))
+    assert not os.path.exists(stored(psl, 1, 'a') + '.psl-migrate')
+    # The batch is kept for the next run.
+    assert psl.migrator.pending() == {'a': 1}
+
+    monkeypatch.setattr(psl.transport, 'argv', argv)
+    psl.resume_migration()
+    assert psl.metadata['a']['node_id'] == 1
+    assert psl.open_file('a').read() == data
+    assert psl.migrator.pending() == {}
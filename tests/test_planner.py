@@ -0,0 +1,67 @@
+""" plan_reassign must pick exactly the moves of the file-by-file fake_placement greedy it replaced. """
+
+import random
+
+import pytest
+
+from placement import PlacementIndex
+from planner import PLANNING_AVAILABLE, plan_reassign
+
+
+def reference_moves(psl):
+    """ The original placement_reassign loop: fake_placement over every file, lowest priority tier first. """
+    eff = PlacementIndex([1.0/psl.latencies[i] for i in range(psl.num)])
+    avail = [PLANNING_AVAILABLE] * psl.num
+    files = sorted(((filename, info) for filename, info in psl.metadata.items()
+                    if filename != "PSL" and 'chunks' not in info),
+                   key=lambda item: item[1]['priority'], reverse=True)
+    moves = {}
+    for filename, info in files:
+        node = psl.fake_placement(avail, eff, info['node_id'], info['priority'])
+        if node != info['node_id']:
+            moves[filename] = node
+    return moves
+
+
+def random_layout(psl, rng, near_full):
+    psl.latencies = [rng.choice([10, 30, 60, 90, 120]) for _ in range(psl.num)]
+    counter = [0.0] * 3
+    for i in range(rng.randint(1, 60 * psl.num)):
+        priority = rng.choice([0, 1, 2, 2, 2])
+        counter[priority] += 1
+        psl.metadata['dir{}/{}.psl'.format(i % 5, i)] = {
+            'node_id': rng.randrange(psl.num), 'mtime': 0, 'priority': priority, 'size': psl.block_size}
+    psl.priority_counter = counter
+    if near_full:
+        # Under 10% of the capacity left: medium and low priority files go past rank 0.
+        psl.available = [int(capacity * rng.uniform(0.01, 0.09)) for capacity in psl.capacities]
+    psl.recompute_effectiveness()
+
+
+@pytest.mark.parametrize('near_full', [False, True])
+@pytest.mark.parametrize('seed', range(12))
+def test_plan_matches_greedy(make_store, seed, near_full):
+    rng = random.Random(seed)
+    psl = make_store(rng.randint(2, 12))
+    random_layout(psl, rng, near_full)
+    if near_full:
+        assert psl.effective_rank(psl.num, 2) > 0
+    plan = plan_reassign(psl)
+    moves = reference_moves(psl)
+    assert plan.moves == moves
+    assert list(plan.moves) == list(moves)
+    assert plan.bytes == sum(psl.metadata[filename]['size'] for filename in moves)
+
+
+def test_dry_run_moves_nothing(make_store):
+    rng = random.Random(1)
+    psl = make_store(8)
+    random_layout(psl, rng, near_full=False)
+    before = {filename: dict(info) for filename, info in psl.metadata.items() if filename != "PSL"}
+    available = list(psl.available)
+    plan = psl.placement_reassign(dry_run=True)
+    assert len(plan) > 0
+    assert plan.moves == reference_moves(psl)
+    assert plan.bytes == sum(before[filename]['size'] for filename in plan.moves)
+    assert {filename: dict(info) for filename, info in psl.metadata.items() if filename != "PSL"} == before
+    assert psl.available == available
@@ -0,0 +1,101 @@
+""" TaskPool: back-pressure, the per-node cap, serial keys and errors. """
+
+import threading
+import time
+
+import pytest
+
+from pool import TaskBatch, TaskPool
+
+
+def make_pool(**kwargs):
+    return TaskPool(lambda task, stats, wait: task(), **kwargs)
+
+
+def test_max_pending_blocks_submit():
+    pool = make_pool(num_workers=2, max_pending=3)
+    release = threading.Event()
+    for _ in range(3):
+        pool.submit(release.wait)
+    submitted = threading.Event()
+    def producer():
+        pool.submit(lambda: None)
+        submitted.set()
+    threading.Thread(target=producer, daemon=True).start()
+    # Three tasks outstanding: the fourth submit waits for one of them to finish.
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    pool.shutdown()
+
+
+def test_node_limit_parks_tasks():
+    pool = make_pool(num_workers=8, node_limit=2)
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+    def task(node):
+        def run():
+            with lock:
+                running[node] += 1
+                peak[node] = max(peak[node], running[node])
+            time.sleep(0.02)
+            with lock:
+                running[node] -= 1
+            return node
+        return run
+    futures = [pool.submit(task('a'), node='a') for _ in range(10)]
+    others = [pool.submit(task('b'), node='b') for _ in range(2)]
+    assert [f.result(timeout=5) for f in others] == ['b', 'b']
+    assert [f.result(timeout=5) for f in futures] == ['a'] * 10
+    assert peak == {'a': 2, 'b': 2}
+    pool.shutdown()
+    assert not pool.parked.get('a')
+
+
+def test_serial_tasks_run_in_submit_order():
+    pool = make_pool(num_workers=8)
+    order = []
+    def task(i):
+        def run():
+            # Later tasks are quicker: only the serial key keeps them in order.
+            time.sleep(0.01 * (5 - i))
+            order.append(i)
+        return run
+    futures = [pool.submit(task(i), node='a', serial='a') for i in range(5)]
+    for future in futures:
+        future.result(timeout=5)
+    assert order == list(range(5))
+    assert pool.serial == {}
+    pool.shutdown()
+
+
+def test_exception_reaches_future():
+    pool = make_pool(num_workers=2)
+    def fail():
+        raise ValueError("boom")
+    handle = TaskBatch(2)
+    handle.add(pool.submit(fail, node='a'), 0)
+    handle.add(pool.submit(lambda: 7, node='a'), 1)
+    assert handle.wait(timeout=5)
+    with pytest.raises(ValueError, match="boom"):
+        handle.futures[0].result()
+    assert handle.results == [None, 7]
+    assert [str(e) for e in handle.errors()] == ["boom"]
+    # The worker that ran it is still serving tasks.
+    assert pool.submit(lambda: 'ok', node='a').result(timeout=5) == 'ok'
+    pool.shutdown()
+
+
+def test_shutdown_cancels_pending():
+    pool = make_pool(num_workers=1)
+    release = threading.Event()
+    first = pool.submit(release.wait)
+    time.sleep(0.05)
+    queued = [pool.submit(lambda: None), pool.submit(lambda: None, serial='s'),
+              pool.submit(lambda: None, serial='s')]
+    threading.Timer(0.1, release.set).start()
+    pool.shutdown(cancel_pending=True)
+    assert first.result() is True
+    assert all(f.cancelled() for f in queued)
+    assert pool.outstanding == 0
@@ -0,0 +1,105 @@
+""" Trace replay: the open- and closed-loop reports, against an in-memory stand-in for the store. """
+
+import json
+from subprocess import CompletedProcess
+from threading import Lock
+import time
+
+import pytest
+
+from replay import Replayer, read_trace
+
+
+class FakeStore:
+    """ Files as a set; every operation takes delay seconds. Gets of 'broken' fail. """
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.files = set()
+        self.lock = Lock()
+
+    def run(self, ok):
+        time.sleep(self.delay)
+        return CompletedProcess([], 0 if ok else 1)
+
+    def create_file(self, filename, size=67108864, priority=2):
+        with self.lock:
+            if filename in self.files:
+                return None
+            self.files.add(filename)
+        return self.run(True)
+
+    def retrieve_file(self, filename, output=None):
+        if filename not in self.files:
+            return None
+        return self.run(filename != 'broken')
+
+    def delete_file(self, filename):
+        with self.lock:
+            if filename not in self.files:
+                return None
+            self.files.discard(filename)
+        return self.run(True)
+
+
+TRACE = [
+    {'time': 10.0, 'op': 'put', 'file': 'a', 'size': 10},
+    {'time': 10.0, 'op': 'put', 'file': 'broken', 'priority': 0},
+    {'time': 10.1, 'op': 'put', 'file': 'a'},
+    {'time': 10.1, 'op': 'get', 'file': 'a'},
+    {'time': 10.2, 'op': 'get', 'file': 'broken'},
+    {'time': 10.2, 'op': 'get', 'file': 'nothing'},
+    {'time': 10.3, 'op': 'del', 'file': 'a'},
+]
+
+
+def write_trace(tmp_path, records):
+    path = tmp_path / 'trace.jsonl'
+    path.write_text(''.join(json.dumps(record) + '\n\n' for record in records))
+    return str(path)
+
+
+def outcomes(result):
+    return {op: (value['ok'], value['error'], value['missing']) for op, value in result['ops'].items()}
+
+
+def test_read_trace(tmp_path):
+    assert list(read_trace(write_trace(tmp_path, TRACE))) == TRACE
+    with pytest.raises(ValueError, match='trace.jsonl:3'):
+        list(read_trace(write_trace(tmp_path, [TRACE[0], {'time': 1, 'op': 'move', 'file': 'a'}])))
+
+
+def test_open_loop_report(tmp_path):
+    replayer = Replayer(FakeStore(), concurrency=1)
+    replayer.open_loop(read_trace(write_trace(tmp_path, TRACE)), speed=2.0)
+    result = replayer.report()
+    assert result['operations'] == 7
+    assert outcomes(result) == {'put': (2, 0, 1), 'get': (1, 1, 1), 'del': (1, 0, 0)}
+    # Arrivals follow the trace, 0.3 s of it at twice the speed.
+    assert 0.15 <= result['seconds'] < 1.0
+    assert result['throughput'] == 7 / result['seconds']
+
+
+def test_open_loop_counts_backlog_in_latency(tmp_path):
+    # One thread and operations that take longer than the gaps: the later ones queue behind.
+    records = [{'time': i * 0.01, 'op': 'put', 'file': 'f%d' % i} for i in range(5)]
+    replayer = Replayer(FakeStore(delay=0.1), concurrency=1)
+    replayer.open_loop(iter(records))
+    put = replayer.report()['ops']['put']
+    assert put['count'] == 5 and put['ok'] == 5
+    # The last one was due at 0.04 s and finished after 0.5 s.
+    assert put['max'] >= 0.45
+    assert replayer.lag < 0.1
+
+
+def test_closed_loop_report():
+    store = FakeStore(delay=0.05)
+    records = [{'time': 0, 'op': 'put', 'file': 'f%d' % i} for i in range(8)]
+    replayer = Replayer(store, concurrency=4)
+    replayer.closed_loop(iter(records))
+    result = replayer.report()
+    assert result['operations'] == 8 and outcomes(result) == {'put': (8, 0, 0)}
+    assert store.files == {'f%d' % i for i in range(8)}
+    # Two rounds of four, back to back: trace times are ignored.
+    assert 0.1 <= result['seconds'] < 0.4
+    assert result['max_dispatch_lag'] == 0.0
+    assert 0.05 <= result['ops']['put']['p50'] < 0.2
@@ -0,0 +1,12 @@
+def test_retrieve_deleted_meanwhile(make_store, tmp_path):
+    psl = make_store(2)
+    psl.create_file('a.psl', size=1024)
+    plan_retrieve = psl.plan_retrieve
+    def racing(filename):
+        planned = plan_retrieve(filename)
+        psl.delete_file(filename)
+        return planned
+    psl.plan_retrieve = racing
+    assert psl.retrieve_file('a.psl', output=str(tmp_path)) is None
+    psl.create_file('b.psl', size=1024)
+    assert psl.open_file('b.psl') is None
@@ -0,0 +1,65 @@
+""" Striping of files larger than a block over the local transport. """
+
+import os
+
+from index import chunk_sizes
+
+
+def small_store(make_store, num_nodes, **config):
+    psl = make_store(num_nodes, **config)
+    psl.block_size = 1024
+    psl.capacities = [100 * psl.block_size] * psl.num
+    psl.available = list(psl.capacities)
+    psl.recompute_effectiveness()
+    return psl
+
+
+def test_chunk_sizes():
+    assert chunk_sizes(1024, 1024) == [1024]
+    assert chunk_sizes(1025, 1024) == [1024, 1]
+    assert chunk_sizes(3000, 1024) == [1024, 1024, 952]
+
+
+def test_block_size_boundary(make_store):
+    psl = small_store(make_store, 3)
+    exact = os.urandom(psl.block_size)
+    assert psl.put_file('exact', exact).returncode == 0
+    assert 'chunks' not in psl.metadata['exact']
+
+    over = os.urandom(psl.block_size + 1)
+    assert psl.put_file('over', over).returncode == 0
+    info = psl.metadata['over']
+    assert len(info['chunks']) == 2 and info['size'] == psl.block_size + 1
+    assert [size for _, _, size in psl.copies('over', info)] == [psl.block_size, 1]
+    assert psl.open_file('exact').read() == exact
+    assert psl.open_file('over').read() == over
+
+    # Same through create_file, which writes placeholder content.
+    psl.create_file('created', size=psl.block_size + 1)
+    assert len(psl.metadata['created']['chunks']) == 2
+    assert sum(psl.capacities) - sum(psl.available) == len(exact) + 2 * len(over)
+
+
+def test_stripe_chunks_on_distinct_nodes(make_store):
+    psl = small_store(make_store, 4)
+    # Skew the effectiveness so the greedy would pick the same node for every chunk.
+    psl.available[2] -= 50 * psl.block_size
+    psl.recompute_effectiveness()
+    psl.create_file('big', size=10 * psl.block_size + 5)
+    chunks = psl.metadata['big']['chunks']
+    assert len(chunks) == 11
+    for start in range(0, len(chunks), psl.num):
+        stripe = chunks[start:start + psl.num]
+        assert len(set(stripe)) == len(stripe)
+
+
+def test_ranged_reads_across_chunks(make_store):
+    psl = small_store(make_store, 3)
+    data = os.urandom(3 * psl.block_size + 100)
+    assert psl.put_file('a', data).returncode == 0
+    block = psl.block_size
+    for offset, length in [(block - 10, 20), (block - 1, 2), (block, block), (10, 2 * block + 50),
+                           (3 * block + 90, 100), (0, None), (2 * block + 7, None)]:
+        with psl.open_file('a', offset=offset, length=length) as f:
+            expected = data[offset:] if length is None else data[offset:offset + length]
+            assert f.read() == expected
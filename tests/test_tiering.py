@@ -0,0 +1,72 @@
+import shutil
+import threading
+
+from api import FILE_FREQUENCY, PriorityStoreLite
+from simulation import scratch_store
+from tiering import Tierer, plan_tiers
+
+
+def tiered_store(make_store, num_files=200):
+    """ 1% of the files at priority 0, 9% at priority 1 (f0, f1 and f2..f19 for 200 files). """
+    psl = make_store(4)
+    for i in range(num_files):
+        priority = 0 if i < num_files // 100 else 1 if i < num_files // 10 else 2
+        psl.add_entry('f%d' % i, psl.make_entry(0, priority, 1024))
+    return psl
+
+
+def test_equally_hot_files_stay_put(make_store):
+    psl = tiered_store(make_store)
+    # Read once each, the files of the lower tiers a little later than the others.
+    for i in range(20):
+        psl.access.hit('f%d' % i, now=1000.0 + i * 0.1)
+    assert plan_tiers(psl, FILE_FREQUENCY, now=1010.0) == {}
+
+
+def test_hotter_file_is_promoted(make_store):
+    psl = tiered_store(make_store)
+    for i in range(20):
+        psl.access.hit('f%d' % i, now=1000.0 + i * 0.1)
+    for _ in range(3):
+        psl.access.hit('f18', now=1005.0)
+        psl.access.hit('f50', now=1005.0)
+    changes = plan_tiers(psl, FILE_FREQUENCY, now=1010.0)
+    # Both newcomers beat the files they push out by more than the margin; f0, read first, is the
+    # coldest of the 20 and leaves the medium tier to make room for f1.
+    assert changes == {'f18': 0, 'f50': 0, 'f1': 1, 'f0': 2}
+
+
+def test_tierer_survives_a_failed_pass(make_store, capsys):
+    psl = make_store(2)
+    passes = []
+    done = threading.Event()
+    def retier():
+        passes.append(len(passes))
+        if len(passes) == 1:
+            raise OSError("node down")
+        done.set()
+    psl.retier = retier
+    tierer = Tierer(psl, 0.01)
+    tierer.start()
+    try:
+        assert done.wait(5)
+    finally:
+        tierer.stop()
+    assert "Re-tiering failed: OSError('node down')" in capsys.readouterr().err
+
+
+def test_access_counters_survive_a_restart():
+    psl, scratch = scratch_store(2)
+    try:
+        psl.add_entry('a', psl.make_entry(0, 2, 1024))
+        for _ in range(3):
+            psl.access.hit('a', now=1000.0)
+        psl.access.hit('b', now=1005.0)
+        psl.persist_metadata()
+        psl.close()
+        psl = PriorityStoreLite(scratch)
+        assert psl.access.score('a', now=1010.0) > psl.access.score('b', now=1010.0) > 0
+        assert psl.access.to_json() == {'a': [3.0, 1000.0], 'b': [1.0, 1005.0]}
+    finally:
+        psl.close()
+        shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,74 @@
+""" LocalTransport: per-node channel caps and the reaping of idle sessions. """
+
+import threading
+import time
+
+from transport import LocalTransport
+
+
+class Recording(LocalTransport):
+    """ LocalTransport that logs the sessions it opens and closes. """
+    def __init__(self, *args, **kwargs):
+        self.sessions = []
+        super().__init__(*args, **kwargs)
+
+    def open_session(self, node):
+        super().open_session(node)
+        self.sessions.append(('open', node))
+
+    def close_session(self, node):
+        self.sessions.append(('close', node))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_channel_cap(tmp_path):
+    transport = Recording(str(tmp_path), max_channels=2, idle_timeout=0)
+    assert transport.acquire('a') and transport.acquire('a')
+    assert not transport.acquire('a', blocking=False)
+    # The cap is per node.
+    assert transport.acquire('b', blocking=False)
+    transport.release('b')
+
+    done = threading.Event()
+    def run():
+        transport.execute('a', 'true')
+        done.set()
+    threading.Thread(target=run, daemon=True).start()
+    assert not done.wait(0.2)
+    transport.release('a')
+    assert done.wait(5)
+    transport.release('a')
+    assert transport.acquire('a', blocking=False) and transport.acquire('a', blocking=False)
+    transport.release('a')
+    transport.release('a')
+    assert transport.active == {'a': 0, 'b': 0}
+    # One session per node, opened by its first operation.
+    assert transport.sessions == [('open', 'a'), ('open', 'b')]
+    transport.close()
+
+
+def test_reap_idle(tmp_path):
+    transport = Recording(str(tmp_path), idle_timeout=0.1)
+    transport.acquire('busy')
+    transport.execute('idle', 'true')
+    assert wait_for(lambda: ('close', 'idle') in transport.sessions)
+    # Past the timeout, but an operation is still running on it.
+    time.sleep(0.3)
+    assert ('close', 'busy') not in transport.sessions
+    transport.release('busy')
+    assert wait_for(lambda: ('close', 'busy') in transport.sessions)
+    assert transport.last_used == {}
+
+    # The next operation opens the session again.
+    transport.execute('idle', 'true')
+    assert transport.sessions.count(('open', 'idle')) == 2
+    transport.close()
+    assert transport.sessions[-1] == ('close', 'idle')
@@ -0,0 +1,93 @@
+""" put_file over the local transport: a failed upload must leave nothing behind. """
+
+import os
+
+import pytest
+
+
+def small_store(make_store, num_nodes, **config):
+    psl = make_store(num_nodes, **config)
+    psl.block_size = 1024
+    psl.capacities = [100 * psl.block_size] * psl.num
+    psl.available = list(psl.capacities)
+    psl.recompute_effectiveness()
+    return psl
+
+
+def stored_files(psl):
+    root = psl.transport.root
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+
+def break_uploads(psl, monkeypatch, replace, nodes=None):
+    """ Rewrite the upload command run on nodes (every node if None) with replace(command). """
+    argv = psl.transport.argv
+    def broken(node, command):
+        if 'md5sum' in command and (nodes is None or node in nodes):
+            command = replace(command)
+        return argv(node, command)
+    monkeypatch.setattr(psl.transport, 'argv', broken)
+
+
+def check_nothing_left(psl, filename):
+    assert filename not in psl.metadata
+    assert not psl.claims
+    assert psl.available == psl.capacities
+    assert stored_files(psl) == []
+
+
+def test_put_file_round_trip(make_store):
+    psl = small_store(make_store, 3)
+    data = os.urandom(3 * psl.block_size + 10)
+    assert psl.put_file('a', data).returncode == 0
+    assert psl.open_file('a').read() == data
+    assert psl.put_file('a', b'again') is None
+    assert not any(name.endswith('.psl-upload') for name in stored_files(psl))
+
+
+def test_checksum_mismatch_leaves_nothing(make_store, monkeypatch):
+    psl = small_store(make_store, 2)
+    # The node keeps only part of what it is sent, so its digest differs from the sender's.
+    break_uploads(psl, monkeypatch, lambda command: command.replace('cat >', 'head -c 10 >'))
+    rc = psl.put_file('a', b'x' * 500)
+    assert rc.returncode == 1
+    check_nothing_left(psl, 'a')
+
+
+def test_failed_part_leaves_nothing(make_store, monkeypatch):
+    psl = small_store(make_store, 3)
+    # Only the chunks sent to the first node fail; the others have already been written.
+    break_uploads(psl, monkeypatch, lambda command: command + ' && exit 1', nodes=[psl.datanodes[0]])
+    data = os.urandom(5 * psl.block_size)
+    assert psl.put_file('a', data).returncode == 1
+    check_nothing_left(psl, 'a')
+    assert psl.put_file('b', iter([data[:700], data[700:]])).returncode == 1
+    check_nothing_left(psl, 'b')
+
+
+def test_unknown_length_stream(make_store):
+    psl = small_store(make_store, 3, upload_parts=2)
+    data = os.urandom(3 * psl.block_size + 500)
+    pieces = (data[i:i + 700] for i in range(0, len(data), 700))
+    assert psl.put_file('striped', pieces, priority=1).returncode == 0
+    info = psl.metadata['striped']
+    assert len(info['chunks']) == 4 and info['size'] == len(data) and info['priority'] == 1
+    assert psl.open_file('striped').read() == data
+    assert sum(psl.capacities) - sum(psl.available) == len(data)
+
+    # A stream that fits in one block is stored like any small file.
+    assert psl.put_file('small', iter([b'a' * 300, b'b' * 300])).returncode == 0
+    assert 'chunks' not in psl.metadata['small']
+    assert psl.open_file('small').read() == b'a' * 300 + b'b' * 300
+
+
+def test_stream_error_releases_space(make_store):
+    psl = small_store(make_store, 3)
+    def pieces():
+        yield os.urandom(2 * psl.block_size)
+        raise IOError("source went away")
+    with pytest.raises(IOError):
+        psl.put_file('a', pieces())
+    check_nothing_left(psl, 'a')
@@ -0,0 +1,118 @@
+""" tiering.py
+
+Access tracking and automatic re-tiering for PriorityStoreLite.
+
+AccessTracker keeps one exponentially decaying counter per file, bumped on every read: the
+counter halves every half_life seconds without reads, so it approximates the file's recent read
+rate. plan_tiers ranks the files by that rate and hands out priorities within the FILE_FREQUENCY
+budgets: the hottest 1% become priority 0, the next 9% priority 1, the rest priority 2. A file
+that was never read is not promoted, and a file only takes the place of one already in the better
+tier if its score beats that file's by the margin, so files read about as often as the tier's
+members do not trade places (and migrate) on every pass. The counters are saved with the metadata
+snapshot, so a restart does not forget what is hot.
+
+Author: Brian Tuan
+"""
+
+import sys
+import time
+from threading import Event, Lock, Thread
+
+import numpy as np
+
+
+class AccessTracker:
+    def __init__(self, half_life=3600.0):
+        self.half_life = half_life
+        self.lock = Lock()
+        self.counters = {}
+
+    def hit(self, filename, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            counter = self.counters.get(filename)
+            if counter is None:
+                self.counters[filename] = [1.0, now]
+            else:
+                counter[0] = counter[0] * 2.0**(-(now - counter[1])/self.half_life) + 1.0
+                counter[1] = now
+
+    def score(self, filename, now=None):
+        now = time.time() if now is None else now
+        counter = self.counters.get(filename)
+        if counter is None:
+            return 0.0
+        return counter[0] * 2.0**(-(now - counter[1])/self.half_life)
+
+    def forget(self, filename):
+        with self.lock:
+            self.counters.pop(filename, None)
+
+    def to_json(self):
+        with self.lock:
+            return {filename: list(counter) for filename, counter in self.counters.items()}
+
+    def load_json(self, data):
+        with self.lock:
+            self.counters = {filename: list(counter) for filename, counter in data.items()}
+
+
+def plan_tiers(psl, frequencies, now=None, margin=1.25):
+    """ {filename: new priority} for the files whose priority should change. """
+    now = time.time() if now is None else now
+    names = [filename for filename in psl.metadata if filename != "PSL"]
+    if not names:
+        return {}
+    scores = np.array([psl.access.score(f, now) for f in names])
+    current = np.array([psl.metadata[f]['priority'] for f in names])
+    # Hottest first; on equal scores the file already in the better tier stays ahead.
+    order = np.lexsort((current, -scores))
+    target = np.full(len(names), 2)
+    high = int(frequencies[0] * len(names))
+    medium = int(frequencies[1] * len(names))
+    target[order[:high]] = 0
+    target[order[high:high + medium]] = 1
+    # Never promote a file nobody reads.
+    cold = scores == 0
+    target[cold] = np.maximum(target[cold], current[cold])
+    for tier in (0, 1):
+        # Pair the hottest newcomer with the coldest file it pushes out, and so on: only the pairs
+        # where the newcomer is hotter by the margin swap, the others both stay where they are.
+        promoted = np.flatnonzero((target == tier) & (current > tier))
+        displaced = np.flatnonzero((current == tier) & (target > tier))
+        promoted = promoted[np.argsort(-scores[promoted], kind='stable')]
+        displaced = displaced[np.argsort(scores[displaced], kind='stable')]
+        n = min(len(promoted), len(displaced))
+        kept = scores[promoted[:n]] <= margin * scores[displaced[:n]]
+        target[promoted[:n][kept]] = current[promoted[:n][kept]]
+        target[displaced[:n][kept]] = tier
+    changed = np.flatnonzero(target != current)
+    return {names[i]: int(target[i]) for i in changed.tolist()}
+
+
+class Tierer:
+    """ Runs PriorityStoreLite.retier every interval seconds. """
+    def __init__(self, psl, interval):
+        self.psl = psl
+        self.interval = interval
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.psl.retier()
+            except Exception as e:
+                # A failed pass (e.g. a node down during its migrations) must not stop the next ones.
+                print("Re-tiering failed:", repr(e), file=sys.stderr)
+
+# End of file
@@ -0,0 +1,221 @@
+""" transport.py
+
+Transport layer for PriorityStoreLite. Every remote operation issued by the API goes through a
+Transport, which owns the connections to the datanodes.
+
+    SSHTransport    long-lived OpenSSH control masters, one multiplexed session per datanode.
+    LocalTransport  runs commands through the local shell, mapping each datanode onto a directory.
+                    Useful for tests and for running the API without real hosts.
+
+Both cap the number of concurrent channels per datanode and reap sessions that have been idle for
+longer than the configured timeout.
+
+Author: Brian Tuan
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from threading import Lock, Semaphore, Thread, Event
+
+DEFAULT_MAX_CHANNELS = 8
+DEFAULT_IDLE_TIMEOUT = 300
+
+
+def make_transport(config):
+    """ Build the transport named in config.json (defaults to SSH). """
+    kind = config.get('transport', 'ssh')
+    max_channels = config.get('max_channels', DEFAULT_MAX_CHANNELS)
+    idle_timeout = config.get('idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    if kind == 'ssh':
+        return SSHTransport(max_channels=max_channels, idle_timeout=idle_timeout)
+    if kind == 'local':
+        return LocalTransport(config.get('local_root', os.path.join(tempfile.gettempdir(), 'psl')),
+                              max_channels=max_channels, idle_timeout=idle_timeout)
+    raise ValueError("Unknown transport: {}".format(kind))
+
+
+class Channel:
+    """ Context manager holding one of a node's channel slots for the duration of an operation. """
+    def __init__(self, transport, node):
+        self.transport = transport
+        self.node = node
+
+    def __enter__(self):
+        self.transport.acquire(self.node)
+        return self
+
+    def __exit__(self, *exc):
+        self.transport.release(self.node)
+        return False
+
+
+class Transport:
+    """ Base class. Subclasses implement argv(), fetch_argv(), resolve() and the session hooks. """
+    def __init__(self, max_channels=DEFAULT_MAX_CHANNELS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_channels = max_channels
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.channels = {}
+        self.last_used = {}
+        self.active = {}
+        self.closed = Event()
+        self.reaper = None
+        if idle_timeout:
+            self.reaper = Thread(target=self.reap_idle, daemon=True)
+            self.reaper.start()
+
+    # Session bookkeeping
+
+    def acquire(self, node, blocking=True):
+        """ Take one of the node's channels. Without blocking, returns False if none is free. """
+        with self.lock:
+            if node not in self.channels:
+                self.channels[node] = Semaphore(self.max_channels)
+            sem = self.channels[node]
+        if not sem.acquire(blocking):
+            return False
+        self.enter(node)
+        return True
+
+    def release(self, node):
+        self.leave(node)
+        with self.lock:
+            sem = self.channels[node]
+        sem.release()
+
+    def enter(self, node):
+        """ Count an operation on the node, opening its session if it is not up. """
+        with self.lock:
+            fresh = node not in self.last_used
+            self.active[node] = self.active.get(node, 0) + 1
+            self.last_used[node] = time.time()
+        if fresh:
+            self.open_session(node)
+
+    def leave(self, node):
+        with self.lock:
+            self.active[node] -= 1
+            self.last_used[node] = time.time()
+
+    def channel(self, node):
+        return Channel(self, node)
+
+    def reap_idle(self):
+        while not self.closed.wait(min(self.idle_timeout, 30)):
+            now = time.time()
+            with self.lock:
+                idle = [node for node, t in self.last_used.items()
+                        if self.active[node] == 0 and now - t > self.idle_timeout]
+                for node in idle:
+                    del self.last_used[node]
+            for node in idle:
+                self.close_session(node)
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            nodes = list(self.last_used)
+            self.last_used.clear()
+        for node in nodes:
+            self.close_session(node)
+
+    def open_session(self, node):
+        pass
+
+    def close_session(self, node):
+        pass
+
+    # Operations
+
+    def argv(self, node, command):
+        """ Argument vector that runs a shell command on the node. """
+        raise NotImplementedError
+
+    def fetch_argv(self, node, remote_path, local_path):
+        """ Argument vector that copies a remote file to a local path. """
+        raise NotImplementedError
+
+    def resolve(self, node, path):
+        """ Location of a datanode path as seen by the node's shell. """
+        return path
+
+    def execute(self, node, command, input=None, capture=False):
+        with self.channel(node):
+            return subprocess.run(self.argv(node, command), input=input,
+                                  stdout=subprocess.PIPE if capture else None)
+
+    def spawn(self, node, argv, **kwargs):
+        """ Start argv without waiting for it, holding a channel. The caller must release(node). """
+        self.acquire(node)
+        try:
+            return subprocess.Popen(argv, **kwargs)
+        except BaseException:
+            self.release(node)
+            raise
+
+    def open(self, node, command, stdin=None):
+        """ Start a command on the node with its stdout piped back. The caller must release(node). """
+        return self.spawn(node, self.argv(node, command), stdin=stdin, stdout=subprocess.PIPE)
+
+    def fetch(self, node, remote_path, local_path):
+        with self.channel(node):
+            return subprocess.run(self.fetch_argv(node, remote_path, local_path))
+
+
+class SSHTransport(Transport):
+    """ Multiplexes every operation for a node over one OpenSSH control master. """
+    def __init__(self, max_channels=DEFAULT_MAX_CHANNELS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.control_dir = tempfile.mkdtemp(prefix='psl-ssh-')
+        super().__init__(max_channels=max_channels, idle_timeout=idle_timeout)
+
+    def ssh_options(self):
+        # ControlPersist keeps the master alive on its own, the reaper shuts it down when idle. The
+        # masters of a process that never calls close() exit after idle_timeout on their own.
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}/%C'.format(self.control_dir),
+                '-o', 'ControlPersist={}s'.format(self.idle_timeout or DEFAULT_IDLE_TIMEOUT),
+                '-o', 'BatchMode=yes']
+
+    def open_session(self, node):
+        subprocess.run(['ssh'] + self.ssh_options() + ['-M', '-N', '-f', node])
+
+    def close_session(self, node):
+        subprocess.run(['ssh'] + self.ssh_options() + ['-O', 'exit', node],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def argv(self, node, command):
+        return ['ssh'] + self.ssh_options() + [node, command]
+
+    def fetch_argv(self, node, remote_path, local_path):
+        return ['scp', '-q'] + self.ssh_options() + [node + ':' + remote_path, local_path]
+
+    def close(self):
+        super().close()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class LocalTransport(Transport):
+    """ Runs every datanode on the local machine, each under its own directory of root. """
+    def __init__(self, root, max_channels=DEFAULT_MAX_CHANNELS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.root = root
+        super().__init__(max_channels=max_channels, idle_timeout=idle_timeout)
+
+    def node_root(self, node):
+        return os.path.join(self.root, node.replace('/', '_'))
+
+    def resolve(self, node, path):
+        return self.node_root(node) + '/' + path.lstrip('/')
+
+    def open_session(self, node):
+        os.makedirs(self.node_root(node), exist_ok=True)
+
+    def argv(self, node, command):
+        return ['sh', '-c', command]
+
+    def fetch_argv(self, node, remote_path, local_path):
+        return ['cp', remote_path, local_path]
+
+# End of file
@@ -0,0 +1,216 @@
+""" upload.py
+
+Uploads of real content into PriorityStoreLite.
+
+A source is a local path, a bytes-like object, a readable file object or any iterable of bytes.
+Each piece of the file (a replica, or a chunk of a striped file) is streamed into a temporary file
+on its node through one remote `cat`, so writes are pipelined instead of one round trip per buffer.
+The node hashes what it received and the upload only counts if that digest matches the one computed
+while sending. Once every piece checked out, the temporary files are renamed into place and the file
+is added to the metadata.
+
+Sources of known size are placed up front and all their pieces go out in parallel. Streams of
+unknown size are read part by part (one part per block): a stream that fits in a block is stored
+like any small file, a longer one is striped, each part being placed and uploaded while the next is
+read, with at most upload_parts parts in memory.
+
+Author: Brian Tuan
+"""
+
+from concurrent.futures import wait
+import hashlib
+import os
+import subprocess
+import time
+from itertools import chain
+from subprocess import CompletedProcess
+from threading import Semaphore
+
+from index import chunk_name
+
+PIECE_SIZE = 1048576
+
+
+class BufferSource:
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+        self.size = len(self.data)
+
+    def pieces(self, offset, length):
+        for start in range(offset, offset + length, PIECE_SIZE):
+            yield self.data[start:min(start + PIECE_SIZE, offset + length)]
+
+
+class FileSource:
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def pieces(self, offset, length):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                piece = f.read(min(PIECE_SIZE, length))
+                if not piece:
+                    raise IOError("{} shrank while uploading it".format(self.path))
+                length -= len(piece)
+                yield piece
+
+
+class StreamSource:
+    size = None
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def parts(self, part_size):
+        """ Yield the stream in parts of exactly part_size bytes, the last one excepted. """
+        part = bytearray()
+        for data in self.iterable:
+            part += data
+            while len(part) >= part_size:
+                yield bytes(part[:part_size])
+                del part[:part_size]
+        if part:
+            yield bytes(part)
+
+
+def make_source(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return BufferSource(source)
+    if isinstance(source, (str, os.PathLike)):
+        return FileSource(source)
+    if hasattr(source, 'read'):
+        return StreamSource(iter(lambda: source.read(PIECE_SIZE), b''))
+    return StreamSource(source)
+
+
+class Uploader:
+    def __init__(self, psl, max_parts=4):
+        self.psl = psl
+        self.max_parts = max_parts
+
+    def put(self, filename, source, priority=2, node_id=None, persist=True):
+        """ Upload source as filename. None if the file exists or cannot be placed. """
+        psl = self.psl
+        # Hold the name for the whole upload: the entry is only added once every piece is in place.
+        if not psl.claim(filename):
+            return None
+        try:
+            source = make_source(source)
+            if source.size is None:
+                parts = source.parts(psl.block_size)
+                first = next(parts, b'')
+                second = next(parts, None)
+                if second is not None and node_id is None and psl.num > 1:
+                    return self.put_stream(filename, chain([first, second], parts), priority, persist)
+                # Short enough (or pinned to one node): upload it like a buffer.
+                rest = [first] if second is None else chain([first, second], parts)
+                source = BufferSource(b''.join(rest))
+
+            entry = psl.place_entry(filename, source.size, node_id=node_id, priority=priority)
+            if entry is None:
+                return None
+            jobs = []
+            offset = 0
+            for piece_node, name, size in psl.copies(filename, entry):
+                jobs.append((piece_node, name, source.pieces(offset, size)))
+                if 'chunks' in entry:
+                    offset += size
+            try:
+                results = list(psl.fanout_pool().map(lambda job: self.upload(*job, priority=priority), jobs))
+            except BaseException:
+                self.finish(filename, entry, jobs, False, persist)
+                raise
+            return self.finish(filename, entry, jobs, all(results), persist)
+        finally:
+            psl.unclaim(filename)
+
+    def put_stream(self, filename, parts, priority, persist):
+        """ Stripe a stream of unknown size, placing and uploading each part as it is read. """
+        psl = self.psl
+        slots = Semaphore(self.max_parts)
+        chunks = []
+        jobs = []
+        futures = []
+        size = 0
+        try:
+            for i, part in enumerate(parts):
+                slots.acquire()
+                chunks = psl.place_chunks(priority, [len(part)], chunks)
+                size += len(part)
+                job = (chunks[-1], chunk_name(filename, i), BufferSource(part).pieces(0, len(part)))
+                jobs.append(job)
+                future = psl.fanout_pool().submit(self.upload, *job, priority=priority)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            entry = psl.make_entry(chunks[0], priority, size, chunks=chunks)
+            # Every part, not just up to the first failure: the cleanup must not race a part still writing.
+            ok = all([future.result() for future in futures])
+        except BaseException:
+            wait(futures)
+            self.finish(filename, psl.make_entry(chunks[0], priority, size, chunks=chunks) if chunks else None,
+                        jobs, False, persist)
+            raise
+        return self.finish(filename, entry, jobs, ok, persist)
+
+    def finish(self, filename, entry, jobs, ok, persist):
+        """ Rename the verified pieces into place and add the entry, or undo everything. """
+        psl = self.psl
+        paths = []
+        for piece_node, name, _ in jobs:
+            node = psl.datanodes[piece_node]
+            path = psl.remote_path(node, name)
+            paths.append((node, path, path + '.psl-upload'))
+        if ok:
+            rc = psl.execute_all([(node, 'mv "{}" "{}"'.format(tmp, path)) for node, path, tmp in paths])
+            ok = rc.returncode == 0
+        if not ok:
+            if paths:
+                psl.execute_all([(node, 'rm -f "{}" "{}"'.format(tmp, path)) for node, path, tmp in paths])
+            if entry is not None:
+                psl.release_entry(filename, entry)
+                psl.commit_metadata(persist)
+            return CompletedProcess(['put', filename], 1)
+        if psl.cache is not None:
+            psl.cache.invalidate(filename)
+        psl.add_entry(filename, entry)
+        psl.commit_metadata(persist)
+        return CompletedProcess(['put', filename], 0)
+
+    def upload(self, node_id, name, pieces, priority=None):
+        """ Stream pieces into name's temporary file on the node. True if the node got them intact. """
+        start = time.time()
+        sent = 0
+        transport = self.psl.transport
+        node = self.psl.datanodes[node_id]
+        path = self.psl.remote_path(node, name)
+        tmp = path + '.psl-upload'
+        command = 'mkdir -p "{}" && cat > "{}" && md5sum < "{}"'.format(path[:path.rfind('/')], tmp, tmp)
+        proc = transport.spawn(node, transport.argv(node, command),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        digest = hashlib.md5()
+        try:
+            try:
+                for piece in pieces:
+                    digest.update(piece)
+                    proc.stdin.write(piece)
+                    sent += len(piece)
+                proc.stdin.close()
+            except BrokenPipeError:
+                # The node died; its exit code reports the failure below.
+                pass
+            out = proc.stdout.read()
+            proc.wait()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+            proc.stdout.close()
+            transport.release(node)
+        ok = proc.returncode == 0 and out.split()[:1] == [digest.hexdigest().encode()]
+        self.psl.metrics.observe('put', time.time() - start, node=node, priority=priority,
+                                 nbytes=sent if ok else 0, error=not ok)
+        return ok
+
+# End of file